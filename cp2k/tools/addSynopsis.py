@@ -207,12 +207,12 @@ def insertSynopsis(defs,infile,outfile,logFile=sys.stdout):
 	    raise
 	except Warning, w:
 	    logFile.write("ignoring warning at line %d of file '%s'\n"%
-                          (lineNr,infile.name))
+                          (lineNr,getattr(infile,'name','<input>')))
 	    logFile.write(str(w)+"\n")
 
-def addSynopsisToFile(ifile,sfile,outfile,logFile=sys.stdout):
-    """Adds the synopsis to the file sfile, reading the interface from
-    ifile, and writing the result to outfile"""
+def interfaceDefs(ifile,logFile=sys.stdout):
+    """Returns the definitions of the functions and subroutines of the
+    interface in ifile (as expected by insertSynopsis)"""
     rawDefs=parseInterface(ifile,logFile)
     defs={}
     #print "rawDefs=",rawDefs
@@ -224,7 +224,124 @@ def addSynopsisToFile(ifile,sfile,outfile,logFile=sys.stdout):
                 else:
                     defs[key]=rawDefs[kind][key]
     #print "def=",defs
-    insertSynopsis(defs,sfile,outfile,logFile)
+    return defs
+
+class InterfaceStore:
+    """On disk store of the parsed interfaces (see interfaceDefs).
+    Every interface file has its own pickle in the store directory, read only
+    when that interface is needed. An entry is valid as long as the interface
+    file has the same mtime and size or, if these changed, the same sha1.
+    The messages of the parsing are stored too, and repeated when the entry
+    is used. A readOnly store uses the valid entries but writes none"""
+    storeVersion=1
+
+    def __init__(self,path,readOnly=0):
+        self.path=path
+        self.readOnly=readOnly
+
+    def entryPath(self,fileName):
+        """Returns the path of the entry of the interface file fileName"""
+        import os.path, hashlib
+        fileName=os.path.abspath(fileName)
+        dirHash=hashlib.sha1(os.path.dirname(fileName)).hexdigest()[:8]
+        return os.path.join(self.path,
+                            os.path.basename(fileName)+"-"+dirHash+".pickle")
+
+    def readEntry(self,fileName):
+        """Returns the entry of fileName, or None if missing or unreadable"""
+        import cPickle
+        try:
+            f=open(self.entryPath(fileName),'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                entry=cPickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+        if (type(entry)!=type({}) or
+            entry.get('version')!=self.storeVersion):
+            return None
+        return entry
+
+    def writeEntry(self,fileName,entry):
+        """Writes atomically the entry of fileName"""
+        import os, tempfile, cPickle
+        if self.readOnly: return
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path): raise
+        (fd,tmpName)=tempfile.mkstemp(dir=self.path)
+        f=os.fdopen(fd,'wb')
+        try:
+            cPickle.dump(entry,f,cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpName,self.entryPath(fileName))
+
+    def defs(self,ifile,logFile=sys.stdout):
+        """Returns the definitions of the interface in ifile (an open file),
+        parsing it only if the stored ones are not valid"""
+        import os, hashlib
+        from cStringIO import StringIO
+        st=os.fstat(ifile.fileno())
+        entry=self.readEntry(ifile.name)
+        if entry and (entry['mtime'],entry['size'])==(st.st_mtime,st.st_size):
+            logFile.write(entry['log'])
+            return entry['defs']
+        content=ifile.read()
+        contentHash=hashlib.sha1(content).hexdigest()
+        if entry and entry['hash']==contentHash:
+            entry['mtime']=st.st_mtime
+            entry['size']=st.st_size
+            self.writeEntry(ifile.name,entry)
+            logFile.write(entry['log'])
+            return entry['defs']
+        parseLog=StringIO()
+        defs=interfaceDefs(StringIO(content),parseLog)
+        self.writeEntry(ifile.name,{'version':self.storeVersion,
+                                    'mtime':st.st_mtime,'size':st.st_size,
+                                    'hash':contentHash,'defs':defs,
+                                    'log':parseLog.getvalue()})
+        logFile.write(parseLog.getvalue())
+        return defs
+
+# if set to a dictionary interfaceDefsOfFile keeps the parsed interfaces
+# in it (used by long running processes like prettifyServer)
+interfaceCache=None
+# if set to an InterfaceStore interfaceDefsOfFile takes the parsed
+# interfaces from it
+interfaceStore=None
+
+def interfaceDefsOfFile(ifile,logFile=sys.stdout):
+    """Same as interfaceDefs, but if interfaceCache is a dictionary the
+    definitions are cached (until the interface file changes), and if
+    interfaceStore is set they are kept in it"""
+    if interfaceCache is None and interfaceStore is None:
+        return interfaceDefs(ifile,logFile)
+    import os
+    st=os.fstat(ifile.fileno())
+    key=(st.st_mtime,st.st_size)
+    if interfaceCache is not None:
+        cached=interfaceCache.get(ifile.name)
+        if cached and cached[0]==key:
+            return cached[1]
+    if interfaceStore is not None:
+        defs=interfaceStore.defs(ifile,logFile)
+    else:
+        defs=interfaceDefs(ifile,logFile)
+    if interfaceCache is not None:
+        interfaceCache[ifile.name]=(key,defs)
+    return defs
+
+def addSynopsisToFile(ifile,sfile,outfile,logFile=sys.stdout):
+    """Adds the synopsis to the file sfile, reading the interface from
+    ifile, and writing the result to outfile"""
+    insertSynopsis(interfaceDefsOfFile(ifile,logFile),sfile,outfile,logFile)
     
 
 def addSynopsisInDir(interfaceDir, outDir,filePaths,logFile=sys.stdout):
@@ -261,10 +378,14 @@ def addSynopsisInDir(interfaceDir, outDir,filePaths,logFile=sys.stdout):
     return fileMapping
 
 if __name__ == '__main__':
-    if len(sys.argv)<4:
-        print "usage:", sys.argv[0]," interface_dir out_dir sourcefile1.F [sourcefile2.F ...]"
+    args=sys.argv[1:]
+    if args and args[0].startswith("--store="):
+        interfaceStore=InterfaceStore(args[0][len("--store="):])
+        args=args[1:]
+    if len(args)<3:
+        print "usage:", sys.argv[0]," [--store=store_dir] interface_dir out_dir sourcefile1.F [sourcefile2.F ...]"
     else:
-        interfaceDir=sys.argv[1]
-        outDir=sys.argv[2]
-        addSynopsisInDir(interfaceDir, outDir,sys.argv[3:],sys.stdout)
+        interfaceDir=args[0]
+        outDir=args[1]
+        addSynopsisInDir(interfaceDir, outDir,args[2:],sys.stdout)
 
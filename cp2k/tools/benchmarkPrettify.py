@@ -0,0 +1,528 @@
+#! /usr/bin/env python
+"""Benchmarks of the fortran source processing tools.
+
+The suite runs the stages of prettify (normalizeFortranFile.rewriteFortranFile,
+prettify.upcaseKeywords, replacer.replaceWords, addSynopsis.insertSynopsis)
+and instantiateTemplates.instantiateTemplate on a fixed corpus (the first
+files of cp2k/src, in alphabetical order) and on generated stress files
+(huge routines, thousands of declarations, deep interface blocks, very long
+lines). Every stage runs in its own process, so that the peak memory can be
+measured. The results (lines/s, bytes/s, peak memory) are written as json,
+and two runs can be compared.
+
+The micro benchmarks time the upcasing and the joining of continuation lines
+on generated maple2f90/autotune-like sources of growing size; the time per
+byte should not grow with the length of the lines.
+
+usage:
+  benchmarkPrettify.py suite [--src=../src] [--files=N] [--scale=N]
+      [--repeat=N] [--stages=normalize,upcase,...] [--output=run.json]
+  benchmarkPrettify.py compare old.json new.json [--threshold=0.1]
+  benchmarkPrettify.py micro [--sizes=1000,10000,...] [--string-fraction=0.2]
+"""
+
+import sys
+import os, os.path
+import time
+import random
+import hashlib
+import glob
+from cStringIO import StringIO
+import StringIO as pyStringIO
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import fortranLexer
+import prettify
+import normalizeFortranFile
+import replacer
+import addSynopsis
+import instantiateTemplates
+
+suiteVersion=1
+
+def generatedExpression(length,stringFraction=0.2,seed=1):
+    """Returns the terms of a generated expression of about length characters
+    as a list"""
+    rand=random.Random(seed)
+    terms=[]
+    size=0
+    while size<length:
+        r=rand.random()
+        i=len(terms)
+        if r<stringFraction:
+            term="'t%d: if (x) then'//"%i
+        elif r<stringFraction+0.2:
+            term="sqrt(t%d)*"%i
+        elif r<stringFraction+0.3:
+            term="0.1D1/dble(t%d)**2+"%i
+        else:
+            term="0.%dD1*t%d+"%(i%10,i)
+        terms.append(term)
+        size+=len(term)
+    return terms
+
+def generatedLongLine(length,stringFraction=0.2):
+    "Returns a single line with an expression of about length characters"
+    return ("        cg = "+"".join(generatedExpression(length,stringFraction))+
+            "0.1D1\n")
+
+def generatedContinuedLines(length,stringFraction=0.2,lineLength=70):
+    """Returns an assignment of about length characters split in continuation
+    lines of about lineLength characters"""
+    lines=[]
+    line="        cg = "
+    for term in generatedExpression(length,stringFraction):
+        if len(line)+len(term)>lineLength:
+            lines.append(line+"&\n")
+            line="             "
+        line+=term
+    lines.append(line+"0.1D1\n")
+    return "".join(lines)
+
+def moduleSource(name,body,header=""):
+    "Returns the source of the module name containing the routines in body"
+    return ("MODULE "+name+"\n"+
+            "  USE kinds, ONLY: dp\n"+
+            "#include \"cp_common_uses.h\"\n"+
+            "  IMPLICIT NONE\n  PRIVATE\n"+
+            "  CHARACTER(len=*), PARAMETER, PRIVATE :: moduleN = '"+name+"'\n"+
+            header+
+            "CONTAINS\n"+body+
+            "END MODULE "+name+"\n")
+
+def robodocHeader(name):
+    "Returns a robodoc comment for the routine name"
+    return ("!!****f* "+name+"\n"+
+            "!!\n!!   NAME\n!!     "+name+"\n"+
+            "!!\n!!   SYNOPSIS\n!!     old synopsis\n"+
+            "!!\n!!   FUNCTION\n!!     generated routine\n"+
+            "!!\n!!*** **********************************************************\n")
+
+def hugeRoutineSource(scale):
+    """Returns a module with a single routine with 2000*scale statements
+    and the routine names"""
+    rand=random.Random(2)
+    lines=["  SUBROUTINE huge_routine(x,n,error)\n",
+           "    REAL(KIND=dp), DIMENSION(:), INTENT(INOUT) :: x\n",
+           "    INTEGER, INTENT(IN) :: n\n",
+           "    TYPE(cp_error_type), INTENT(inout) :: error\n",
+           "    CHARACTER(len=*), PARAMETER :: routineN = 'huge_routine'\n",
+           "    INTEGER :: i\n",
+           "    REAL(KIND=dp) :: "+", ".join(["t%d"%i for i in xrange(50)])+"\n"]
+    for i in xrange(2000*scale):
+        r=rand.random()
+        j=rand.randrange(50)
+        if r<0.1:
+            lines.append("    if (t%d > 0.0_dp) then\n      t%d = sqrt(t%d) ! branch %d\n    end if\n"%(j,j,j,i))
+        elif r<0.2:
+            lines.append("    do i=1,n\n      x(i) = x(i)+t%d*real(i,dp)\n    end do\n"%j)
+        elif r<0.25:
+            lines.append("    call cp_assert(t%d>=0.0_dp,cp_failure_level,cp_assertion_failed,routineN,&\n         'negative t%d',error)\n"%(j,j))
+        else:
+            lines.append("    t%d = t%d*0.5_dp+abs(t%d)-max(t%d,1.0_dp)\n"%(
+                j,rand.randrange(50),rand.randrange(50),rand.randrange(50)))
+    lines.append("  END SUBROUTINE huge_routine\n")
+    return (moduleSource("bench_huge_routine",robodocHeader("huge_routine")+
+                         "".join(lines)),["huge_routine"])
+
+def manyDeclarationsSource(scale):
+    """Returns a module with a routine with 300*scale declarations (parameters
+    depending on other parameters, arrays depending on them, half of the
+    variables unused) and the routine names"""
+    rand=random.Random(3)
+    decl=["  SUBROUTINE many_declarations(n,error)\n",
+          "    INTEGER, INTENT(IN) :: n\n",
+          "    TYPE(cp_error_type), INTENT(inout) :: error\n"]
+    body=[]
+    params=[]
+    for i in xrange(300*scale):
+        r=rand.random()
+        if r<0.3:
+            if params:
+                decl.append("    INTEGER, PARAMETER :: p_%d = p_%d+1\n"%(
+                    i,rand.choice(params)))
+            else:
+                decl.append("    INTEGER, PARAMETER :: p_%d = 1\n"%i)
+            params.append(i)
+        elif r<0.6 and params:
+            decl.append("    REAL(KIND=dp), DIMENSION(p_%d) :: a_%d\n"%(
+                rand.choice(params),i))
+            if rand.random()<0.5:
+                body.append("    a_%d = 0.0_dp\n"%i)
+        else:
+            decl.append("    INTEGER :: n_%d\n"%i)
+            if rand.random()<0.5:
+                body.append("    n_%d = n\n"%i)
+    return (moduleSource("bench_many_declarations",
+                         robodocHeader("many_declarations")+"".join(decl)+
+                         "".join(body)+"  END SUBROUTINE many_declarations\n"),
+            ["many_declarations"])
+
+def deepInterfacesSource(scale):
+    """Returns a module with 100*scale routines, each with an interface block
+    declaring dummy procedures with their own interfaces, and the routine
+    names"""
+    routines=[]
+    names=[]
+    for i in xrange(100*scale):
+        name="deep_interface_%d"%i
+        names.append(name)
+        routines.append(robodocHeader(name)+
+            "  SUBROUTINE "+name+"(f,g,x)\n"+
+            "    INTERFACE\n"+
+            "      FUNCTION f(x,h) RESULT(res)\n"+
+            "        USE kinds, ONLY: dp\n"+
+            "        REAL(KIND=dp), INTENT(IN) :: x\n"+
+            "        INTERFACE\n"+
+            "          FUNCTION h(y) RESULT(r)\n"+
+            "            USE kinds, ONLY: dp\n"+
+            "            REAL(KIND=dp), INTENT(IN) :: y\n"+
+            "            REAL(KIND=dp) :: r\n"+
+            "          END FUNCTION h\n"+
+            "        END INTERFACE\n"+
+            "        REAL(KIND=dp) :: res\n"+
+            "      END FUNCTION f\n"+
+            "      SUBROUTINE g(x)\n"+
+            "        USE kinds, ONLY: dp\n"+
+            "        REAL(KIND=dp), INTENT(INOUT) :: x\n"+
+            "      END SUBROUTINE g\n"+
+            "    END INTERFACE\n"+
+            "    REAL(KIND=dp), INTENT(INOUT) :: x\n"+
+            "    INTEGER :: unused_%d\n"%i+
+            "    CALL g(x)\n"+
+            "  END SUBROUTINE "+name+"\n")
+    return (moduleSource("bench_deep_interfaces","".join(routines)),names)
+
+def longLinesSource(scale):
+    "Returns a module with very long lines and the routine names"
+    body=("  SUBROUTINE long_lines(cg)\n"+
+          "    REAL(KIND=dp), INTENT(OUT) :: cg\n"+
+          generatedLongLine(20000*scale)+
+          generatedContinuedLines(20000*scale)+
+          "  END SUBROUTINE long_lines\n")
+    return (moduleSource("bench_long_lines",robodocHeader("long_lines")+body),
+            ["long_lines"])
+
+syntheticGenerators=[hugeRoutineSource,manyDeclarationsSource,
+                     deepInterfacesSource,longLinesSource]
+
+routineNameRe=None
+def routineNames(text):
+    "Returns the names of the routines defined in text"
+    global routineNameRe
+    if routineNameRe is None:
+        import re
+        routineNameRe=re.compile(
+            r"^ *(?:recursive +|pure +|elemental +)*(?:subroutine|function) +([a-zA-Z_0-9]+)",
+            re.IGNORECASE|re.MULTILINE)
+    return [name.lower() for name in routineNameRe.findall(text)]
+
+def loadCorpus(srcDir,maxFiles=None,scale=1):
+    """Returns the corpus: a list of dictionaries with name, path, text and
+    routines (the names of the routines, used for the synopsis).
+    The corpus is made of the first maxFiles .F files of srcDir (all if
+    maxFiles is None) and the generated stress files (if scale>0).
+    The generated files get a path in srcDir (for cp_common_uses.h), but are
+    never written."""
+    corpus=[]
+    fileNames=glob.glob(os.path.join(srcDir,"*.F"))
+    fileNames.sort()
+    if maxFiles is not None:
+        fileNames=fileNames[:maxFiles]
+    for fileName in fileNames:
+        f=open(fileName,'r')
+        text=f.read()
+        f.close()
+        corpus.append({'name':os.path.basename(fileName),'path':fileName,
+                       'text':text,'routines':routineNames(text)})
+    if scale>0:
+        for generator in syntheticGenerators:
+            (text,routines)=generator(scale)
+            name=text[len("MODULE "):text.index("\n")]+".F"
+            corpus.append({'name':name,'path':os.path.join(srcDir,name),
+                           'text':text,'routines':routines})
+    return corpus
+
+def loadTemplates(srcDir):
+    """Returns the templates of srcDir: a list of dictionaries with name,
+    text and substitutions (the list of substitutions of the instantiation
+    file)"""
+    templates=[]
+    fileNames=glob.glob(os.path.join(srcDir,"*.instantiation"))
+    fileNames.sort()
+    for fileName in fileNames:
+        templateName=fileName[:-len(".instantiation")]+".template"
+        if not os.path.exists(templateName): continue
+        f=open(fileName,'r')
+        substitutions=eval(f.read())
+        f.close()
+        f=open(templateName,'r')
+        text=f.read()
+        f.close()
+        templates.append({'name':os.path.basename(templateName),'text':text,
+                          'substitutions':substitutions})
+    return templates
+
+def corpusHash(corpus):
+    "Returns a hash identifying the content of the corpus"
+    h=hashlib.sha1()
+    for entry in corpus:
+        h.update(entry['name']+"\0"+entry['text']+"\0")
+    return h.hexdigest()
+
+class NamedBuffer(pyStringIO.StringIO):
+    """In memory file with a name, that keeps its content when closed
+    (instantiateTemplate uses the names and closes the files)"""
+    def __init__(self,name,text=""):
+        pyStringIO.StringIO.__init__(self,text)
+        self.name=name
+    def close(self):
+        pass
+
+def runNormalize(entry,logFile):
+    normalizeFortranFile.rewriteFortranFile(StringIO(entry['text']),StringIO(),
+                                            logFile,orig_filename=entry['path'])
+
+def runUpcase(entry,logFile):
+    prettify.upcaseKeywords(StringIO(entry['text']),StringIO(),logFile)
+
+def runReplace(entry,logFile):
+    replacer.replaceWords(StringIO(entry['text']),StringIO(),logFile=logFile)
+
+def runSynopsis(entry,logFile):
+    defs={}
+    for name in entry['routines']:
+        defs[name]={'name':name,'kind':'subroutine','expansion':
+                    "SUBROUTINE "+name+"()\nEND SUBROUTINE "+name+"\n"}
+    addSynopsis.insertSynopsis(defs,StringIO(entry['text']),StringIO(),logFile)
+
+def runTemplates(entry,logFile):
+    for substitution in entry['substitutions']:
+        instantiateTemplates.instantiateTemplate(
+            NamedBuffer(entry['name'],entry['text']),NamedBuffer("out.F"),
+            substitution,logFile)
+
+# name -> (function,uses the templates instead of the corpus)
+stages={'normalize':(runNormalize,0),
+        'upcase':(runUpcase,0),
+        'replace':(runReplace,0),
+        'synopsis':(runSynopsis,0),
+        'templates':(runTemplates,1)}
+stageNames=['normalize','upcase','replace','synopsis','templates']
+
+def peakMemoryKB():
+    "Returns the peak resident memory of this process in KB"
+    import resource
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin':
+        peak/=1024
+    return peak
+
+def runStage(stageName,srcDir,maxFiles=None,scale=1,repeat=1):
+    """Runs the stage stageName on the corpus (or the templates) repeat
+    times. Returns a dictionary with the number of files, lines and bytes,
+    the best time, the peak memory of the process before and after the stage
+    and the number of failed files"""
+    (function,onTemplates)=stages[stageName]
+    if onTemplates:
+        inputs=loadTemplates(srcDir)
+        count=lambda entry:len(entry['substitutions'])
+    else:
+        inputs=loadCorpus(srcDir,maxFiles,scale)
+        count=lambda entry:1
+    lines=0
+    nBytes=0
+    for entry in inputs:
+        lines+=entry['text'].count("\n")*count(entry)
+        nBytes+=len(entry['text'])*count(entry)
+    memoryBefore=peakMemoryKB()
+    best=None
+    failed=0
+    # the tools also print directly to stdout and stderr
+    (oldStdout,oldStderr)=(sys.stdout,sys.stderr)
+    for i in xrange(repeat):
+        fortranLexer._lineCache.clear()
+        fortranLexer._parsedCache.clear()
+        failed=0
+        logFile=StringIO()
+        (sys.stdout,sys.stderr)=(logFile,logFile)
+        try:
+            t0=time.time()
+            for entry in inputs:
+                try:
+                    function(entry,logFile)
+                except Exception:
+                    failed+=1
+            t=time.time()-t0
+        finally:
+            (sys.stdout,sys.stderr)=(oldStdout,oldStderr)
+        if best is None or t<best: best=t
+    return {'files':len(inputs),'lines':lines,'bytes':nBytes,'seconds':best,
+            'linesPerSecond':lines/max(best,1.e-9),
+            'bytesPerSecond':nBytes/max(best,1.e-9),
+            'memoryBeforeKB':memoryBefore,'peakMemoryKB':peakMemoryKB(),
+            'failed':failed}
+
+def runSuite(srcDir,maxFiles=None,scale=1,repeat=3,stagesToRun=stageNames,
+             logFile=sys.stdout):
+    """Runs every stage in its own process, and returns the results of the
+    run (a dictionary)"""
+    import subprocess, platform
+    srcDir=os.path.abspath(srcDir)
+    corpus=loadCorpus(srcDir,maxFiles,scale)
+    result={'version':suiteVersion,
+            'date':time.strftime("%Y-%m-%d %H:%M:%S"),
+            'host':platform.node(),'python':platform.python_version(),
+            'corpus':{'srcDir':srcDir,'files':len(corpus),
+                      'maxFiles':maxFiles,'scale':scale,
+                      'hash':corpusHash(corpus)},
+            'repeat':repeat,'stages':{}}
+    del corpus
+    for stageName in stagesToRun:
+        args=[sys.executable,os.path.abspath(__file__),'stage',stageName,
+              '--src='+srcDir,'--scale=%d'%scale,'--repeat=%d'%repeat]
+        if maxFiles is not None:
+            args.append('--files=%d'%maxFiles)
+        # the includes are searched in the working directory
+        child=subprocess.Popen(args,stdout=subprocess.PIPE,cwd=srcDir)
+        output=child.communicate()[0]
+        if child.returncode!=0:
+            raise Exception("stage "+stageName+" failed")
+        stageResult=json.loads(output)
+        result['stages'][stageName]=stageResult
+        logFile.write("%-10s %8d lines %10.3f s %10.0f lines/s %8d KB peak\n"%(
+            stageName,stageResult['lines'],stageResult['seconds'],
+            stageResult['linesPerSecond'],stageResult['peakMemoryKB']))
+        logFile.flush()
+    return result
+
+def compareRuns(old,new,threshold=0.1,logFile=sys.stdout):
+    """Writes the comparison of two runs of the suite to logFile.
+    Returns the list of the stages that are slower (in lines/s) or need
+    more memory by more than the fraction threshold"""
+    if old['corpus']['hash']!=new['corpus']['hash']:
+        logFile.write("WARNING the runs used different corpora\n")
+    logFile.write("%-10s %12s %12s %8s %10s %10s %8s\n"%(
+        "stage","old lines/s","new lines/s","speedup","old KB","new KB",
+        "memory"))
+    regressions=[]
+    for stageName in stageNames:
+        if not (old['stages'].has_key(stageName) and
+                new['stages'].has_key(stageName)):
+            continue
+        o=old['stages'][stageName]
+        n=new['stages'][stageName]
+        speedup=n['linesPerSecond']/max(o['linesPerSecond'],1.e-9)
+        oMem=o['peakMemoryKB']-o['memoryBeforeKB']
+        nMem=n['peakMemoryKB']-n['memoryBeforeKB']
+        memoryRatio=float(max(nMem,1))/max(oMem,1)
+        flag=""
+        if speedup<1.-threshold or memoryRatio>1.+threshold:
+            regressions.append(stageName)
+            flag=" <-"
+        logFile.write("%-10s %12.0f %12.0f %8.2f %10d %10d %8.2f%s\n"%(
+            stageName,o['linesPerSecond'],n['linesPerSecond'],speedup,
+            oMem,nMem,memoryRatio,flag))
+    return regressions
+
+def timeIt(function,repeat=3):
+    """Returns the minimum time of repeat calls to function"""
+    best=None
+    for i in xrange(repeat):
+        fortranLexer._lineCache.clear()
+        fortranLexer._parsedCache.clear()
+        t0=time.time()
+        function()
+        t=time.time()-t0
+        if best is None or t<best: best=t
+    return best
+
+def benchmarkUpcase(sizes,stringFraction=0.2,logFile=sys.stdout):
+    """Times the upcasing of generated lines of the given sizes (single long
+    line and continued lines)"""
+    logFile.write("upcase (string fraction %.2f)\n"%stringFraction)
+    logFile.write("%10s %14s %12s %14s %12s\n"%(
+        "size","long line[s]","[us/kB]","continued[s]","[us/kB]"))
+    for size in sizes:
+        line=generatedLongLine(size,stringFraction)
+        tLine=timeIt(lambda:prettify.upcaseStringKeywords(line))
+        text=generatedContinuedLines(size,stringFraction)
+        tCont=timeIt(lambda:prettify.upcaseKeywords(StringIO(text),StringIO()))
+        logFile.write("%10d %14.5f %12.1f %14.5f %12.1f\n"%(
+            size,tLine,tLine*1.e9/len(line),tCont,tCont*1.e9/len(text)))
+
+def benchmarkJoin(sizes,stringFraction=0.2,logFile=sys.stdout):
+    """Times the joining of the continuation lines of generated statements
+    (normalizeFortranFile.readFortranLine)"""
+    logFile.write("join continuation lines (string fraction %.2f)\n"%
+                  stringFraction)
+    logFile.write("%10s %8s %14s %12s\n"%("size","lines","time[s]","[us/kB]"))
+    for size in sizes:
+        text=generatedContinuedLines(size,stringFraction)
+        t=timeIt(lambda:normalizeFortranFile.readFortranLine(StringIO(text)))
+        logFile.write("%10d %8d %14.5f %12.1f\n"%(
+            size,text.count("\n"),t,t*1.e9/len(text)))
+
+if __name__=='__main__':
+    args=sys.argv[1:]
+    command='micro'
+    if args and not args[0].startswith('--'):
+        command=args[0]
+        args=args[1:]
+    options={'src':os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..','src'),
+             'files':None,'scale':1,'repeat':3,'stages':stageNames,
+             'output':None,'threshold':0.1,
+             'sizes':[1000,10000,100000,1000000],'string-fraction':0.2}
+    positional=[]
+    for arg in args:
+        if not arg.startswith('--'):
+            positional.append(arg)
+            continue
+        if '=' not in arg:
+            print __doc__
+            sys.exit(1)
+        (key,value)=arg[2:].split('=',1)
+        if not options.has_key(key):
+            print __doc__
+            sys.exit(1)
+        if key in ('files','scale','repeat'):
+            value=int(value)
+        elif key in ('threshold','string-fraction'):
+            value=float(value)
+        elif key=='sizes':
+            value=map(int,value.split(','))
+        elif key=='stages':
+            value=value.split(',')
+            for stageName in value:
+                if not stages.has_key(stageName):
+                    print "unknown stage",stageName
+                    sys.exit(1)
+        options[key]=value
+    if command=='micro' and not positional:
+        benchmarkUpcase(options['sizes'],options['string-fraction'])
+        benchmarkJoin(options['sizes'],options['string-fraction'])
+    elif command=='suite' and not positional:
+        result=runSuite(options['src'],options['files'],options['scale'],
+                        options['repeat'],options['stages'])
+        if options['output']:
+            f=open(options['output'],'w')
+            json.dump(result,f,indent=1,sort_keys=True)
+            f.write("\n")
+            f.close()
+    elif command=='stage' and len(positional)==1:
+        json.dump(runStage(positional[0],options['src'],options['files'],
+                           options['scale'],options['repeat']),sys.stdout)
+    elif command=='compare' and len(positional)==2:
+        runs=[]
+        for fileName in positional:
+            f=open(fileName,'r')
+            runs.append(json.load(f))
+            f.close()
+        regressions=compareRuns(runs[0],runs[1],options['threshold'])
+        sys.exit(len(regressions)>0)
+    else:
+        print __doc__
+        sys.exit(1)
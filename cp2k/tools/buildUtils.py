@@ -2,6 +2,7 @@
 """Functions that builds cp2k, rebuild templates, prettify,...."""
 
 import sys, re, os, os.path, commands, time, shutil
+from cStringIO import StringIO
 from os.path import join
 import prettify
 import instantiateTemplates
@@ -33,22 +34,72 @@ def buildCp2k(cp2kRoot,buildType="sopt",logFilePath=None,clean=None):
         logFile.close()
         return 1
 
+def prettifyToDir(job):
+    """prettifies a file writing the result to a directory.
+    job is a tuple (filePath,outDir,isTemplateInstance,options), options
+    are the keyword arguments of prettify.prettifyFile.
+    If the prettification of a template instance fails, the unprettified
+    instance is copied to outDir.
+    Returns a tuple (filePath,failed,log)"""
+    (fileP,outDir,isTemplateInstance,options)=job
+    logFile=StringIO()
+    failed=0
+    oldStdout=sys.stdout
+    sys.stdout=logFile
+    try:
+        try:
+            logFile.write("\n+ processing file '"+os.path.basename(fileP)+"'\n")
+            infile=open(fileP,"r")
+            prettyFile=prettify.prettifyFile(infile,logFile=logFile,**options)
+            outfile=open(os.path.join(outDir,os.path.basename(fileP)),"w")
+            outfile.write(prettyFile.read())
+            prettyFile.close()
+            infile.close()
+            outfile.close()
+        except:
+            logFile.write("\n** ERROR prettifying the file "+fileP+"\n")
+            import traceback
+            logFile.write('-'*60+"\n")
+            traceback.print_exc(file=logFile)
+            logFile.write('-'*60+"\n")
+            failed=1
+            if isTemplateInstance:
+                shutil.copyfile(fileP,os.path.join(outDir,os.path.basename(fileP)))
+                logFile.write("+ used unprettified template instance for file "+
+                              os.path.basename(fileP)+"\n")
+    finally:
+        sys.stdout=oldStdout
+    return (fileP,failed,logFile.getvalue())
+
 def prettifyCp2k(cp2kRoot,buildType="sdbg",logDirPath=None,mainLog=sys.stdout,
-                 directives=defaultDirectives):
+                 directives=defaultDirectives,jobs=1):
+    """instantiates the templates, builds cp2k and prettifies the template
+    instances and the modified files, using jobs parallel processes for the
+    prettification"""
     if not logDirPath:
         logDirPath=join(cp2kRoot,"prettify"+time.strftime("%y%m%d-%H:%M"))
     mainLog.write("===== instantiating templates =====\n")
     mainLog.flush()
     import glob
     logFile=open(os.path.join(logDirPath,"templateInstantiation.log"),'w')
-    templateDir=join(logDirPath,"outTemplates")
-    os.mkdir(templateDir)
+    # the instances are kept between runs, only the outdated ones are
+    # generated again
+    templateDir=join(cp2kRoot,"obj","templateInstances")
+    if not os.path.isdir(templateDir):
+        os.makedirs(templateDir)
     instantiationFiles=glob.glob(os.path.join(cp2kRoot,"src","*.instantiation"))
-    templateInstances=[]
-    for instantiationFile in instantiationFiles:
-        templateInstances.extend(
-            instantiateTemplates.evaluateInstantiationFile(instantiationFile,
-                                                           logFile,templateDir))
+    (templateInstances,failures)=instantiateTemplates.instantiateFiles(
+        instantiationFiles,logFile,templateDir,jobs=jobs,
+        stampFile=join(templateDir,"instances.stamps"))
+    # the failed instances are not prettified (they were renamed to .err)
+    if failures:
+        for instance in failures:
+            logFile.write("FAILED instance '%s'\n"%instance)
+        mainLog.write("++ WARNING generation of %d template instances FAILED\n"%
+                      len(failures))
+        failures=set(failures)
+        templateInstances=[instance for instance in templateInstances
+                           if instance not in failures]
 
     mainLog.write(" template generation logFile in '%s'\n"%
                   os.path.basename(logFile.name))
@@ -131,32 +182,28 @@ def prettifyCp2k(cp2kRoot,buildType="sdbg",logDirPath=None,mainLog=sys.stdout,
     mainLog.flush()
 
     if not directives["synopsis"]: buildDir=None
-    errors=0
+    jobList=[]
     for fileP in filesToPret:
-        try:
-            logFile.write("\n+ processing file '"+os.path.basename(fileP)+"'\n")
-            infile=open(fileP,"r")
-            outfile=open(os.path.join(outDir,os.path.basename(fileP)),"w")
-            prettify.prettifyFile(infile,outfile,
-                                  normalize_use=directives["normalize-use"],
-                                  upcase_keywords=directives["upcase-keywords"],
-                                  interfaces_dir=buildDir,
-                                  replace=directives["replace"],
-                                  logFile=logFile)
-            infile.close()
-            outfile.close()
-        except:
-            logFile.write("\n** ERROR prettifying the file "+fileP+"\n")
-            import traceback
-            logFile.write('-'*60+"\n")
-            traceback.print_exc(file=logFile)
-            logFile.write('-'*60+"\n")
-            logFile.flush()
-            errors=errors+1
-            if fileP in templateInstances:
-                shutil.copyfile(fileP,os.path.join(outDir,os.path.basename(fileP)))
-                logFile.write("+ used unprettified template instance for file "+
-                              os.path.basename(fileP)+"\n")
+        jobList.append((fileP,outDir,fileP in templateInstances,
+                        {'normalize_use':directives["normalize-use"],
+                         'upcase_keywords':directives["upcase-keywords"],
+                         'interfaces_dir':buildDir,
+                         'replace':directives["replace"]}))
+    if jobs>1 and len(jobList)>1:
+        import multiprocessing
+        pool=multiprocessing.Pool(min(jobs,len(jobList)))
+        results=pool.imap(prettifyToDir,jobList)
+    else:
+        pool=None
+        results=map(prettifyToDir,jobList)
+    errors=0
+    for (fileP,failed,log) in results:
+        logFile.write(log)
+        logFile.flush()
+        if failed: errors=errors+1
+    if pool:
+        pool.close()
+        pool.join()
     os.mkdir(os.path.join(outDir,"orig"))
     os.chdir(outDir)
     for fileP in os.listdir(outDir):
@@ -4,6 +4,7 @@ import sys
 import re
 import string
 from sys import argv
+import fortranLexer
 
 def convert_into_dp(code):
     c1=code
@@ -11,6 +12,17 @@ def convert_into_dp(code):
     c1=floatRe.sub(r"\1e\2_dp",c1)
     return c1
 
+def convertLine(line):
+    """converts the double precision constants in the code of line, leaving
+    strings and comments untouched"""
+    res=[]
+    for (kind,text) in fortranLexer.lexLine(line):
+        if kind==fortranLexer.CODE:
+            res.append(convert_into_dp(text))
+        else:
+            res.append(text)
+    return "".join(res)
+
 if __name__ == '__main__':
     import os.path
     if len(sys.argv)<2:
@@ -24,7 +36,7 @@ if __name__ == '__main__':
                while 1:
                    line=infile.readline().replace("\t",8*" ")
                    if not line: break
-                   outfile.write(convert_into_dp(line))
+                   outfile.write(convertLine(line))
                infile.close()
                outfile.close()
                os.rename(tmpName, fileName)
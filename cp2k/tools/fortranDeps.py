@@ -0,0 +1,425 @@
+#! /usr/bin/env python
+"""Module dependencies of fortran files, and analysis of the build DAG.
+
+The USE statements (also those of the included files, like
+cp_common_uses.h), the #include and include dependencies and the modules
+defined by each file are scanned with the parser of normalizeFortranFile.
+The scan results are cached (in a pickle file, updated like the module
+index: files whose size, modification time and then content hash changed
+are scanned again).
+
+From them the make dependencies can be written (in the format of
+makedepf90 with -m "%m.mod"), and the DAG of the files (a file depends on
+the files defining the modules it uses) analysed: critical path, width
+of the levels, files that serialize the build and the duration of a
+build with N parallel jobs (simulated with the file size or the number of
+lines as cost of each compilation)."""
+
+import sys
+import os, os.path
+import re
+import hashlib
+import cPickle
+from cStringIO import StringIO
+from normalizeFortranFile import readFortranLine, useParseRe
+import moduleIndex
+
+cacheVersion=1
+
+includeRe=re.compile(r"#[ \t]*include[ \t]*[\"<](?P<file>[^\">]+)[\">]")
+fortranIncludeRe=re.compile(r" *include *[\"'](?P<file>[^\"']+)[\"'] *$",
+                            re.IGNORECASE)
+
+def scanFile(inFile):
+    """Scans the fortran file inFile.
+    Returns a dictionary with the lowercase names of the modules it defines
+    ('modules'), of the modules it uses ('uses') and the files it includes
+    ('includes', as written in the include), and 'error' (None or the error
+    that stopped the scan)"""
+    modules=[]
+    uses={}
+    includes=[]
+    error=None
+    try:
+        while 1:
+            (jline,comments,lines)=readFortranLine(inFile)
+            if not lines: break
+            if lines[0][0]=='#':
+                m=includeRe.match(lines[0])
+                if m and m.group('file') not in includes:
+                    includes.append(m.group('file'))
+                continue
+            if not jline or jline.isspace(): continue
+            m=useParseRe.match(jline)
+            if m:
+                uses[m.group('module').lower()]=1
+                continue
+            m=moduleIndex.moduleStartRe.match(jline)
+            if m and m.group('name').lower()!='procedure':
+                if m.group('name').lower() not in modules:
+                    modules.append(m.group('name').lower())
+                continue
+            m=fortranIncludeRe.match(jline)
+            if m and m.group('file') not in includes:
+                includes.append(m.group('file'))
+    except SyntaxError, e:
+        error=str(e)
+    uses=uses.keys()
+    uses.sort()
+    return {'modules':modules,'uses':uses,'includes':includes,'error':error}
+
+class DepCache:
+    """Persistent cache of the results of scanFile"""
+    def __init__(self,path=None):
+        self.path=path
+        self.files={}
+        self.modified=0
+        if path and os.path.exists(path):
+            f=open(path,'rb')
+            try:
+                data=cPickle.load(f)
+            finally:
+                f.close()
+            if data.get('version')==cacheVersion:
+                self.files=data['files']
+
+    def scan(self,fileName):
+        """Returns the result of scanFile for fileName, scanning it only if
+        it changed"""
+        fileName=os.path.abspath(fileName)
+        st=os.stat(fileName)
+        entry=self.files.get(fileName)
+        if entry and entry['mtime']==st.st_mtime and entry['size']==st.st_size:
+            return entry['scan']
+        f=open(fileName)
+        try:
+            content=f.read()
+        finally:
+            f.close()
+        fileHash=hashlib.sha1(content).hexdigest()
+        self.modified=1
+        if entry and entry['hash']==fileHash:
+            entry['mtime']=st.st_mtime
+            entry['size']=st.st_size
+            return entry['scan']
+        scan=scanFile(StringIO(content))
+        scan['size']=len(content)
+        scan['lines']=content.count("\n")
+        self.files[fileName]={'mtime':st.st_mtime,'size':st.st_size,
+                              'hash':fileHash,'scan':scan}
+        return scan
+
+    def save(self,path=None):
+        """Writes the cache (if modified)"""
+        if path is None: path=self.path
+        if not path or (not self.modified and path==self.path): return
+        import tempfile
+        (fd,tmpName)=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        f=os.fdopen(fd,'wb')
+        try:
+            cPickle.dump({'version':cacheVersion,'files':self.files},f,
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpName,path)
+        self.modified=0
+
+class BuildGraph:
+    """The dependencies of a set of fortran files.
+    For each file (as given) it knows the modules it defines, the files it
+    includes (transitively, the existing ones), the modules it uses (also
+    in the included files) and the files it depends on"""
+    def __init__(self,fileNames,cache=None,includeDirs=(),logFile=sys.stdout):
+        if cache is None: cache=DepCache()
+        self.fileNames=list(fileNames)
+        self.defines={}
+        self.includes={}
+        self.uses={}
+        self.cost={}
+        self.moduleFile={}
+        for fileName in self.fileNames:
+            scan=cache.scan(fileName)
+            if scan['error']:
+                logFile.write("error scanning %s: %s\n"%(fileName,scan['error']))
+            self.defines[fileName]=scan['modules']
+            self.cost[fileName]={'size':scan['size'],'lines':scan['lines'],
+                                 'unit':1}
+            uses=dict.fromkeys(scan['uses'])
+            includes=[]
+            toScan=[(fileName,inc) for inc in scan['includes']]
+            while toScan:
+                (includer,inc)=toScan.pop(0)
+                incPath=None
+                for dirName in [os.path.dirname(includer)]+list(includeDirs):
+                    path=os.path.join(dirName,inc)
+                    if os.path.isfile(path):
+                        incPath=path
+                        break
+                if incPath is None or incPath in includes: continue
+                includes.append(incPath)
+                incScan=cache.scan(incPath)
+                uses.update(dict.fromkeys(incScan['uses']))
+                toScan.extend([(incPath,i) for i in incScan['includes']])
+            self.includes[fileName]=includes
+            self.uses[fileName]=sorted(uses.keys())
+            for moduleName in scan['modules']:
+                if self.moduleFile.has_key(moduleName):
+                    logFile.write("module %s defined both in %s and %s\n"%
+                                  (moduleName,self.moduleFile[moduleName],
+                                   fileName))
+                else:
+                    self.moduleFile[moduleName]=fileName
+        self.deps={}
+        for fileName in self.fileNames:
+            deps={}
+            for moduleName in self.uses[fileName]:
+                depFile=self.moduleFile.get(moduleName)
+                if depFile and depFile!=fileName: deps[depFile]=1
+            self.deps[fileName]=sorted(deps.keys())
+
+    def writeMakeDeps(self,outFile):
+        """Writes the make dependencies (as makedepf90 -m "%m.mod" does)"""
+        for fileName in self.fileNames:
+            depMods=[]
+            for moduleName in self.uses[fileName]:
+                depFile=self.moduleFile.get(moduleName)
+                if depFile and depFile!=fileName:
+                    depMods.append(moduleName+".mod")
+            targets=[os.path.splitext(os.path.basename(fileName))[0]+".o"]
+            targets+=[m+".mod" for m in self.defines[fileName]]
+            outFile.write(" ".join(targets)+" : "+
+                          " ".join([fileName]+self.includes[fileName]+depMods)+
+                          "\n")
+
+    def topologicalOrder(self):
+        """Returns the files ordered so that every file comes after the files
+        it depends on, raises SyntaxError if there is a cycle"""
+        nDeps={}
+        dependents={}
+        for fileName in self.fileNames:
+            nDeps[fileName]=len(self.deps[fileName])
+            for dep in self.deps[fileName]:
+                dependents.setdefault(dep,[]).append(fileName)
+        order=[f for f in self.fileNames if nDeps[f]==0]
+        i=0
+        while i<len(order):
+            for fileName in dependents.get(order[i],[]):
+                nDeps[fileName]-=1
+                if nDeps[fileName]==0: order.append(fileName)
+            i+=1
+        if len(order)!=len(self.fileNames):
+            cycle=[f for f in self.fileNames if nDeps[f]>0]
+            raise SyntaxError("cyclic module dependencies between "+
+                              " ".join(cycle))
+        return order
+
+    def analyse(self,weight='unit',jobs=()):
+        """Analyses the DAG, the cost of compiling a file is 1, or its size
+        or its lines (weight='unit','size' or 'lines').
+        Returns a dictionary with
+          files, dependencies: the number of files and of dependencies
+          totalCost: the cost of compiling everything serially
+          criticalPath, criticalPathCost: the most expensive chain of
+            dependent files (in compilation order) and its cost
+          levels: the number of files of each level (the files of a level
+            depend only on files of the previous ones), maxWidth the maximum
+          serializing: the files that are alone in their level, with the
+            number of files depending (also indirectly) on them
+          bottlenecks: the files of the critical path with the most
+            (direct and indirect) dependents
+          simulated: {jobs:cost} the cost of a build with that many parallel
+            jobs (starting first the files with the most expensive chain of
+            dependents)"""
+        order=self.topologicalOrder()
+        cost={}
+        for fileName in order:
+            cost[fileName]=self.cost[fileName][weight]
+        # earliest finish and level of each file
+        finish={}
+        level={}
+        before={}
+        for fileName in order:
+            start=0
+            level[fileName]=0
+            before[fileName]=None
+            for dep in self.deps[fileName]:
+                if before[fileName] is None or finish[dep]>start:
+                    start=finish[dep]
+                    before[fileName]=dep
+                level[fileName]=max(level[fileName],level[dep]+1)
+            finish[fileName]=start+cost[fileName]
+        # the most expensive chain of dependents (included the file itself)
+        tail={}
+        dependents={}
+        for fileName in order:
+            dependents[fileName]=[]
+        for fileName in order:
+            for dep in self.deps[fileName]:
+                dependents[dep].append(fileName)
+        for fileName in reversed(order):
+            tail[fileName]=cost[fileName]+max(
+                [0]+[tail[d] for d in dependents[fileName]])
+        # transitive dependents, as bitsets
+        index=dict([(f,i) for (i,f) in enumerate(order)])
+        reach={}
+        for fileName in reversed(order):
+            bits=0
+            for d in dependents[fileName]:
+                bits|=reach[d]|(1L<<index[d])
+            reach[fileName]=bits
+        nDependents={}
+        for fileName in order:
+            nDependents[fileName]=bin(reach[fileName]).count("1")
+        res={'files':len(order),
+             'dependencies':sum([len(self.deps[f]) for f in order]),
+             'totalCost':sum(cost.values()),'weight':weight}
+        path=[]
+        if order:
+            last=max(order,key=lambda f:(finish[f],-index[f]))
+            res['criticalPathCost']=finish[last]
+            while last is not None:
+                path.append(last)
+                last=before[last]
+            path.reverse()
+        else:
+            res['criticalPathCost']=0
+        res['criticalPath']=path
+        levels=[0]*(max([0]+level.values())+1)
+        for fileName in order:
+            levels[level[fileName]]+=1
+        if not order: levels=[]
+        res['levels']=levels
+        res['maxWidth']=max([0]+levels)
+        res['serializing']=[(f,nDependents[f]) for f in order
+                            if levels[level[f]]==1]
+        bottlenecks=[(f,nDependents[f]) for f in path]
+        bottlenecks.sort(key=lambda x:-x[1])
+        res['bottlenecks']=bottlenecks
+        res['simulated']={}
+        for nJobs in jobs:
+            res['simulated'][nJobs]=self.simulate(order,cost,tail,nJobs)
+        return res
+
+    def simulate(self,order,cost,priority,jobs):
+        """Returns the cost of building the files (in topological order)
+        with jobs parallel compilations, starting first the ready files with
+        the highest priority"""
+        import heapq
+        nDeps={}
+        dependents={}
+        for fileName in order:
+            nDeps[fileName]=len(self.deps[fileName])
+            for dep in self.deps[fileName]:
+                dependents.setdefault(dep,[]).append(fileName)
+        index=dict([(f,i) for (i,f) in enumerate(order)])
+        ready=[(-priority[f],index[f],f) for f in order if nDeps[f]==0]
+        heapq.heapify(ready)
+        running=[]
+        now=0
+        while ready or running:
+            while ready and len(running)<jobs:
+                fileName=heapq.heappop(ready)[2]
+                heapq.heappush(running,(now+cost[fileName],index[fileName],
+                                        fileName))
+            (now,i,fileName)=heapq.heappop(running)
+            for d in dependents.get(fileName,[]):
+                nDeps[d]-=1
+                if nDeps[d]==0:
+                    heapq.heappush(ready,(-priority[d],index[d],d))
+        return now
+
+def writeAnalysis(analysis,outFile,maxList=20):
+    """Writes a readable summary of analysis (see BuildGraph.analyse)"""
+    outFile.write("files: %d, dependencies: %d\n"%
+                  (analysis['files'],analysis['dependencies']))
+    outFile.write("cost (%s): total %d, critical path %d (%d files), "
+                  "parallelism %.1f\n"%
+                  (analysis['weight'],analysis['totalCost'],
+                   analysis['criticalPathCost'],len(analysis['criticalPath']),
+                   float(analysis['totalCost'])/max(1,analysis['criticalPathCost'])))
+    outFile.write("levels: %d, max width: %d\n"%(len(analysis['levels']),
+                                                 analysis['maxWidth']))
+    outFile.write("  width of the levels: %s\n"%
+                  " ".join([str(w) for w in analysis['levels']]))
+    outFile.write("critical path:\n")
+    for fileName in analysis['criticalPath']:
+        outFile.write("  %s\n"%fileName)
+    outFile.write("files alone in their level (dependents):\n")
+    for (fileName,n) in analysis['serializing'][:maxList]:
+        outFile.write("  %s (%d)\n"%(fileName,n))
+    outFile.write("critical path files with most dependents:\n")
+    for (fileName,n) in analysis['bottlenecks'][:maxList]:
+        outFile.write("  %s (%d)\n"%(fileName,n))
+    jobs=analysis['simulated'].keys()
+    jobs.sort()
+    for nJobs in jobs:
+        simCost=analysis['simulated'][nJobs]
+        outFile.write("simulated build with %d jobs: %d (speedup %.1f)\n"%
+                      (nJobs,simCost,
+                       float(analysis['totalCost'])/max(1,simCost)))
+
+if __name__=='__main__':
+    usage=("usage: "+sys.argv[0]+" [--cache=file] [--make=file] [--analyse]\n"+
+           "    [--json] [--weight=unit|size|lines] [--jobs=N[,M...]]\n"+
+           "    [-Idir] file1 [file2 ...]\n"+
+           "  scans the module dependencies of the given fortran files (using\n"+
+           "  the cache, default dir_of_file1/deps.cache), writes the make\n"+
+           "  dependencies to the --make file (- for stdout) and with --analyse\n"+
+           "  writes an analysis of the build DAG (as json with --json),\n"+
+           "  simulating builds with the given numbers of jobs")
+    cachePath=None
+    makeFile=None
+    analyse=0
+    asJson=0
+    weight='unit'
+    jobs=[]
+    includeDirs=[]
+    fileNames=[]
+    for arg in sys.argv[1:]:
+        m=re.match(r"--(cache|make|weight|jobs)=(.+)$",arg)
+        if m:
+            if m.group(1)=='cache':
+                cachePath=m.group(2)
+            elif m.group(1)=='make':
+                makeFile=m.group(2)
+            elif m.group(1)=='weight' and m.group(2) in ('unit','size','lines'):
+                weight=m.group(2)
+            elif m.group(1)=='jobs' and re.match(r"[0-9]+(,[0-9]+)*$",m.group(2)):
+                jobs=[int(j) for j in m.group(2).split(",")]
+            else:
+                print usage
+                sys.exit(1)
+        elif arg=='--analyse':
+            analyse=1
+        elif arg=='--json':
+            asJson=1
+        elif arg.startswith('-I') and len(arg)>2:
+            includeDirs.append(arg[2:])
+        elif arg.startswith('-'):
+            print usage
+            sys.exit(1)
+        else:
+            fileNames.append(arg)
+    if not fileNames or not (makeFile or analyse):
+        print usage
+        sys.exit(1)
+    if cachePath is None:
+        cachePath=os.path.join(os.path.dirname(os.path.abspath(fileNames[0])),
+                               'deps.cache')
+    cache=DepCache(cachePath)
+    graph=BuildGraph(fileNames,cache,includeDirs,sys.stderr)
+    cache.save()
+    if makeFile=='-':
+        graph.writeMakeDeps(sys.stdout)
+    elif makeFile:
+        outFile=open(makeFile,'w')
+        graph.writeMakeDeps(outFile)
+        outFile.close()
+    if analyse:
+        analysis=graph.analyse(weight,jobs)
+        if asJson:
+            import json
+            json.dump(analysis,sys.stdout,indent=1,sort_keys=True)
+            sys.stdout.write("\n")
+        else:
+            writeAnalysis(analysis,sys.stdout)
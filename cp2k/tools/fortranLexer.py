@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+"""Splits free form fortran source lines in code, strings, comments,...
+
+The source tools (normalizeFortranFile, prettify, instantiateTemplates,
+convert_to_dp) use this module to find strings and comments, so that they
+agree on the edge cases (quotes or ! in strings, !$ directives,...).
+The tokens of a line are cached, as the same lines go through several
+tools (and stages of prettify)."""
+
+import re
+
+# token kinds
+CODE='code'                 # code outside strings and comments
+STRING='string'             # a complete character constant with its quotes
+COMMENT='comment'           # a ! comment up to the end of the line
+DIRECTIVE='directive'       # the !$ sentinel of a conditional/OpenMP line
+CONTINUATION='continuation' # an &
+OPEN_STRING='openString'    # an unterminated character constant
+
+# a complete character constant
+stringStr=r"\"[^\"]*\"|'[^']*'"
+tokenRe=re.compile(r"(?P<code>[^&!\"']+)|(?P<string>"+stringStr+")|"+
+                   r"(?P<directive>!\$)|(?P<comment>!.*)|"+
+                   r"(?P<continuation>&)|(?P<openString>[\"'].*)")
+spacesRe=re.compile(r" *\n?\Z")
+specialCharRe=re.compile(r"[&!\"']")
+
+maxCachedLines=50000
+_lineCache={}
+_parsedCache={}
+
+def lexLine(line):
+    """Returns the tokens of line as a tuple of (kind,text) pairs.
+    Joining the texts gives back line.
+    Comments and unterminated strings stop at the newline, which is part of
+    the following code token"""
+    tokens=_lineCache.get(line)
+    if tokens is None:
+        if not specialCharRe.search(line):
+            tokens=((CODE,line),)
+        else:
+            tokens=tuple([(m.lastgroup,m.group())
+                          for m in tokenRe.finditer(line)])
+        if len(_lineCache)>=maxCachedLines:
+            _lineCache.clear()
+        _lineCache[line]=tokens
+    return tokens
+
+def parseFortranLine(line):
+    """Splits a (non preprocessor) line in the parts relevant when joining
+    continuation lines.
+    Returns a tuple (core,continues,comment) where core is the code of the
+    line (strings and !$ directives included) without the leading spaces and
+    the leading and trailing &, continues is true if the line ends with an &
+    and comment is the ! comment (or None).
+    Returns None if the line is not a valid free form line (& in the middle
+    of the code, unterminated strings)"""
+    parsed=_parsedCache.get(line,0)
+    if parsed!=0:
+        return parsed
+    parsed=_parseFortranLine(lexLine(line))
+    if len(_parsedCache)>=maxCachedLines:
+        _parsedCache.clear()
+    _parsedCache[line]=parsed
+    return parsed
+
+def _parseFortranLine(tokens):
+    end=len(tokens)
+    comment=None
+    for i in xrange(end):
+        if tokens[i][0]==COMMENT:
+            end=i
+            comment=tokens[i][1]
+            break
+    # leading spaces and & are not part of the core
+    core=[]
+    start=0
+    if end>0 and tokens[0][0]==CONTINUATION:
+        start=1
+    elif end>0 and tokens[0][0]==CODE:
+        start=1
+        firstCode=tokens[0][1].lstrip(" ")
+        if firstCode:
+            core.append(firstCode)
+        elif end>1 and tokens[1][0]==CONTINUATION:
+            start=2
+    continues=0
+    stop=end
+    if stop>start and tokens[stop-1][0]==CONTINUATION:
+        continues=1
+        stop-=1
+    elif (stop-1>start and tokens[stop-2][0]==CONTINUATION and
+          tokens[stop-1][0]==CODE and spacesRe.match(tokens[stop-1][1])):
+        continues=1
+        stop-=2
+    for (kind,text) in tokens[start:stop]:
+        if kind==CONTINUATION or kind==OPEN_STRING:
+            return None
+        core.append(text)
+    return ("".join(core),continues,comment)
+
+def commentStart(line):
+    """Returns the position of the ! that starts the comment (or the !$
+    directive) of line, None if line has no comment"""
+    pos=0
+    for (kind,text) in lexLine(line):
+        if kind==COMMENT or kind==DIRECTIVE:
+            return pos
+        pos+=len(text)
+    return None
@@ -0,0 +1,381 @@
+#! /usr/bin/env python
+"""Cross-reference database of a fortran source tree.
+
+For each file the database (sqlite) stores the modules it defines (with
+their public symbols, see moduleIndex), the routines, types and named
+interfaces it defines, its USE statements, its call sites and the
+identifiers it references. Like the module index it is updated
+incrementally: only files whose size and modification time, and then
+content hash changed are parsed again (by parallel processes if requested).
+
+The queries (definitions, callers, users of a module, unused public
+symbols) are single indexed sql queries. A public symbol is reported as
+unused if no file other than the one defining its module references an
+identifier with its name, generic names and renames make this a list of
+candidates rather than a proof."""
+
+import sys
+import os, os.path
+import re
+import hashlib
+import sqlite3
+from cStringIO import StringIO
+from normalizeFortranFile import readFortranLine
+import moduleIndex
+
+xrefVersion=1
+
+schema="""
+create table files (id integer primary key, path text unique, mtime real,
+                    size integer, hash text, error text);
+create table modules (name text, file integer, line integer,
+                      defaultPrivate integer, complete integer);
+create table symbols (module text, name text);
+create table definitions (name text, kind text, scope text, file integer,
+                          line integer);
+create table uses (file integer, unit text, module text, only text,
+                   line integer);
+create table calls (file integer, caller text, callee text, line integer);
+create table idents (file integer, name text);
+create index modules_name on modules(name);
+create index modules_file on modules(file);
+create index symbols_module on symbols(module);
+create index definitions_name on definitions(name);
+create index definitions_file on definitions(file);
+create index uses_module on uses(module);
+create index uses_file on uses(file);
+create index calls_callee on calls(callee);
+create index calls_file on calls(file);
+create index idents_name on idents(name);
+create index idents_file on idents(file);
+"""
+
+programStartRe=re.compile(r" *program +(?P<name>[a-zA-Z_][a-zA-Z_0-9]*)",
+                          re.IGNORECASE)
+programEndRe=re.compile(r" *end *program",re.IGNORECASE)
+onlyRe=re.compile(r" *use +[a-zA-Z_][a-zA-Z_0-9]* *, *only *:(?P<names>.*)$",
+                  re.IGNORECASE)
+callRe=re.compile(r" *(?:[0-9]+ +)?(?:if *\(.*\) *)?call +(?P<name>[a-zA-Z_][a-zA-Z_0-9]*)",
+                  re.IGNORECASE)
+stringRe=re.compile(r"\"[^\"]*\"|'[^']*'")
+identifierRe=re.compile(r"\b[a-zA-Z_][a-zA-Z_0-9]*")
+
+def parseXrefs(inFile):
+    """Parses the fortran file inFile.
+    Returns a dictionary with the lists 'modules' (the entries of
+    moduleIndex.parseModuleSymbols, with the 'line' of the module
+    statement), 'definitions' ((name,kind,scope,line) tuples), 'uses'
+    ((unit,module,only,line), only is None or the comma separated only list),
+    'calls' ((caller,callee,line)) and 'idents' (the lowercase identifiers
+    referenced), and 'error' (None or the error that stopped the parsing).
+    Names are lowercase, scope, unit and caller are the innermost program
+    unit (module, program or routine), None outside them."""
+    res={'modules':[],'definitions':[],'uses':[],'calls':[],'idents':[],
+         'error':None}
+    idents={}
+    scopes=[]
+    module=None
+    block=None
+    blockDepth=0
+    lineNr=0
+    try:
+        while 1:
+            line=lineNr+1
+            (jline,comments,lines)=readFortranLine(inFile)
+            if not lines: break
+            lineNr+=len(lines)
+            if not jline or jline.isspace(): continue
+            if module is not None:
+                if (moduleIndex.moduleEndRe.match(jline) and
+                    module['depth']==0 and not module['block']):
+                    res['modules'].append(moduleIndex.finishModule(module))
+                    res['modules'][-1]['line']=module['line']
+                    module=None
+                    if scopes: scopes.pop()
+                    continue
+                moduleIndex.parseModuleStatement(module,jline)
+            for name in identifierRe.findall(stringRe.sub("",jline)):
+                idents[name.lower()]=1
+            scope=None
+            if scopes: scope=scopes[-1]
+            if block=='interface':
+                if moduleIndex.interfaceRe.match(jline):
+                    blockDepth+=1
+                elif moduleIndex.interfaceEndRe.match(jline):
+                    blockDepth-=1
+                    if blockDepth==0: block=None
+                continue
+            if block=='type':
+                if moduleIndex.typeEndRe.match(jline): block=None
+                continue
+            m=moduleIndex.moduleStartRe.match(jline)
+            if m and m.group('name').lower()!='procedure':
+                name=m.group('name').lower()
+                module=moduleIndex.newModule(name,line)
+                res['definitions'].append((name,'module',scope,line))
+                scopes.append(name)
+                continue
+            m=programStartRe.match(jline)
+            if m:
+                name=m.group('name').lower()
+                res['definitions'].append((name,'program',scope,line))
+                scopes.append(name)
+                continue
+            if (moduleIndex.routineEndRe.match(jline) or
+                programEndRe.match(jline)):
+                if scopes: scopes.pop()
+                continue
+            m=moduleIndex.routineStartRe.match(jline)
+            if m:
+                name=m.group('name').lower()
+                kind='function'
+                if jline[:m.start('name')].rstrip().lower().endswith('subroutine'):
+                    kind='subroutine'
+                res['definitions'].append((name,kind,scope,line))
+                scopes.append(name)
+                continue
+            m=moduleIndex.useRe.match(jline)
+            if m:
+                only=None
+                mOnly=onlyRe.match(jline)
+                if mOnly:
+                    only=",".join([n.strip().lower().replace(" ","")
+                                   for n in mOnly.group('names').split(",")])
+                res['uses'].append((scope,m.group('module').lower(),only,line))
+                continue
+            m=callRe.match(jline)
+            if m:
+                res['calls'].append((scope,m.group('name').lower(),line))
+                continue
+            m=moduleIndex.interfaceRe.match(jline)
+            if m:
+                block='interface'
+                blockDepth=1
+                if m.group('name'):
+                    name=m.group('name').lower()
+                    if name not in ('operator','assignment'):
+                        res['definitions'].append((name,'interface',scope,
+                                                   line))
+                continue
+            m=moduleIndex.typeDefRe.match(jline)
+            if m:
+                block='type'
+                res['definitions'].append((m.group('name').lower(),'type',
+                                           scope,line))
+    except SyntaxError, e:
+        res['error']="line %d: %s"%(lineNr+1,e)
+    if module is not None:
+        res['modules'].append(moduleIndex.finishModule(module))
+        res['modules'][-1]['line']=module['line']
+    res['idents']=idents.keys()
+    return res
+
+def parseFileWorker(job):
+    """Parses the file of job=(fileName,oldHash), suitable to be mapped over
+    a process pool. Returns (fileName,mtime,size,hash,xrefs), xrefs is None
+    if the content hash is still oldHash"""
+    (fileName,oldHash)=job
+    st=os.stat(fileName)
+    f=open(fileName,'r')
+    try:
+        content=f.read()
+    finally:
+        f.close()
+    fileHash=hashlib.sha1(content).hexdigest()
+    if fileHash==oldHash:
+        return (fileName,st.st_mtime,st.st_size,fileHash,None)
+    return (fileName,st.st_mtime,st.st_size,fileHash,
+            parseXrefs(StringIO(content)))
+
+class XrefDatabase:
+    """Cross-reference database stored in the sqlite file path"""
+    def __init__(self,path):
+        self.path=path
+        self.db=sqlite3.connect(path)
+        self.db.text_factory=str
+        version=self.db.execute("pragma user_version").fetchone()[0]
+        if version!=xrefVersion:
+            tables=[row[0] for row in self.db.execute(
+                "select name from sqlite_master where type='table'")]
+            for table in tables:
+                self.db.execute("drop table "+table)
+            self.db.executescript(schema)
+            self.db.execute("pragma user_version=%d"%xrefVersion)
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def removeFile(self,fileId):
+        """Removes the file with id fileId and everything it defines"""
+        for table in ('modules','definitions','uses','calls','idents'):
+            self.db.execute("delete from "+table+" where file=?",(fileId,))
+        self.db.execute("delete from symbols where module not in "+
+                        "(select name from modules)")
+        self.db.execute("delete from files where id=?",(fileId,))
+
+    def storeFile(self,fileName,mtime,size,fileHash,xrefs):
+        """Stores the xrefs (see parseXrefs) of fileName"""
+        row=self.db.execute("select id from files where path=?",
+                            (fileName,)).fetchone()
+        if row:
+            self.removeFile(row[0])
+        fileId=self.db.execute(
+            "insert into files (path,mtime,size,hash,error) values (?,?,?,?,?)",
+            (fileName,mtime,size,fileHash,xrefs['error'])).lastrowid
+        for m in xrefs['modules']:
+            self.db.execute("delete from symbols where module=?",(m['name'],))
+            self.db.execute("insert into modules values (?,?,?,?,?)",
+                            (m['name'],fileId,m['line'],m['defaultPrivate'],
+                             m['complete']))
+            self.db.executemany("insert into symbols values (?,?)",
+                                [(m['name'],s) for s in m['public']])
+        self.db.executemany("insert into definitions values (?,?,?,?,?)",
+                            [d[:3]+(fileId,d[3]) for d in xrefs['definitions']])
+        self.db.executemany("insert into uses values (?,?,?,?,?)",
+                            [(fileId,)+u for u in xrefs['uses']])
+        self.db.executemany("insert into calls values (?,?,?,?)",
+                            [(fileId,)+c for c in xrefs['calls']])
+        self.db.executemany("insert into idents values (?,?)",
+                            [(fileId,name) for name in xrefs['idents']])
+
+    def updateFiles(self,fileNames,jobs=1,removeMissingIn=()):
+        """Parses again the files in fileNames that changed (using jobs
+        processes), and removes the files of the directories in
+        removeMissingIn that are not in fileNames.
+        Returns the number of files parsed"""
+        import itertools
+        fileNames=[os.path.abspath(f) for f in fileNames]
+        known={}
+        for (fileId,path,mtime,size,fileHash) in self.db.execute(
+            "select id,path,mtime,size,hash from files"):
+            known[path]=(fileId,mtime,size,fileHash)
+        present={}
+        jobList=[]
+        for fileName in fileNames:
+            present[fileName]=1
+            st=os.stat(fileName)
+            entry=known.get(fileName)
+            if entry and (entry[1],entry[2])==(st.st_mtime,st.st_size):
+                continue
+            jobList.append((fileName,entry and entry[3]))
+        dirs=dict.fromkeys([os.path.abspath(d) for d in removeMissingIn])
+        for (path,entry) in known.items():
+            if dirs.has_key(os.path.dirname(path)) and not present.has_key(path):
+                self.removeFile(entry[0])
+        pool=None
+        if jobs>1 and len(jobList)>1:
+            import multiprocessing
+            pool=multiprocessing.Pool(min(jobs,len(jobList)))
+            results=pool.imap_unordered(parseFileWorker,jobList,8)
+        else:
+            results=itertools.imap(parseFileWorker,jobList)
+        nParsed=0
+        try:
+            for (fileName,mtime,size,fileHash,xrefs) in results:
+                if xrefs is None:
+                    self.db.execute("update files set mtime=?, size=? where path=?",
+                                    (mtime,size,fileName))
+                else:
+                    self.storeFile(fileName,mtime,size,fileHash,xrefs)
+                    nParsed+=1
+            self.db.commit()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        return nParsed
+
+    def updateDir(self,dirName,extensions=('.F','.f90'),jobs=1):
+        """Updates the database with the files of the directory dirName.
+        Returns the number of files parsed"""
+        dirName=os.path.abspath(dirName)
+        fileNames=[os.path.join(dirName,fName) for fName in os.listdir(dirName)
+                   if os.path.splitext(fName)[1] in extensions]
+        return self.updateFiles(fileNames,jobs,removeMissingIn=[dirName])
+
+    def definitions(self,name):
+        """Returns the (name,kind,scope,path,line) of the definitions of name"""
+        return self.db.execute(
+            "select d.name,d.kind,d.scope,f.path,d.line from definitions d "+
+            "join files f on f.id=d.file where d.name=? order by f.path,d.line",
+            (name.lower(),)).fetchall()
+
+    def callers(self,name):
+        """Returns the (caller,path,line) of the calls to name"""
+        return self.db.execute(
+            "select c.caller,f.path,c.line from calls c join files f "+
+            "on f.id=c.file where c.callee=? order by f.path,c.line",
+            (name.lower(),)).fetchall()
+
+    def users(self,moduleName):
+        """Returns the (unit,only,path,line) of the USE of moduleName"""
+        return self.db.execute(
+            "select u.unit,u.only,f.path,u.line from uses u join files f "+
+            "on f.id=u.file where u.module=? order by f.path,u.line",
+            (moduleName.lower(),)).fetchall()
+
+    def unusedPublic(self,moduleName=None):
+        """Returns the (module,symbol,path) of the public symbols (of
+        moduleName, or of all the modules) never referenced outside the file
+        that defines them"""
+        query=("select s.module,s.name,f.path from symbols s "+
+               "join modules m on m.name=s.module join files f on f.id=m.file "+
+               "where not exists (select 1 from idents i where i.name=s.name "+
+               "and i.file!=m.file)")
+        args=()
+        if moduleName:
+            query+=" and s.module=?"
+            args=(moduleName.lower(),)
+        return self.db.execute(query+" order by s.module,s.name",args).fetchall()
+
+if __name__=='__main__':
+    usage=("usage: "+sys.argv[0]+" [--db=file] [--jobs=N] [--def=name] "+
+           "[--callers=name]\n    [--users=module] [--unused[=module]] "+
+           "dir1 [dir2 ...]\n"+
+           "  updates the cross-reference database (default src_dir/xref.db)\n"+
+           "  with the fortran files of the given directories and answers\n"+
+           "  the queries")
+    dbPath=None
+    jobs=1
+    queries=[]
+    dirs=[]
+    for arg in sys.argv[1:]:
+        m=re.match(r"--(def|callers|users|unused)(?:=(.+))?$",arg)
+        if m and (m.group(2) or m.group(1)=='unused'):
+            queries.append((m.group(1),m.group(2)))
+        elif arg.startswith('--db='):
+            dbPath=arg[len('--db='):]
+        elif re.match(r"--jobs=[0-9]+$",arg):
+            jobs=int(arg[len('--jobs='):])
+        elif arg.startswith('-'):
+            print usage
+            sys.exit(1)
+        else:
+            dirs.append(arg)
+    if not dirs and not (dbPath and queries):
+        print usage
+        sys.exit(1)
+    if dbPath is None:
+        dbPath=os.path.join(dirs[0],'xref.db')
+    xref=XrefDatabase(dbPath)
+    for dirName in dirs:
+        nParsed=xref.updateDir(dirName,jobs=jobs)
+        print "parsed",nParsed,"files of",dirName
+    for (query,name) in queries:
+        if query=='def':
+            for (name,kind,scope,path,line) in xref.definitions(name):
+                print "%s:%d: %s %s (in %s)"%(path,line,kind,name,scope)
+        elif query=='callers':
+            for (caller,path,line) in xref.callers(name):
+                print "%s:%d: called by %s"%(path,line,caller)
+        elif query=='users':
+            for (unit,only,path,line) in xref.users(name):
+                if only is None:
+                    print "%s:%d: used by %s"%(path,line,unit)
+                else:
+                    print "%s:%d: used by %s, only: %s"%(path,line,unit,only)
+        else:
+            for (moduleName,symbol,path) in xref.unusedPublic(name):
+                print "%s: %s is not used outside %s"%(path,symbol,moduleName)
+    xref.close()
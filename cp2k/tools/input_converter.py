@@ -67,6 +67,12 @@ class SectionConverter:
             sect_att.add_keyword(kw)
         if conv.sort_keywords:
             sect_att.sort_keywords()
+        if sect.data is not None:
+            if sect_att.data is None:
+                sect_att.data=sect.data
+                sect_att.is_data=1
+            else:
+                sect_att.data.extend(sect.data)
         for subSs in sect.subsections.values():
             for subS in subSs:
                 subS.name=conv.upcase(subS.name)
@@ -1,41 +1,182 @@
 #!env python
-import sys, os, os.path, StringIO
+import sys, os, os.path, re, StringIO, array
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+# a line of the input: its text, the text before the comment, "#" if the
+# line has a comment and the comment
+lineRe=re.compile(r"(([^#\n]*)(#?)([^\n]*)(?:\n|\Z))")
+
+def lex_lines(text):
+    """returns the records of the lines of text as three lists: the text
+    before the comment (stripped), the comment (prefixed by a space, "" if
+    the line has none) and the text of the line"""
+    if "\r" in text:
+        # splitlines would also split at the carriage returns
+        records=lineRe.findall(text)
+        if records and not records[-1][0]:
+            records.pop()
+        lines=[line for (line,core,hasComment,comment) in records]
+        cores=[core.strip() for (line,core,hasComment,comment) in records]
+        comments=[hasComment and " "+comment.strip(" \t\n")
+                  for (line,core,hasComment,comment) in records]
+        return (cores,comments,lines)
+    lines=text.splitlines(1)
+    cores=map(str.strip,lines)
+    comments=[""]*len(lines)
+    pos=text.find("#")
+    lineI=0
+    lineStart=0
+    while pos>=0:
+        lineI+=text.count("\n",lineStart,pos)
+        line=lines[lineI]
+        i=line.find("#")
+        cores[lineI]=line[:i].strip()
+        comments[lineI]=" "+line[i+1:].strip(" \t\n")
+        lineStart=text.find("\n",pos)
+        if lineStart<0: break
+        pos=text.find("#",lineStart)
+    return (cores,comments,lines)
+
+def count_lines(buf,start=0,end=None):
+    "returns the number of newlines in buf[start:end] (buf can be a mmap)"
+    if end is None:
+        end=len(buf)
+    if isinstance(buf,str):
+        return buf.count("\n",start,end)
+    n=0
+    for pos in xrange(start,end,1<<20):
+        n+=buf[pos:min(pos+(1<<20),end)].count("\n")
+    return n
 
 class Parser:
-    "represent a file to parse"
-    def __init__(self,f,lines=[],lineN=0):
+    """represent a file to parse.
+    The file is read at the first use (memory mapped if it is large) and
+    tokenized by lex_lines in blocks of blockSize bytes. cores, comments and
+    texts are the columns of the records of the current block (and of the
+    lines pushed back), recI the index of the next one. If bufEnd is set
+    only buf up to it is read"""
+    blockSize=1<<18
+    def __init__(self,f,lines=None,lineN=0):
         self.f=f
-        self.lines=lines
+        self.buf=None
+        self.bufPos=0
+        self.bufEnd=None
+        self.cores=[]
+        self.comments=[]
+        self.texts=[]
+        self.recI=0
+        self.lineN=0
+        if lines:
+            for line in lines:
+                self.pushback(line)
         self.lineN=lineN
+    def load(self):
+        "reads (or maps) the file"
+        self.buf=None
+        try:
+            import mmap
+            self.bufPos=self.f.tell()
+            if os.fstat(self.f.fileno()).st_size>self.bufPos+self.blockSize:
+                self.buf=mmap.mmap(self.f.fileno(),0,access=mmap.ACCESS_READ)
+        except (AttributeError,EnvironmentError,ValueError):
+            pass
+        if self.buf is None:
+            self.buf=self.f.read()
+            self.bufPos=0
+    def drop_read(self):
+        "removes the records already read"
+        del self.cores[:self.recI]
+        del self.comments[:self.recI]
+        del self.texts[:self.recI]
+        self.recI=0
+    def next_block(self):
+        "tokenizes the next block of lines, returns 0 at the end of the file"
+        if self.buf is None:
+            self.load()
+        bufEnd=self.bufEnd
+        if bufEnd is None:
+            bufEnd=len(self.buf)
+        if self.bufPos>=bufEnd:
+            return 0
+        end=self.buf.find("\n",self.bufPos+self.blockSize,bufEnd)
+        if end<0:
+            end=bufEnd
+        else:
+            end+=1
+        (cores,comments,texts)=lex_lines(self.buf[self.bufPos:end])
+        self.bufPos=end
+        self.drop_read()
+        self.cores+=cores
+        self.comments+=comments
+        self.texts+=texts
+        return 1
     def readline(self):
+        if self.recI>=len(self.texts) and not self.next_block():
+            return ""
+        self.recI+=1
         self.lineN+=1
-        if self.lines:
-            return self.lines.pop()
-        line=self.f.readline()
-        if not line: self.lineN-=1
-        return line
+        return self.texts[self.recI-1]
     def readInputLine(self):
-        coreLines=[]
-        lines=""
-        comment=""
+        recI=self.recI
+        if recI>=len(self.texts):
+            if not self.next_block(): return ("","","")
+            recI=0
+        self.recI=recI+1
+        self.lineN+=1
+        core=self.cores[recI]
+        if core[-1:]!="\\":
+            return (core,self.comments[recI],self.texts[recI])
+        comment=self.comments[recI]
+        lines=self.texts[recI]
+        coreLines=[core[:-1].strip()]
         while 1:
-            line=self.readline()
-            if not line: break
-            lines+=line
-            commStart=line.find('#')
-            if commStart>=0:
-                comment+=" "+line[commStart+1:].strip(" \t\n")
-                coreLines.append(line[:commStart].strip())
-            else:
-                coreLines.append(line.strip(" \t\n"))
-            if not coreLines[-1] or coreLines[-1][-1]!="\\": break
-            coreLines[-1]=coreLines[-1][-1].strip(" \t\n")
+            recI=self.recI
+            if recI>=len(self.texts):
+                if not self.next_block(): break
+                recI=0
+            self.recI=recI+1
+            self.lineN+=1
+            core=self.cores[recI]
+            lines+=self.texts[recI]
+            comment+=self.comments[recI]
+            if core[-1:]!="\\":
+                coreLines.append(core)
+                break
+            coreLines.append(core[:-1].strip())
         return (" ".join(coreLines),comment,lines)
+    def tell(self):
+        "returns the offset in buf of the next line"
+        if self.buf is None:
+            self.load()
+        pos=self.bufPos
+        for line in self.texts[self.recI:]:
+            pos-=len(line)
+        return pos
+    def seek(self,offset):
+        """skips the input up to offset (the start of a line after the next
+        line) counting the lines skipped"""
+        pos=self.tell()
+        self.lineN+=count_lines(self.buf,pos,offset)
+        if offset>pos and self.buf[offset-1]!="\n":
+            self.lineN+=1
+        self.recI=len(self.texts)
+        self.drop_read()
+        self.bufPos=offset
     def pushback(self,lines):
         if lines:
-            for line in lines.splitlines(1):
+            if self.recI and self.texts[self.recI-1] is lines:
+                # the line just read, it is still in the records
+                self.recI-=1
                 self.lineN-=1
-                self.lines.append(line)
+                return
+            (cores,comments,texts)=lex_lines(lines)
+            self.cores[self.recI:self.recI]=cores
+            self.comments[self.recI:self.recI]=comments
+            self.texts[self.recI:self.recI]=texts
+            self.lineN-=len(texts)
     def file_pos(self):
         line=self.readline()
         self.pushback(line)
@@ -43,6 +184,8 @@ class Parser:
     def old_pos(self,line=None):
         return ("%s at line %i: %s"%(repr(self.f.name),self.lineN-1,repr(line)))
     def close(self):
+        if self.buf is not None and not isinstance(self.buf,str):
+            self.buf.close()
         self.f.close()
 
 class Keyword:
@@ -76,9 +219,153 @@ class Keyword:
         self.write(outS)
         return outS.getvalue()
     
+# sections whose lines are rows of a table (an optional label, three
+# coordinates and optional extra columns like molecule and residue names)
+data_sections=["coord","velocity","core_coord","core_velocity",
+               "shell_coord","shell_velocity"]
+
+def is_float(s):
+    "returns true if the string s is a number"
+    try:
+        float(s)
+    except ValueError:
+        return 0
+    return 1
+
+class DataTable:
+    """the rows of a data section (see data_sections).
+    labels are the labels of the rows (None if the rows have no label, like
+    in &VELOCITY), coords their coordinates and extra the text of the
+    columns after the coordinates ("" for the rows without, extra is None if
+    no row has them).
+    While the rows are added labels and extra are lists and coords an
+    array.array('d') with 3 values per row, finish converts them to numpy
+    arrays (of strings, and of float64 with shape (n_rows,3)) if numpy is
+    available.
+    comments maps the index of a row to its comment, pre_comments to the
+    comments of the lines before it"""
+    def __init__(self,has_labels,labels=None,coords=None,extra=None):
+        self.labels=labels
+        if has_labels and labels is None:
+            self.labels=[]
+        self.coords=coords
+        if coords is None:
+            self.coords=array.array('d')
+        self.extra=extra
+        self.comments={}
+        self.pre_comments={}
+    def n_rows(self):
+        if numpy is not None and isinstance(self.coords,numpy.ndarray):
+            return self.coords.size/3
+        return len(self.coords)/3
+    def add_row(self,values,comment=None,pre_comments=None):
+        """adds the row with the given values (a list of strings), returns 0
+        without adding it if values is not a row of this table"""
+        start=0
+        if self.labels is not None:
+            start=1
+        if len(values)<start+3:
+            return 0
+        try:
+            x=float(values[start])
+            y=float(values[start+1])
+            z=float(values[start+2])
+        except ValueError:
+            return 0
+        row=self.n_rows()
+        self.coords.append(x)
+        self.coords.append(y)
+        self.coords.append(z)
+        if start:
+            self.labels.append(intern(values[0]))
+        if len(values)>start+3:
+            if self.extra is None:
+                self.extra=[""]*row
+            self.extra.append(" ".join(values[start+3:]))
+        elif self.extra is not None:
+            self.extra.append("")
+        if comment:
+            self.comments[row]=comment
+        if pre_comments:
+            self.pre_comments[row]=pre_comments
+        return 1
+    def extend(self,other):
+        "appends the rows of the table other (with the same columns)"
+        n=self.n_rows()
+        nOther=other.n_rows()
+        coords=array.array('d')
+        for table in (self,other):
+            if isinstance(table.coords,array.array):
+                coords.extend(table.coords)
+            else:
+                coords.extend(numpy.asarray(table.coords).ravel().tolist())
+        self.coords=coords
+        if self.labels is not None:
+            self.labels=list(self.labels)+list(other.labels)
+        if self.extra is not None or other.extra is not None:
+            self.extra=(list(self.extra or [""]*n)+
+                        list(other.extra or [""]*nOther))
+        for (row,comment) in other.comments.items():
+            self.comments[row+n]=comment
+        for (row,comments) in other.pre_comments.items():
+            self.pre_comments[row+n]=comments
+        self.finish()
+    def finish(self):
+        "converts the rows added to numpy arrays (if numpy is available)"
+        if numpy is None:
+            return
+        if isinstance(self.coords,array.array):
+            self.coords=numpy.frombuffer(self.coords,
+                                         dtype=numpy.float64).reshape(-1,3).copy()
+        if isinstance(self.labels,list):
+            self.labels=numpy.array(self.labels)
+        if isinstance(self.extra,list):
+            self.extra=numpy.array(self.extra)
+    def write(self,outF,indentLevel=0):
+        """writes the rows, all the values of a block of rows are formatted
+        with a single string formatting"""
+        n=self.n_rows()
+        coords=self.coords
+        if numpy is not None:
+            coords=numpy.asarray(coords,dtype=numpy.float64).ravel()
+        coords=coords.tolist()
+        rowFmt="  "*indentLevel
+        columns=[]
+        if self.labels is not None:
+            rowFmt+="%s "
+            columns.append(list(self.labels))
+        rowFmt+="%r %r %r"
+        columns+=[coords[0::3],coords[1::3],coords[2::3]]
+        if self.extra is not None:
+            rowFmt+="%s"
+            columns.append([e and " "+e for e in self.extra])
+        nCols=len(columns)
+        items=[None]*(n*nCols)
+        for i in xrange(nCols):
+            items[i::nCols]=columns[i]
+        indentC="  "*(indentLevel-1)+"#"
+        breaks=self.comments.keys()+[row for row in self.pre_comments.keys()
+                                     if not self.comments.has_key(row)]
+        breaks.sort()
+        start=0
+        for row in breaks+[n]:
+            for chunk in xrange(start,row,4096):
+                nRows=min(4096,row-chunk)
+                outF.write(((rowFmt+"\n")*nRows)%
+                           tuple(items[chunk*nCols:(chunk+nRows)*nCols]))
+            if row<n:
+                for comment in self.pre_comments.get(row,[]):
+                    outF.write(indentC+comment+"\n")
+                outF.write(rowFmt%tuple(items[row*nCols:(row+1)*nCols]))
+                if self.comments.get(row):
+                    outF.write(" #"+self.comments[row])
+                outF.write("\n")
+            start=row+1
+
 class Section:
     def __init__(self,name,args=None,subsections=None,raw_lines=None,
-                 keywords_list=None,pre_comments=None,post_comments=None):
+                 keywords_list=None,pre_comments=None,post_comments=None,
+                 data=None):
         self.name=name
         if args:
             self.args=args
@@ -109,22 +396,76 @@ class Section:
             self.post_comments=post_comments
         else:
             self.post_comments=[]
+        self.data=data
+        self.is_data=(data is not None or
+                      (name is not None and name.lower() in data_sections))
+        # number of keywords and sections added with add_keyword and
+        # add_subsection to the tree of the section (shared by all its
+        # sections), the path index of InputFile is rebuilt when it changes
+        self.tree_changes=[0]
+        for subSs in self.subsections.values():
+            for subS in subSs:
+                subS.set_tree_changes(self.tree_changes)
+        self.data_start=0
     def add_input_line(self,line,comment,lines):
         self.raw_lines.append(lines)
         if line:
             l=line.split()
+            if self.is_data and self.add_data_row(l,comment):
+                return
             kw=Keyword(name=l[0],values=l[1:],comment=comment,
                        pre_comments=self.post_comments)
             self.post_comments=[]
             self.add_keyword(kw)
         elif comment:
             self.post_comments.append(comment)
+    def add_data_row(self,values,comment):
+        """adds values as row of self.data (creating it), returns 0 if it is
+        not a row. A line that is not a row after the rows turns them back
+        into keywords, tables have their keywords first"""
+        if self.data is None:
+            if values[0][0] in "@$":
+                return 0
+            data=DataTable(not is_float(values[0]))
+            if not data.add_row(values,comment,self.post_comments):
+                return 0
+            self.data=data
+            self.data_start=len(self.raw_lines)-1
+        elif not self.data.add_row(values,comment,self.post_comments):
+            self.data_to_keywords()
+            return 0
+        self.post_comments=[]
+        return 1
+    def data_to_keywords(self):
+        "rereads the lines of the rows of self.data as keywords"
+        lines=self.raw_lines[self.data_start:-1]
+        del self.raw_lines[self.data_start:-1]
+        last=self.raw_lines.pop()
+        self.post_comments=self.data.pre_comments.get(0,[])
+        self.data=None
+        self.is_data=0
+        f=Parser(StringIO.StringIO("".join(lines)),[])
+        while 1:
+            (coreLine,comments,lines)=f.readInputLine()
+            if not lines: break
+            self.add_input_line(coreLine,comments,lines)
+        self.raw_lines.append(last)
+    def set_tree_changes(self,tree_changes):
+        "makes the section and its subsections part of the tree of tree_changes"
+        self.tree_changes=tree_changes
+        for subSs in self.subsections.values():
+            for subS in subSs:
+                subS.set_tree_changes(tree_changes)
     def add_keyword(self,kw):
+        self.tree_changes[0]+=1
         self.keywords_list.append(kw)
         if (not self.keywords.has_key(kw.name.lower())):
             self.keywords[kw.name.lower()]=[]
         self.keywords[kw.name.lower()].append(kw)
     def add_subsection(self,subS):
+        self.tree_changes[0]+=1
+        if subS.tree_changes is not self.tree_changes:
+            subS.set_tree_changes(self.tree_changes)
         if not self.subsections.has_key(subS.name.lower()):
             self.subsections[subS.name.lower()]=[]
         self.subsections[subS.name.lower()].append(subS)
@@ -146,6 +487,8 @@ class Section:
         else:
             for kw in self.keywords_list:
                 kw.write(outF,indentLevel+1)
+            if self.data is not None:
+                self.data.write(outF,indentLevel+1)
         sNames=self.subsections.keys()
         sNames.sort()
         for sName in sNames:
@@ -190,7 +533,137 @@ class Section:
                 for subS in subSs:
                     subS.rebuild_keyword_list(self,recursive=recursive)
         
-def read_section(f):
+class LazySection(Section):
+    """a section that is built from its text at the first access to
+    anything but name, args and pre_comments (or at the first assignment
+    to anything but pre_comments), it then becomes a Section.
+    Until then write copies its text verbatim.
+    source is (f,buf,node,lineN): the file, its text, the node of the
+    section in the tree of scan_sections and the number of lines before it.
+    buf must stay readable (the Parser open) while the section is lazy"""
+    def __init__(self,name,args,pre_comments,source):
+        self.__dict__.update(name=name,args=args,pre_comments=pre_comments,
+                             source=source,tree_changes=[0])
+    def __getattr__(self,attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        self.materialize()
+        return getattr(self,attr)
+    def __setattr__(self,attr,value):
+        if attr not in ("pre_comments","tree_changes"):
+            self.materialize()
+        self.__dict__[attr]=value
+    def set_tree_changes(self,tree_changes):
+        self.__dict__["tree_changes"]=tree_changes
+    def materialize(self):
+        "reads the section turning it into a Section, its subsections stay lazy"
+        tree_changes=self.tree_changes
+        changes=tree_changes[0]
+        try:
+            self.read_source()
+        finally:
+            tree_changes[0]=changes
+    def read_source(self):
+        (fileObj,buf,node,lineN)=self.__dict__.pop("source")
+        tree_changes=self.tree_changes
+        self.__class__=Section
+        Section.__init__(self,self.name,self.args,pre_comments=self.pre_comments)
+        self.tree_changes=tree_changes
+        (start,bodyEnd,end,children)=node
+        f=Parser(fileObj,lineN=lineN)
+        f.buf=buf
+        f.bufPos=start
+        f.bufEnd=bodyEnd
+        f.readInputLine()
+        iChild=0
+        while 1:
+            (coreLine,comments,lines)=f.readInputLine()
+            if not lines: break
+            if coreLine and coreLine[0]=='&':
+                child=children[iChild]
+                iChild+=1
+                l=coreLine.split()
+                childLineN=f.lineN-lines.count("\n")-(not lines.endswith("\n"))
+                self.add_subsection(LazySection(l[0][1:],l[1:],[],
+                                                (fileObj,buf,child,childLineN)))
+                f.seek(child[2])
+            else:
+                self.add_input_line(coreLine,comments,lines)
+        if self.data is not None:
+            self.data.finish()
+    def write(self,outF,indentLevel=0):
+        indentC="  "*(indentLevel-1)+"#"
+        for comment in self.pre_comments:
+            outF.write(indentC)
+            outF.write(comment)
+            outF.write("\n")
+        (fileObj,buf,(start,bodyEnd,end,children),lineN)=self.source
+        for pos in xrange(start,end,1<<20):
+            outF.write(buf[pos:min(pos+(1<<20),end)])
+        if buf[end-1]!="\n":
+            outF.write("\n")
+
+# a line starting a section, with the name and the arguments
+sectionLineRe=re.compile(r"[^\S\n]*&([^\s#]*)([^#\n]*)")
+
+def scan_sections(f):
+    """finds the sections of the input of the Parser f without reading its
+    lines and returns the top level ones. The section nodes are lists
+    [start,bodyEnd,end,subsections] with the offsets in f.buf of the start
+    of the section, of its &END line and of the end of the &END line.
+    Raises the SyntaxErrors of read_section for the section structure"""
+    if f.buf is None:
+        f.load()
+    buf=f.buf
+    sections=[]
+    stack=[]
+    amp=buf.find("&",f.tell())
+    while amp>=0:
+        start=buf.rfind("\n",0,amp)+1
+        end=buf.find("\n",amp)+1
+        if not end:
+            end=len(buf)
+        amp=buf.find("&",end)
+        m=sectionLineRe.match(buf,start)
+        if not m:
+            continue
+        if start:
+            # the line is part of a line that ends with a backslash
+            prevLine=buf[buf.rfind("\n",0,start-1)+1:start-1]
+            if prevLine.split("#",1)[0].strip()[-1:]=="\\":
+                continue
+        name=m.group(1)
+        if name.lower()!="end":
+            node=[start,None,None,[]]
+            if stack:
+                stack[-1][1][3].append(node)
+            else:
+                sections.append(node)
+            stack.append((name,node))
+            continue
+        lineN=f.lineN+count_lines(buf,f.tell(),start)+1
+        if not stack:
+            raise SyntaxError("found dangling &END in %s at line %i: %s"%
+                              (repr(f.f.name),lineN-1,repr(buf[start:end])))
+        args=m.group(2).split()
+        if args and args[-1].lower()!=stack[-1][0].lower():
+            raise SyntaxError("end section mismatch %s vs %s at line %i"%
+                              (stack[-1][0],args[-1],lineN))
+        node=stack.pop()[1]
+        node[1]=start
+        node[2]=end
+    if stack:
+        lineN=f.lineN+count_lines(buf,f.tell())
+        if buf and buf[-1]!="\n":
+            lineN+=1
+        raise SyntaxError("unterminated section %s in %s at line %i: ''"%
+                          (stack[-1][0],repr(f.f.name),lineN-1))
+    return sections
+
+def read_section(f,sections=None):
+    """reads the next top level section from the Parser f.
+    If sections is given (the nodes of scan_sections still to read) the
+    section is returned as LazySection and its text skipped"""
     while 1:
         (coreLine,comments,lines)=f.readInputLine()
         if not lines or not lines.isspace(): break
@@ -209,28 +682,181 @@ def read_section(f):
     l=coreLine.split()
     sect_name=l[0][1:]
     sect_args=l[1:]
-    if sect_name.lower()=="end": raise SyntaxError("found dangling &END in %s"%f.old_pos(line))
+    if sect_name.lower()=="end": raise SyntaxError("found dangling &END in %s"%f.old_pos(lines))
+    if sections is not None:
+        lineN=f.lineN-lines.count("\n")-(not lines.endswith("\n"))
+        node=sections.pop(0)
+        f.seek(node[2])
+        return LazySection(sect_name,sect_args,preSectionComments,
+                           (f.f,f.buf,node,lineN))
     sect=Section(sect_name,sect_args,pre_comments=preSectionComments)
+    read_section_body(f,sect)
+    return sect
+
+def read_section_body(f,sect):
+    "reads the lines of sect (after its first line) up to its &END"
     while 1:
         (coreLine,comments,lines)=f.readInputLine()
         if not lines:
             raise SyntaxError("unterminated section %s in %s"%
-                              (sect_name,f.old_pos(line)))
+                              (sect.name,f.old_pos(lines)))
         if coreLine and coreLine[0]=='&':
             l=coreLine.split()
             if l[0][1:].lower()=="end":
-                if len(l)>1 and l[-1].lower()!=sect_name.lower():
+                if len(l)>1 and l[-1].lower()!=sect.name.lower():
                     raise SyntaxError("end section mismatch %s vs %s at line %i"%
-                                      (sect_name,l[-1],f.lineN))
-                else:
-                    return sect
-            else:
-                f.pushback(lines)
-                sect.add_subsection(read_section(f))
+                                      (sect.name,l[-1],f.lineN))
+                if sect.data is not None:
+                    sect.data.finish()
+                return
+            subS=Section(l[0][1:],l[1:])
+            subS.tree_changes=sect.tree_changes
+            read_section_body(f,subS)
+            sect.add_subsection(subS)
         else:
             sect.add_input_line(coreLine,comments,lines)
 
+# kinds of the events of iter_events
+SECTION_START="section_start"
+SECTION_END="section_end"
+KEYWORD="keyword"
+COMMENT="comment"
+BLANK="blank"
+
+def iter_events(f):
+    """generator of the events of the input read from the Parser f, without
+    building the section tree (so in constant memory).
+    Every event is a tuple (kind,name,values,comment,lines):
+      SECTION_START: name and args (values) of the section
+      SECTION_END: name of the section closed, values the words after &END
+      KEYWORD: name and values of the keyword (also for lines outside any
+        section, that read_section ignores)
+      COMMENT: a line with only a comment (name is None, values empty)
+      BLANK: an empty line (name and comment are None, values empty)
+    comment is the comment of the line (or None) and lines the original
+    text, so writing the lines of all the events gives back the input"""
+    stack=[]
+    while 1:
+        (coreLine,comments,lines)=f.readInputLine()
+        if not lines: break
+        if not comments: comments=None
+        if coreLine and coreLine[0]=='&':
+            l=coreLine.split()
+            name=l[0][1:]
+            if name.lower()=="end":
+                if not stack:
+                    raise SyntaxError("found dangling &END in %s"%
+                                      f.old_pos(lines))
+                if len(l)>1 and l[-1].lower()!=stack[-1].lower():
+                    raise SyntaxError("end section mismatch %s vs %s at line %i"%
+                                      (stack[-1],l[-1],f.lineN))
+                yield (SECTION_END,stack.pop(),l[1:],comments,lines)
+            else:
+                stack.append(name)
+                yield (SECTION_START,name,l[1:],comments,lines)
+        elif coreLine:
+            l=coreLine.split()
+            yield (KEYWORD,l[0],l[1:],comments,lines)
+        elif comments:
+            yield (COMMENT,None,[],comments,lines)
+        else:
+            yield (BLANK,None,[],None,lines)
+    if stack:
+        raise SyntaxError("unterminated section %s in %s"%
+                          (stack[-1],f.file_pos()))
+
+class InputHandler:
+    """receives the events of parse_events (see iter_events), the methods
+    of this class do nothing"""
+    def start_section(self,name,args,comment,lines):
+        pass
+    def end_section(self,name,comment,lines):
+        pass
+    def keyword(self,name,values,comment,lines):
+        pass
+    def comment(self,comment,lines):
+        pass
+    def blank(self,lines):
+        pass
+
+def parse_events(f,handler):
+    """calls the methods of handler (an InputHandler) for the events of the
+    input read from the Parser f"""
+    for (kind,name,values,comment,lines) in iter_events(f):
+        if kind==KEYWORD:
+            handler.keyword(name,values,comment,lines)
+        elif kind==SECTION_START:
+            handler.start_section(name,values,comment,lines)
+        elif kind==SECTION_END:
+            handler.end_section(name,comment,lines)
+        elif kind==COMMENT:
+            handler.comment(comment,lines)
+        else:
+            handler.blank(lines)
+
+def rewrite_keywords(f,outF,replacements):
+    """copies the input read from the Parser f to outF, replacing the values
+    of the keywords in replacements, a dictionary from the keyword path
+    (like "FORCE_EVAL%SUBSYS%CELL%ABC", case insensitive) to the list of the
+    new values. The input is streamed, everything else is copied verbatim.
+    Returns the number of keywords replaced"""
+    newValues={}
+    for (path,values) in replacements.items():
+        newValues[path.upper()]=values
+    stack=[]
+    nReplaced=0
+    for (kind,name,values,comment,lines) in iter_events(f):
+        if kind==SECTION_START:
+            stack.append(name.upper())
+        elif kind==SECTION_END:
+            stack.pop()
+        elif kind==KEYWORD:
+            path="%".join(stack+[name.upper()])
+            if newValues.has_key(path):
+                indent=lines[:len(lines)-len(lines.lstrip(" \t"))]
+                line=indent+" ".join([name]+list(newValues[path]))
+                if comment:
+                    line+=" #"+comment
+                outF.write(line+"\n")
+                nReplaced+=1
+                continue
+        outF.write(lines)
+    return nReplaced
+
+pathSegmentRe=re.compile(r"\s*([^%\[\]\s]+)\s*(?:\[\s*([0-9]+)\s*\]\s*)?\Z")
+path_keys={}
+
+def path_key(path):
+    """returns the key of a path like "FORCE_EVAL%SUBSYS%KIND[1]%ELEMENT": a
+    tuple of (lowercase name,index) pairs. The index selects among the
+    sections (or keywords) with the same name, it counts from 0 and is 0 if
+    omitted"""
+    key=path_keys.get(path)
+    if key is None:
+        key=[]
+        for segment in path.split("%"):
+            m=pathSegmentRe.match(segment)
+            if not m:
+                raise ValueError("invalid input path "+repr(path))
+            key.append((m.group(1).lower(),int(m.group(2) or 0)))
+        key=tuple(key)
+        if len(path_keys)>=10000:
+            path_keys.clear()
+        path_keys[path]=key
+    return key
+
+def path_string(key):
+    "returns the path of a key of path_key"
+    return "%".join([name.upper()+(i and "[%i]"%i or "") for (name,i) in key])
+
 class InputFile:
+    """a parsed input.
+    Its sections and keywords can be accessed by path (see path_key) with
+    get, set, delete and find_all, using an index of the paths that is
+    rebuilt after add_keyword/add_subsection in its tree (see
+    Section.tree_changes) and extended into the LazySections when they are
+    read. Keywords and sections added, or sections removed, directly in the
+    keywords or subsections dictionaries need a reindex"""
     def __init__(self,filename,pre_comments=None,post_comments=None,subsections=None):
         self.filename=filename
         if pre_comments:
@@ -245,7 +871,18 @@ class InputFile:
             self.subsections=subsections
         else:
             self.subsections={}
-    def parse_file(self,f):
+        self.tree_changes=[0]
+        for subSs in self.subsections.values():
+            for subS in subSs:
+                subS.set_tree_changes(self.tree_changes)
+        self.path_index=None
+        self.names_index=None
+        self.indexed_changes=None
+    def parse_file(self,f,lazy=0):
+        """reads the input from the Parser f. If lazy is true the sections
+        are LazySections, only the structure of the input is checked and
+        f must not be closed while some of them are lazy"""
+        sections=None
         while 1:
             (coreLine,comments,lines)=f.readInputLine()
             if not lines: break
@@ -253,17 +890,255 @@ class InputFile:
                 f.pushback(lines)
                 break
             self.pre_comments.append(comments)
+        if lazy:
+            sections=scan_sections(f)
         while 1:
-            sect=read_section(f)
+            sect=read_section(f,sections)
             if not sect: break
             if sect.name==None:
                 self.post_comments+=sect.pre_comments
                 break
             self.add_subsection(sect)
     def add_subsection(self,sect):
+        self.tree_changes[0]+=1
+        if sect.tree_changes is not self.tree_changes:
+            sect.set_tree_changes(self.tree_changes)
         if not self.subsections.has_key(sect.name.lower()):
             self.subsections[sect.name.lower()]=[]
         self.subsections[sect.name.lower()].append(sect)
+    def reindex(self):
+        """rebuilds the path index (without reading the LazySections)"""
+        self.path_index={}
+        self.names_index={}
+        self.index_section(self,())
+        self.indexed_changes=self.tree_changes[0]
+    def index_section(self,sect,key):
+        """adds the contents of sect (at key) to the index, a keyword hides
+        the section with the same path"""
+        for (name,subSs) in sect.subsections.items():
+            for i in xrange(len(subSs)):
+                self.index_entry(key+((name,i),),subSs[i],sect)
+                if not isinstance(subSs[i],LazySection):
+                    self.index_section(subSs[i],key+((name,i),))
+        if sect is not self:
+            for (name,kws) in sect.keywords.items():
+                for i in xrange(len(kws)):
+                    self.index_entry(key+((name,i),),kws[i],sect)
+    def index_entry(self,key,obj,parent):
+        """adds obj (in parent) at key to the index, the entries are
+        (obj,parent,objs,name,i) with objs the dictionary of parent where
+        obj is at [name][i]"""
+        (name,i)=key[-1]
+        if isinstance(obj,Keyword):
+            entry=(obj,parent,parent.keywords,name,i)
+        else:
+            entry=(obj,parent,parent.subsections,name,i)
+        self.path_index[key]=entry
+        self.names_index.setdefault(name,[]).append((key,entry))
+    def unindex(self,key,obj):
+        """removes obj (at key) and its contents from the index, the path
+        index entry of key is removed only if it is the one of obj"""
+        (name,i)=key[-1]
+        entry=self.path_index.get(key)
+        if entry is not None and entry[0] is obj:
+            del self.path_index[key]
+        entries=self.names_index.get(name,[])
+        for j in xrange(len(entries)):
+            if entries[j][0]==key and entries[j][1][0] is obj:
+                del entries[j]
+                break
+        if isinstance(obj,Keyword) or isinstance(obj,LazySection):
+            return
+        for (name,subSs) in obj.subsections.items():
+            for j in xrange(len(subSs)):
+                self.unindex(key+((name,j),),subSs[j])
+        for (name,kws) in obj.keywords.items():
+            for j in xrange(len(kws)):
+                self.unindex(key+((name,j),),kws[j])
+    def index_slot(self,key,parent):
+        """sets the path index entry of key (in parent) to the keyword at
+        key, or else to the section"""
+        (name,i)=key[-1]
+        kws=[]
+        if parent is not self:
+            kws=parent.keywords.get(name,[])
+        subSs=parent.subsections.get(name,[])
+        if i<len(kws):
+            self.path_index[key]=(kws[i],parent,parent.keywords,name,i)
+        elif i<len(subSs):
+            self.path_index[key]=(subSs[i],parent,parent.subsections,name,i)
+        elif self.path_index.has_key(key):
+            del self.path_index[key]
+    def in_place(self,entry):
+        "returns true if the object of the index entry is still in place"
+        objs=entry[2].get(entry[3])
+        return objs is not None and entry[4]<len(objs) and objs[entry[4]] is entry[0]
+    def resolve(self,key):
+        """returns (object,parent) of the keyword (or else the section) at
+        key, or None, reading and indexing the LazySections on the way"""
+        if self.indexed_changes!=self.tree_changes[0]:
+            self.reindex()
+        entry=self.path_index.get(key)
+        if entry is not None:
+            if not self.in_place(entry):
+                self.reindex()
+                entry=self.path_index.get(key)
+            if entry is not None:
+                return entry[:2]
+        parent=self
+        for depth in xrange(len(key)):
+            (name,i)=key[depth]
+            if depth==len(key)-1 and parent is not self:
+                kws=parent.keywords.get(name)
+                if kws and i<len(kws):
+                    return (kws[i],parent)
+            subSs=parent.subsections.get(name)
+            if not subSs or i>=len(subSs):
+                return None
+            sect=subSs[i]
+            if depth==len(key)-1:
+                return (sect,parent)
+            if isinstance(sect,LazySection):
+                sect.materialize()
+                self.index_section(sect,key[:depth+1])
+            parent=sect
+    def get(self,path):
+        """returns the keyword at path, or the section if there is no such
+        keyword, or None"""
+        if self.indexed_changes==self.tree_changes[0]:
+            key=path_keys.get(path)
+            if key is not None:
+                entry=self.path_index.get(key)
+                if entry is not None:
+                    objs=entry[2].get(entry[3])
+                    if objs and entry[4]<len(objs) and objs[entry[4]] is entry[0]:
+                        return entry[0]
+        entry=self.resolve(path_key(path))
+        if entry is None:
+            return None
+        return entry[0]
+    def set(self,path,values):
+        """sets the values of the keyword at path (or the arguments of the
+        section) and returns it. If missing the keyword is added (a section
+        at the first level, or if its parent has sections but no keywords
+        with that name), with the sections of the path that are missing, a
+        new section or keyword must have the index following the existing
+        ones. The raw lines of the section of the keyword are removed"""
+        key=path_key(path)
+        entry=self.resolve(key)
+        if entry is not None:
+            (obj,parent)=entry
+            if isinstance(obj,Keyword):
+                obj.values=list(values)
+                parent.remove_raw_lines(0)
+            else:
+                obj.args=list(values)
+            return obj
+        indexed=self.indexed_changes==self.tree_changes[0]
+        parent=self
+        depth=0
+        while depth<len(key)-1:
+            (name,i)=key[depth]
+            subSs=parent.subsections.get(name)
+            if not subSs or i>=len(subSs):
+                break
+            parent=subSs[i]
+            depth+=1
+        names=[segment.split("[")[0].strip() for segment in path.split("%")]
+        for depth in xrange(depth,len(key)):
+            (name,i)=key[depth]
+            addKeyword=(depth==len(key)-1 and parent is not self and
+                        (parent.keywords.has_key(name) or
+                         not parent.subsections.has_key(name)))
+            if addKeyword:
+                nOld=len(parent.keywords.get(name,[]))
+            else:
+                nOld=len(parent.subsections.get(name,[]))
+            if i!=nOld:
+                raise IndexError("cannot add %s, its index should be %i"%
+                                 (path_string(key[:depth+1]),nOld))
+            if addKeyword:
+                obj=Keyword(names[depth],list(values))
+                parent.add_keyword(obj)
+                parent.remove_raw_lines(0)
+            else:
+                obj=Section(names[depth])
+                if depth==len(key)-1:
+                    obj.args=list(values)
+                parent.add_subsection(obj)
+            if indexed:
+                self.index_entry(key[:depth+1],obj,parent)
+            parent=obj
+        if indexed:
+            self.indexed_changes=self.tree_changes[0]
+        return obj
+    def delete(self,path):
+        """removes the keyword (or else the section) at path and returns it
+        (None if there is none). The index entries of the keywords or
+        sections that follow it are updated with their new paths"""
+        key=path_key(path)
+        entry=self.resolve(key)
+        if entry is None:
+            return None
+        (obj,parent)=entry
+        (name,i)=key[-1]
+        if isinstance(obj,Keyword):
+            objs=parent.keywords[name]
+        else:
+            objs=parent.subsections[name]
+        nSlots=len(objs)
+        if parent is not self:
+            nSlots=max(len(parent.keywords.get(name,[])),
+                       len(parent.subsections.get(name,[])))
+        indexed=self.indexed_changes==self.tree_changes[0]
+        if indexed:
+            for j in xrange(i,len(objs)):
+                self.unindex(key[:-1]+((name,j),),objs[j])
+        del objs[i]
+        if isinstance(obj,Keyword):
+            if not objs:
+                del parent.keywords[name]
+            parent.keywords_list.remove(obj)
+            parent.remove_raw_lines(0)
+        elif not objs:
+            del parent.subsections[name]
+        if indexed:
+            for j in xrange(i,len(objs)):
+                self.index_entry(key[:-1]+((name,j),),objs[j],parent)
+                if not isinstance(objs[j],(Keyword,LazySection)):
+                    self.index_section(objs[j],key[:-1]+((name,j),))
+            for j in xrange(i,nSlots):
+                self.index_slot(key[:-1]+((name,j),),parent)
+        return obj
+    def find_all(self,name):
+        """returns the (path,object) of all the sections and keywords called
+        name sorted by path (reading all the LazySections)"""
+        if (self.materialize_all() or
+            self.indexed_changes!=self.tree_changes[0]):
+            self.reindex()
+        entries=self.names_index.get(name.lower(),[])
+        for (key,entry) in entries:
+            if not self.in_place(entry):
+                self.reindex()
+                entries=self.names_index.get(name.lower(),[])
+                break
+        entries=[(key,entry[0]) for (key,entry) in entries]
+        entries.sort(key=lambda entry:entry[0])
+        return [(path_string(key),obj) for (key,obj) in entries]
+    def materialize_all(self):
+        "reads all the LazySections, returns their number"
+        n=0
+        sects=[]
+        for subSs in self.subsections.values():
+            sects+=subSs
+        while sects:
+            sect=sects.pop()
+            if isinstance(sect,LazySection):
+                sect.materialize()
+                n+=1
+            for subSs in sect.subsections.values():
+                sects+=subSs
+        return n
     def write(self,outF):
         for comment in self.pre_comments:
             outF.write("#")
@@ -285,14 +1160,26 @@ class InputFile:
                 s.remove_raw_lines(1)
         
 if __name__=="__main__":
-    if len(sys.argv)>3 or len(sys.argv)<2:
-        print os.path.basename(sys.argv[0])+" input_file [output_file]"
+    replacements={}
+    args=[]
+    for arg in sys.argv[1:]:
+        if arg.startswith("--set=") and "=" in arg[6:]:
+            (path,values)=arg[6:].split("=",1)
+            replacements[path]=values.split()
+        else:
+            args.append(arg)
+    if len(args)>2 or len(args)<1:
+        print os.path.basename(sys.argv[0])+" [--set=SECTION%...%KEYWORD=values ...] input_file [output_file]"
         sys.exit(1)
-    inF=file(sys.argv[1])
+    inF=file(args[0])
     parser=Parser(inF)
     outF=sys.stdout
-    if len(sys.argv)==3:
-        outF=file(sys.argv[2])
+    if len(args)==2:
+        outF=file(args[1],'w')
+    if replacements:
+        nReplaced=rewrite_keywords(parser,outF,replacements)
+        sys.stderr.write("*** replaced %d keywords ***\n"%nReplaced)
+        sys.exit(0)
     parsedFile=InputFile(inF.name)
     parsedFile.parse_file(parser)
     print "*** parsing complete ***"
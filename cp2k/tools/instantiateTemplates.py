@@ -1,82 +1,186 @@
 #! /usr/bin/env python
 
-import sys, re
+import sys, re, os, os.path
 from sys import argv
 import prettify
 import normalizeFortranFile
 import replacer
 import addSynopsis
+import fortranLexer
+import toolsProfile
 
-def instantiateTemplate(infile,outfile,subs,logFile=sys.stdout):
-  import re
-  # this ignores a unbalanced '[' or ']' and ignores a comment
-  # like [ ! ], but well,...
-  directive=re.compile("(\[[ \t]*([^\]]*)[ \t]*\])|(^[ \t]*![ \t]*\[[ \t]*template[ \t]*\(([^\)]*)\)\][ \t]*$)|(!)")
-  logFile.write("instantiating '"+infile.name+"' to '"+outfile.name+"'\n")
-  lineNr=0
-  while 1:
-    line=infile.readline()
-    lineNr=lineNr+1
-    if not line: break
-    inComment=0
-    try:
+# this ignores a unbalanced '[' or ']' and ignores a comment
+# like [ ! ], but well,...
+directiveRe=re.compile("(\[[ \t]*([^\]]*)[ \t]*\])|(^[ \t]*![ \t]*\[[ \t]*template[ \t]*\(([^\)]*)\)\][ \t]*$)")
+
+# kinds of the segments of a Template that are not literal text
+(TOKEN,HEADER,LOG)=range(3)
+
+class Template:
+  """A template parsed once in a list of segments, that can be written
+  with many substitutions.
+  A segment is either a string (literal text) or a tuple:
+    (TOKEN,lineNr,prefix,name,raw,inComment) a [name] placeholder (raw is
+      prefix and the placeholder, written if name is not substituted)
+    (HEADER,lineNr,line,args) the ! [template(args)] description
+    (LOG,message) a warning that does not depend on the substitution"""
+  def __init__(self,text,name):
+    self.name=name
+    self.segments=[]
+    lines=text.split("\n")
+    for i in xrange(len(lines)-1):
+      lines[i]+="\n"
+    if not lines[-1]: del lines[-1]
+    self.lines=len(lines)
+    literal=[]
+    lineNr=0
+    for line in lines:
+      lineNr=lineNr+1
+      commentStart=fortranLexer.commentStart(line)
+      pos=0
       while 1:
-	match=directive.search(line)
-	if not match:
-	  outfile.write(line)
-	  break
-	if match.groups()[4]: # it is a comment
-	  outfile.write(line[:match.end()])
-	  line=line[match.end():]
-	  inComment=1
-	elif match.groups()[2]: # the template description
-	  outfile.write(line)
-	  outfile.write("! ARGS:\n")
-	  for arg in match.groups()[3].split(","):
-	    arg=arg.strip()
-	    if not subs.has_key(arg):
-	      logFile.write("ERROR: missing required argument:"+arg+"\n")
-	      outfile.write("! ERROR argument '"+arg+"' missing\n") 
+        match=directiveRe.search(line)
+        if not match:
+          literal.append(line)
+          break
+        inComment=(commentStart is not None and pos+match.start()>=commentStart)
+        if match.groups()[2]: # the template description
+          self.addSegment(literal,(HEADER,lineNr,line,
+                                   [arg.strip() for arg in
+                                    match.groups()[3].split(",")]))
+          break
+        elif not match.groups()[1]:
+          if not inComment:
+            self.addSegment(literal,(LOG,"WARNING, ingnoring empty group at line %d\n"%lineNr))
+          literal.append(line[:match.end()])
+        else:
+          self.addSegment(literal,(TOKEN,lineNr,line[:match.start()],
+                                   match.groups()[1],line[:match.end()],
+                                   inComment))
+        pos+=match.end()
+        line=line[match.end():]
+    if literal:
+      self.segments.append("".join(literal))
+
+  def addSegment(self,literal,segment):
+    """appends the pending literal text and segment to the segments"""
+    if literal:
+      self.segments.append("".join(literal))
+      del literal[:]
+    self.segments.append(segment)
+
+  def write(self,outfile,subs,logFile=sys.stdout):
+    """writes the template with the substitutions subs (a dictionary) to
+    outfile, in a single write"""
+    out=[]
+    lineNr=0
+    try:
+      for segment in self.segments:
+        if type(segment)==type(""):
+          out.append(segment)
+          continue
+        kind=segment[0]
+        if kind==TOKEN:
+          (kind,lineNr,prefix,name,raw,inComment)=segment
+          if subs.has_key(name):
+            out.append(prefix+subs[name])
+          else:
+            if not inComment:
+              logFile.write("WARNING ignoring unknown token '%s' at line %d\n"%
+                            (name,lineNr))
+            out.append(raw)
+        elif kind==HEADER:
+          (kind,lineNr,line,args)=segment
+          out.append(line)
+          out.append("! ARGS:\n")
+          for arg in args:
+            if not subs.has_key(arg):
+              logFile.write("ERROR: missing required argument:"+arg+"\n")
+              out.append("! ERROR argument '"+arg+"' missing\n")
           kList=subs.keys()
           kList.sort()
           for arg in kList:
             sost=subs[arg].split("\n")
             if (len(sost)>1):
-              outfile.write('!  '+arg+' = \n')
-              outfile.write('!    "'+sost[0])
+              out.append('!  '+arg+' = \n')
+              out.append('!    "'+sost[0])
               for sostLine in sost[1:]:
-                outfile.write('\n!     '+sostLine)
-              outfile.write('"\n')
+                out.append('\n!     '+sostLine)
+              out.append('"\n')
             else:
-              outfile.write('!  '+arg+' = "'+sost[0]+'"\n')
-          outfile.write("\n")
-	  break
-	elif not match.groups()[1]:
-	  if not inComment:
-	    logFile.write("WARNING, ingnoring empty group at line %d\n"%lineNr)
-	  outfile.write(line[:match.end()])
-	  line=line[match.end():]
-	else:
-	  if subs.has_key(match.groups()[1]):
-	    outfile.write(line[:match.start()]+subs[match.groups()[1]])
-	    line=line[match.end():]
-	  else:
-	    if not inComment:
-	      logFile.write("WARNING ignoring unknown token '%s' at line %d\n"%
-                            (match.groups()[1],lineNr))
-	    outfile.write(line[:match.end()])
-	    line=line[match.end():]
+              out.append('!  '+arg+' = "'+sost[0]+'"\n')
+          out.append("\n")
+        else:
+          logFile.write(segment[1])
     except:
-      logFile.write("error in '%s' at line %d\n"%(infile.name,lineNr))
-      outfile.close()
-      infile.close()
-      os.rename(outfile.name,outfile.name+".err")
+      logFile.write("error in '%s' at line %d\n"%(self.name,lineNr))
+      outfile.write("".join(out))
       raise
+    outfile.write("".join(out))
+
+_templates={}
+def compiledTemplate(text,name):
+  """returns the Template of text (the content of the file name), parsing
+  it only once"""
+  template=_templates.get((name,text))
+  if template is None:
+    if len(_templates)>=50:
+      _templates.clear()
+    template=Template(text,name)
+    _templates[(name,text)]=template
+  return template
+
+def instantiateTemplate(infile,outfile,subs,logFile=sys.stdout):
+  """writes the template infile with the substitutions subs to outfile.
+  The template is parsed only the first time (see Template).
+  Returns the number of lines of the template"""
+  logFile.write("instantiating '"+infile.name+"' to '"+outfile.name+"'\n")
+  try:
+    template=compiledTemplate(infile.read(),infile.name)
+    template.write(outfile,subs,logFile)
+  except:
+    outfile.close()
+    infile.close()
+    os.rename(outfile.name,outfile.name+".err")
+    raise
   outfile.close()
   infile.close()
+  return template.lines
+
+def instanceName(instantiationFile,substitution,outDir=None):
+  """Returns the name of the file generated by instantiationFile with
+  substitution (in outDir if given)"""
+  extension=".instantiation"
+  outName=instantiationFile[:-len(extension)]
+  id_ext=0
+  for token in substitution.keys():
+    if token=="ext" :
+      id_ext=1
+    outName=re.sub("(?<![a-zA-Z0-9])_"+token+"_(?![a-zA-Z0-9])",
+                   substitution[token],outName)
+  tmpName=outName+".F"
+  if id_ext==1 :
+    tmpName=outName+substitution["ext"]
+  outName=tmpName
+  if outDir:
+    outName=os.path.join(outDir,os.path.basename(outName))
+  return outName
+
+def generateInstance(infile,outName,substitution,logFile=sys.stdout):
+  """Writes the instance of the template infile (an open file) with
+  substitution to outName, and prettifies it"""
+  try: outfile=open(outName,'w')
+  except:
+    logFile.write("ERROR opening template '"+outName+"'\n")
+    raise
+  started=toolsProfile.start()
+  lines=instantiateTemplate(infile,outfile,substitution,logFile)
+  toolsProfile.stop('instantiate',outName,started,lines=lines,
+                    bytesIn=os.path.getsize(infile.name),
+                    bytesOut=os.path.getsize(outName))
+  prettify.prettfyInplace(outName,logFile=logFile)
 
 def evaluateInstantiationFile(instantiationFile,logFile=sys.stdout,outDir=None):
-    import os
     generatedFiles=[]
     try:
       input = open(instantiationFile,'r')
@@ -93,42 +197,216 @@ def evaluateInstantiationFile(instantiationFile,logFile=sys.stdout,outDir=None):
         except:
           logFile.write("ERROR opening template '"+inName+"'\n")
           raise
-        outName=instantiationFile[:-len(extension)]
-        id_ext=0
-        for token in substitution.keys():
-          if token=="ext" :
-            id_ext=1
-          outName=re.sub("(?<![a-zA-Z0-9])_"+token+"_(?![a-zA-Z0-9])",
-                         substitution[token],outName)
-        tmpName=outName+".F"
-        if id_ext==1 :
-          tmpName=outName+substitution["ext"]
-        outName=tmpName
-        if outDir:
-          outName=os.path.join(outDir,os.path.basename(outName))
-        try: outfile=open(outName,'w')
-        except:
-          logFile.write("ERROR opening template '"+outName+"'\n")
-          raise
-        instantiateTemplate(infile,outfile,substitution,logFile)
-        prettify.prettfyInplace(outName,logFile=logFile)
+        outName=instanceName(instantiationFile,substitution,outDir)
+        generateInstance(infile,outName,substitution,logFile)
         generatedFiles.append(outName)
     except:
-        import sys
         logFile.write("error evaluating substitutions from file '"+
                       instantiationFile+"'\n")
-        import sys, traceback
+        import traceback
         logFile.write('-'*60+"\n")
         traceback.print_exc(file=logFile)
         logFile.write('-'*60+"\n")
     return generatedFiles
 
+_toolsVersion=None
+def toolsVersion():
+  """returns a hash of the sources of the tools used to generate the
+  instances (this module and the ones used by prettify)"""
+  global _toolsVersion
+  if _toolsVersion is None:
+    import hashlib
+    h=hashlib.sha1(prettify.toolsVersion())
+    f=open(os.path.splitext(__file__)[0]+".py",'rb')
+    h.update(f.read())
+    f.close()
+    _toolsVersion=h.hexdigest()
+  return _toolsVersion
+
+def instanceStamp(templateName,outName,substitution):
+  """returns the stamp of the instance outName of templateName: a hash of
+  the template, the substitution, the tools and the cp_common_uses.h used
+  by prettify"""
+  import hashlib
+  h=hashlib.sha1(toolsVersion())
+  h.update(prettify.fileHash(templateName))
+  h.update(repr(sorted(substitution.items())))
+  h.update(prettify.fileHash(os.path.join(
+    os.path.dirname(os.path.abspath(outName)),"cp_common_uses.h")))
+  return h.hexdigest()
+
+def instanceWorker(job):
+  """generates (and prettifies) a template instance, suitable to be mapped
+  over a process pool. job is a tuple (templateName,outName,substitution).
+  Returns a tuple (outName,failed,log)"""
+  from cStringIO import StringIO
+  import traceback
+  (templateName,outName,substitution)=job
+  logFile=StringIO()
+  failed=0
+  # the tools also print directly to stdout, capture it in the log
+  oldStdout=sys.stdout
+  sys.stdout=logFile
+  try:
+    try:
+      infile=open(templateName,"r")
+      generateInstance(infile,outName,substitution,logFile)
+    except:
+      failed=1
+      logFile.write("error generating '"+outName+"'\n")
+      logFile.write('-'*60+"\n")
+      traceback.print_exc(file=logFile)
+      logFile.write('-'*60+"\n")
+  finally:
+    sys.stdout=oldStdout
+  return (outName,failed,logFile.getvalue())
+
+def loadStamps(stampFile):
+  """returns the stamps stored in stampFile: a dictionary from the instance
+  name to (stamp,mtime,size) of the instance when it was generated"""
+  import cPickle
+  if not stampFile or not os.path.exists(stampFile):
+    return {}
+  f=open(stampFile,'rb')
+  try:
+    try:
+      return cPickle.load(f)
+    except Exception:
+      return {}
+  finally:
+    f.close()
+
+def saveStamps(stampFile,stamps):
+  """writes atomically the stamps to stampFile"""
+  import cPickle, tempfile
+  (fd,tmpName)=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(stampFile)))
+  f=os.fdopen(fd,'wb')
+  try:
+    cPickle.dump(stamps,f,cPickle.HIGHEST_PROTOCOL)
+  finally:
+    f.close()
+  os.rename(tmpName,stampFile)
+
+def instantiateFiles(instantiationFiles,logFile=sys.stdout,outDir=None,
+                     jobs=1,stampFile=None):
+  """generates the instances of all the instantiationFiles using jobs
+  processes.
+  If stampFile is given, the instances whose stamp (see instanceStamp)
+  did not change since they were generated, and that were not modified
+  since, are skipped.
+  The logs are written to logFile in order, returns the list of all the
+  instances (also the skipped ones) and the list of the failed ones"""
+  import itertools
+  extension=".instantiation"
+  jobList=[]
+  instances=[]
+  stamps=loadStamps(stampFile)
+  newStamps={}
+  for instantiationFile in instantiationFiles:
+    if not instantiationFile.endswith(extension):
+      logFile.write("ERROR input '"+ instantiationFile+"' is not a "+
+                    extension+" file!!\n")
+      continue
+    templateName=instantiationFile[:-len(extension)]+".template"
+    try:
+      input=open(instantiationFile,'r')
+      try:
+        subst=eval(input.read())
+      finally:
+        input.close()
+    except:
+      logFile.write("error evaluating substitutions from file '"+
+                    instantiationFile+"'\n")
+      import traceback
+      logFile.write('-'*60+"\n")
+      traceback.print_exc(file=logFile)
+      logFile.write('-'*60+"\n")
+      continue
+    for substitution in subst:
+      outName=instanceName(instantiationFile,substitution,outDir)
+      instances.append(outName)
+      stamp=instanceStamp(templateName,outName,substitution)
+      old=stamps.get(outName)
+      if old and old[0]==stamp and os.path.exists(outName):
+        st=os.stat(outName)
+        if old[1:]==(st.st_mtime,st.st_size):
+          newStamps[outName]=old
+          continue
+      newStamps[outName]=(stamp,)
+      jobList.append((templateName,outName,substitution))
+  pool=None
+  if jobs>1 and len(jobList)>1:
+    import multiprocessing
+    pool=multiprocessing.Pool(min(jobs,len(jobList)))
+    results=pool.imap(instanceWorker,jobList)
+  else:
+    results=itertools.imap(instanceWorker,jobList)
+  failures=[]
+  try:
+    for (outName,failed,log) in results:
+      logFile.write(log)
+      logFile.flush()
+      if failed or not os.path.exists(outName):
+        failures.append(outName)
+        del newStamps[outName]
+      else:
+        st=os.stat(outName)
+        newStamps[outName]=newStamps[outName][:1]+(st.st_mtime,st.st_size)
+  finally:
+    if pool:
+      pool.terminate()
+      pool.join()
+    if stampFile:
+      for (outName,stamp) in stamps.items():
+        if not newStamps.has_key(outName) and outName not in failures:
+          # instances of other instantiation files
+          newStamps[outName]=stamp
+      for outName in newStamps.keys():
+        if len(newStamps[outName])==1: del newStamps[outName]
+      saveStamps(stampFile,newStamps)
+  logFile.write("%d instances, %d generated, %d failed\n"%
+                (len(instances),len(jobList),len(failures)))
+  return (instances,failures)
+
 if __name__ == '__main__':
-    if len(sys.argv)<2:
-        print "usage:", sys.argv[0]," template1.instantiation [template2.instantiation ...]"
+    usageDesc=("usage:\n"+sys.argv[0]+""" [--jobs=N] [--out-dir=dir]
+    [--stamps=file] template1.instantiation [template2.instantiation ...]
+
+    generates and prettifies the instances of the given templates, with
+    N parallel processes. With --stamps the instances that are up to date
+    (same template, substitutions and tools as recorded in the stamps
+    file) are skipped.
+    """)
+    jobs=1
+    outDir=None
+    stampFile=None
+    args=[]
+    for arg in sys.argv[1:]:
+        m=re.match(r"--jobs=([0-9]+)$",arg)
+        if m:
+            jobs=int(m.groups()[0])
+            continue
+        m=re.match(r"--(out-dir|stamps)=(.+)$",arg)
+        if m:
+            if m.groups()[0]=='out-dir':
+                outDir=m.groups()[1]
+            else:
+                stampFile=m.groups()[1]
+        elif arg.startswith("-"):
+            print usageDesc
+            sys.exit(arg!="--help")
+        else:
+            args.append(arg)
+    if not args:
+        print usageDesc
+        sys.exit(1)
+    if jobs==1 and not stampFile:
+        for name in args:
+            evaluateInstantiationFile(name,sys.stdout,outDir)
     else:
-        for name in sys.argv[1:]:
-            evaluateInstantiationFile(name,sys.stdout)
+        (instances,failures)=instantiateFiles(args,sys.stdout,outDir,jobs,
+                                              stampFile)
+        sys.exit(len(failures)>0)
 # Local Variables:
 # py-indent-offset: 2
 # End:
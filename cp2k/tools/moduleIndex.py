@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+"""Index of the fortran modules of a source tree.
+
+For each module the index stores the public symbols, the modules it uses
+and the file that defines it. It is stored in a pickle file and updated
+incrementally (only files whose size, modification time and then content
+hash changed are parsed again).
+
+normalizeFortranFile.cleanUse uses it to remove the USE statements (without
+ONLY list) of modules whose public symbols are not used."""
+
+import sys
+import os, os.path
+import re
+import hashlib
+import cPickle
+from normalizeFortranFile import readFortranLine
+
+indexVersion=2
+
+moduleStartRe=re.compile(r" *module +(?P<name>[a-zA-Z_][a-zA-Z_0-9]*) *$",
+                         re.IGNORECASE)
+moduleEndRe=re.compile(r" *end *module(?: +[a-zA-Z_0-9]*)? *$",re.IGNORECASE)
+containsRe=re.compile(r" *contains *$",re.IGNORECASE)
+accessRe=re.compile(r" *(?P<access>public|private) *(?:(?:::)? *(?P<names>[^ \n].*))?$",
+                    re.IGNORECASE)
+useRe=re.compile(r" *use +(?P<module>[a-zA-Z_][a-zA-Z_0-9]*)",re.IGNORECASE)
+typeDefRe=re.compile(r" *type *(?:, *(?P<attributes>[^:]+?) *)?(?:::)? *(?P<name>[a-zA-Z_][a-zA-Z_0-9]*) *$",
+                     re.IGNORECASE)
+typeEndRe=re.compile(r" *end *type",re.IGNORECASE)
+interfaceRe=re.compile(r" *(?:abstract +)?interface *(?P<name>[a-zA-Z_][a-zA-Z_0-9]*)? *(?P<operator>\(.*\))? *$",
+                       re.IGNORECASE)
+interfaceEndRe=re.compile(r" *end *interface",re.IGNORECASE)
+routineStartRe=re.compile(r" *(?:(?:recursive|pure|elemental)\s+|(?:integer|real|logical|complex|character|double\s+precision|type)\s*(?:\((?:[^()]|\([^()]*\))*\))?\s*)*(?:subroutine|function) +(?P<name>[a-zA-Z_][a-zA-Z_0-9]*)",
+                          re.IGNORECASE)
+routineEndRe=re.compile(r" *end *(?:subroutine|function)",re.IGNORECASE)
+declarationRe=re.compile(r" *(?:integer|real|logical|complex|character|double +precision|double +complex|type *\(|class *\(|procedure *\(|enumerator)",
+                         re.IGNORECASE)
+ignoreRe=re.compile(r" *(?:implicit +none|save|enum *,.*|end *enum) *$",re.IGNORECASE)
+nameRe=re.compile(r" *(?P<name>[a-zA-Z_][a-zA-Z_0-9]*)")
+
+def splitTopLevel(text):
+    """Splits text at the commas that are not in parenthesis or strings"""
+    parts=[]
+    depth=0
+    quote=None
+    start=0
+    for i in xrange(len(text)):
+        c=text[i]
+        if quote:
+            if c==quote: quote=None
+        elif c=='"' or c=="'":
+            quote=c
+        elif c=='(':
+            depth+=1
+        elif c==')':
+            depth-=1
+        elif c==',' and depth==0:
+            parts.append(text[start:i])
+            start=i+1
+    parts.append(text[start:])
+    return parts
+
+def declaredNames(text):
+    """Returns the lowercase names declared in the variable list text"""
+    names=[]
+    for var in splitTopLevel(text):
+        m=nameRe.match(var)
+        if m: names.append(m.group('name').lower())
+    return names
+
+def newModule(name,line=None):
+    """Returns the state of the parsing of the module name (starting at
+    line), to be updated by parseModuleStatement and finishModule"""
+    return {'name':name,'defaultPrivate':0,'public':{},'private':{},
+            'declared':{},'uses':[],'complete':1,'unknownStatements':0,
+            'unknownPublic':0,'contains':0,'depth':0,'block':None,
+            'line':line}
+
+def parseModuleSymbols(inFile):
+    """Parses the modules defined in inFile.
+    Returns a list of dictionaries like
+    {'name':'module1','public':['sym1',...],'uses':['module2',...],
+     'defaultPrivate':1,'complete':1}
+    complete is true only if the public symbols are known exactly: the module
+    is PRIVATE by default (so that nothing is re-exported implicitly) and
+    does not export operators or assignments"""
+    modules=[]
+    module=None
+    while 1:
+        (jline,comments,lines)=readFortranLine(inFile)
+        if not lines: break
+        if not jline or jline.isspace(): continue
+        if module is None:
+            m=moduleStartRe.match(jline)
+            if m and m.group('name').lower()!='procedure':
+                module=newModule(m.group('name').lower())
+            continue
+        if moduleEndRe.match(jline) and module['depth']==0 and not module['block']:
+            modules.append(finishModule(module))
+            module=None
+            continue
+        parseModuleStatement(module,jline)
+    if module is not None:
+        modules.append(finishModule(module))
+    return modules
+
+def parseModuleStatement(module,jline):
+    """Updates module with the information contained in the statement jline"""
+    if module['block']=='type':
+        if typeEndRe.match(jline): module['block']=None
+        return
+    if module['block']=='interface':
+        if interfaceEndRe.match(jline):
+            module['block']=None
+        elif not module['interfaceName']:
+            m=routineStartRe.match(jline)
+            if m and module['interfaceDepth']==0:
+                module['declared'][m.group('name').lower()]=1
+            if m:
+                module['interfaceDepth']+=1
+            elif routineEndRe.match(jline):
+                module['interfaceDepth']-=1
+        return
+    if module['contains']:
+        m=routineStartRe.match(jline)
+        if m:
+            if module['depth']==0:
+                module['declared'][m.group('name').lower()]=1
+            module['depth']+=1
+        elif routineEndRe.match(jline):
+            module['depth']-=1
+        return
+    if containsRe.match(jline):
+        module['contains']=1
+        return
+    m=useRe.match(jline)
+    if m:
+        module['uses'].append(m.group('module').lower())
+        return
+    m=accessRe.match(jline)
+    if m:
+        access=m.group('access').lower()
+        if not m.group('names'):
+            if access=='private': module['defaultPrivate']=1
+            return
+        for name in splitTopLevel(m.group('names')):
+            name=name.strip().lower()
+            if not nameRe.match(name) or '(' in name:
+                # operator(...) or assignment(=)
+                if access=='public': module['complete']=0
+                continue
+            module[access][name]=1
+        return
+    m=interfaceRe.match(jline)
+    if m:
+        module['block']='interface'
+        module['interfaceDepth']=0
+        module['interfaceName']=m.group('name') or m.group('operator')
+        if m.group('operator'):
+            module['complete']=0
+        elif m.group('name'):
+            name=m.group('name').lower()
+            if name in ('operator','assignment'):
+                module['complete']=0
+            else:
+                module['declared'][name]=1
+        return
+    m=typeDefRe.match(jline)
+    if m:
+        module['block']='type'
+        name=m.group('name').lower()
+        module['declared'][name]=1
+        attributes=(m.group('attributes') or '').lower()
+        if 'public' in [a.strip() for a in attributes.split(',')]:
+            module['public'][name]=1
+        return
+    m=declarationRe.match(jline)
+    if m:
+        pos=jline.find('::')
+        if pos<0:
+            # declaration without ::, the declared names are unknown
+            unknownStatement(module,jline)
+            return
+        names=declaredNames(jline[pos+2:])
+        attributes=[a.strip().lower() for a in splitTopLevel(jline[:pos])]
+        for name in names:
+            module['declared'][name]=1
+            if 'public' in attributes: module['public'][name]=1
+            if 'private' in attributes: module['private'][name]=1
+    elif not ignoreRe.match(jline):
+        # might declare something (common blocks, namelists,...)
+        unknownStatement(module,jline)
+
+def unknownStatement(module,jline):
+    """Marks module as containing a statement that was not understood"""
+    module['unknownStatements']=1
+    if 'public' in jline.lower():
+        # might export names even if the default is private
+        module['unknownPublic']=1
+
+def finishModule(module):
+    """Returns the index entry of a parsed module"""
+    public=module['public']
+    if module['defaultPrivate']:
+        complete=module['complete'] and not module.get('unknownPublic')
+    else:
+        # everything not explicitly private is exported, also the symbols
+        # of the used modules
+        public=dict(module['declared'])
+        public.update(module['public'])
+        for name in module['private'].keys():
+            if public.has_key(name): del public[name]
+        complete=(module['complete'] and not module['uses'] and
+                  not module['unknownStatements'])
+    symbols=public.keys()
+    symbols.sort()
+    return {'name':module['name'],'public':symbols,'uses':module['uses'],
+            'defaultPrivate':module['defaultPrivate'],'complete':complete}
+
+class ModuleIndex:
+    """Persistent index of the modules of one or more source directories"""
+    def __init__(self,path=None):
+        self.path=path
+        self.files={}
+        self.modules={}
+        self.modified=0
+        if path and os.path.exists(path):
+            f=open(path,'rb')
+            try:
+                data=cPickle.load(f)
+            finally:
+                f.close()
+            if data.get('version')==indexVersion:
+                self.files=data['files']
+                self.modules=data['modules']
+
+    def moduleInfo(self,moduleName):
+        """Returns the index entry of the module moduleName (or None)"""
+        return self.modules.get(moduleName.lower())
+
+    def modulesKey(self,moduleNames):
+        """Returns a string that changes only if the index entries (public
+        symbols, completeness and default access) of moduleNames change"""
+        h=hashlib.sha1()
+        names=dict.fromkeys([name.lower() for name in moduleNames]).keys()
+        names.sort()
+        for name in names:
+            m=self.modules.get(name)
+            if m:
+                h.update("%s:%d%d:%s\n"%(name,bool(m['complete']),
+                    bool(m['defaultPrivate']),",".join(m['public'])))
+            else:
+                h.update(name+":missing\n")
+        return h.hexdigest()
+
+    def updateFile(self,fileName):
+        """Parses fileName again if it changed, returns true if it was parsed"""
+        fileName=os.path.abspath(fileName)
+        st=os.stat(fileName)
+        entry=self.files.get(fileName)
+        if entry and entry['mtime']==st.st_mtime and entry['size']==st.st_size:
+            return 0
+        f=open(fileName)
+        try:
+            content=f.read()
+        finally:
+            f.close()
+        fileHash=hashlib.sha1(content).hexdigest()
+        self.modified=1
+        if entry and entry['hash']==fileHash:
+            entry['mtime']=st.st_mtime
+            entry['size']=st.st_size
+            return 0
+        self.removeFile(fileName)
+        from cStringIO import StringIO
+        try:
+            modules=parseModuleSymbols(StringIO(content))
+        except SyntaxError:
+            modules=[]
+        self.files[fileName]={'mtime':st.st_mtime,'size':st.st_size,
+                              'hash':fileHash,
+                              'modules':[m['name'] for m in modules]}
+        for m in modules:
+            m['file']=fileName
+            self.modules[m['name']]=m
+        return 1
+
+    def removeFile(self,fileName):
+        """Removes fileName and its modules from the index"""
+        entry=self.files.get(fileName)
+        if not entry: return
+        for moduleName in entry['modules']:
+            m=self.modules.get(moduleName)
+            if m and m['file']==fileName:
+                del self.modules[moduleName]
+        del self.files[fileName]
+        self.modified=1
+
+    def updateDir(self,dirName,extensions=('.F','.f90')):
+        """Updates the index with the files of the directory dirName.
+        Returns the number of files parsed"""
+        dirName=os.path.abspath(dirName)
+        nParsed=0
+        present={}
+        for fName in os.listdir(dirName):
+            if os.path.splitext(fName)[1] not in extensions: continue
+            fileName=os.path.join(dirName,fName)
+            present[fileName]=1
+            nParsed+=self.updateFile(fileName)
+        for fileName in self.files.keys():
+            if os.path.dirname(fileName)==dirName and not present.has_key(fileName):
+                self.removeFile(fileName)
+        return nParsed
+
+    def save(self,path=None):
+        """Writes the index (if modified)"""
+        if path is None: path=self.path
+        if not self.modified and path==self.path: return
+        import tempfile
+        (fd,tmpName)=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        f=os.fdopen(fd,'wb')
+        try:
+            cPickle.dump({'version':indexVersion,'files':self.files,
+                          'modules':self.modules},f,cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpName,path)
+        self.modified=0
+
+_loadedIndexes={}
+
+def loadIndex(path):
+    """Returns the ModuleIndex stored in path, loaded only once per process
+    (and again if the file changes)"""
+    st=os.stat(path)
+    key=(st.st_mtime,st.st_size)
+    cached=_loadedIndexes.get(path)
+    if cached and cached[0]==key:
+        return cached[1]
+    index=ModuleIndex(path)
+    _loadedIndexes[path]=(key,index)
+    return index
+
+if __name__=='__main__':
+    usage=("usage: "+sys.argv[0]+" [--index=file] [--query=module] dir1 [dir2 ...]\n"+
+           "  updates the module index (default src_dir/module.index) with the\n"+
+           "  fortran files of the given directories")
+    indexPath=None
+    queries=[]
+    dirs=[]
+    for arg in sys.argv[1:]:
+        if arg.startswith('--index='):
+            indexPath=arg[len('--index='):]
+        elif arg.startswith('--query='):
+            queries.append(arg[len('--query='):])
+        elif arg.startswith('-'):
+            print usage
+            sys.exit(1)
+        else:
+            dirs.append(arg)
+    if not dirs and not (indexPath and queries):
+        print usage
+        sys.exit(1)
+    if indexPath is None:
+        indexPath=os.path.join(dirs[0],'module.index')
+    index=ModuleIndex(indexPath)
+    for dirName in dirs:
+        nParsed=index.updateDir(dirName)
+        print "parsed",nParsed,"files of",dirName
+    index.save()
+    for moduleName in queries:
+        m=index.moduleInfo(moduleName)
+        if not m:
+            print moduleName,"not found"
+        else:
+            print m['name'],"(file",m['file']+", complete:",str(m['complete'])+")"
+            print "  uses:"," ".join(m['uses'])
+            print "  public:"," ".join(m['public'])
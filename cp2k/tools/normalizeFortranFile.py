@@ -5,9 +5,9 @@ import re
 import string
 from sys import argv
 from cStringIO import StringIO
+import fortranLexer
+import toolsProfile
 
-rUse=0
-rVar=0
 varRe=re.compile(r" *(?P<var>[a-zA-Z_0-9]+) *(?P<rest>(?:\((?P<param>(?:[^()]+|\((?:[^()]+|\([^()]*\))*\))*)\))? *(?:= *(?P<value>(:?[^\"',()]+|\((?:[^()\"']+|\([^()\"']*\)|\"[^\"]*\"|'[^']*')*\)|\"[^\"]*\"|'[^']*')+))?)? *(?:(?P<continue>,)|\n?) *",re.IGNORECASE)
 useParseRe=re.compile(
     r" *use +(?P<module>[a-zA-Z_][a-zA-Z_0-9]*)(?P<only> *, *only *:)? *(?P<imports>.*)$",
@@ -19,9 +19,6 @@ def readFortranLine(infile):
     """Reads a group of connected lines (connected with &)
     returns a touple with the joined line, and a list with the original lines.
     Doesn't support multiline character constants!"""
-    lineRe=re.compile(
-        r"(?:(?P<preprocessor>#.*\n?)| *(&)?(?P<core>(?:!\$|[^&!\"']+|\"[^\"]*\"|'[^']*')*)(?P<continue>&)? *(?P<comment>!.*)?\n?)",#$
-        re.IGNORECASE)
     joinedLine=""
     comments=None
     lines=[]
@@ -30,28 +27,79 @@ def readFortranLine(infile):
         line=infile.readline().replace("\t",8*" ")
         if not line: break
         lines.append(line)
-        m=lineRe.match(line)
-        if not m or m.span()[1]!=len(line):
-            raise SyntaxError("unexpected line format:"+repr(line))
-        if m.group("preprocessor"):
+        if line[0]=='#':
             if len(lines)>1:
                 raise SyntaxError("continuation to a preprocessor line not supported "+repr(line))
             comments=line
             break
-        coreAtt=m.group("core")
+        parsedLine=fortranLexer.parseFortranLine(line)
+        if not parsedLine:
+            raise SyntaxError("unexpected line format:"+repr(line))
+        (coreAtt,continues,comment)=parsedLine
         joinedLine+=coreAtt
         if coreAtt and not coreAtt.isspace(): continuation=0
-        if m.group("continue"): continuation=1
-        if m.group("comment"):
+        if continues: continuation=1
+        if comment:
             if comments:
-                comments+="\n"+m.group("comment")
+                comments+="\n"+comment
             else:
-                comments=m.group("comment")
+                comments=comment
         if not continuation: break
     return (joinedLine,comments,lines)
     
-def parseRoutine(inFile):
-    """Parses a routine"""
+class Routine(object):
+    """A parsed routine (see parseRoutine).
+    Its text is not copied: the parts preRoutine, begin, declarations, core
+    and end are consecutive spans of the buffer the routine was parsed from,
+    until they are replaced with setText"""
+    __slots__=('buffer','bounds','replaced','kind','name','arguments',
+               'result','interfaceCount','use','parsedDeclarations',
+               'preDeclComments','declComments','strippedCore','firstCore',
+               'lastCore','postRoutine')
+    parts=('preRoutine','begin','declarations','core','end')
+
+    def __init__(self,buffer,start):
+        self.buffer=buffer
+        self.bounds=[start]*(len(self.parts)+1)
+        self.replaced={}
+        self.kind=None
+        self.name=None
+        self.arguments=None
+        self.result=None
+        self.interfaceCount=0
+        self.use=[]
+        self.parsedDeclarations=[]
+        self.preDeclComments=[]
+        self.declComments=[]
+        self.strippedCore=[]
+        self.firstCore=None
+        self.lastCore=None
+        self.postRoutine=[]
+
+    def text(self,part):
+        "returns the text of the given part of the routine"
+        if self.replaced.has_key(part):
+            return self.replaced[part]
+        i=self.parts.index(part)
+        return self.buffer[self.bounds[i]:self.bounds[i+1]]
+
+    def setText(self,part,text):
+        "replaces the text of the given part of the routine"
+        self.replaced[part]=text
+
+    def coreStatements(self):
+        "returns the statements of the core of the routine as a list"
+        coreFile=StringIO(self.text('core'))
+        statements=[]
+        while 1:
+            (jline,comments,lines)=readFortranLine(coreFile)
+            if not lines: break
+            statements.append("".join(lines))
+        return statements
+
+def parseRoutine(inFile,buffer):
+    """Parses a routine, inFile has to be a StringIO reading buffer
+    (the returned Routine refers to it)"""
     startRe=re.compile(r" *(?:recursive +|pure +|elemental +)*(?:subroutine|function)",re.IGNORECASE)
     endRe=re.compile(r" *end (?:subroutine|function)",re.IGNORECASE)
     startRoutineRe=re.compile(r" *(?:recursive +|pure +|elemental +)*(?P<kind>subroutine|function) +(?P<name>[a-zA-Z_][a-zA-Z_0-9]*) *(?:\((?P<arguments>[^()]*)\))? *(?:result *\( *(?P<result>[a-zA-Z_][a-zA-Z_0-9]*) *\))? *(?:bind *\([^()]+\))? *\n?",re.IGNORECASE)#$
@@ -62,26 +110,14 @@ def parseRoutine(inFile):
     ignoreRe=re.compile(r" *(?:|implicit +none *)$",re.IGNORECASE)
     interfaceStartRe=re.compile(r" *interface *$",re.IGNORECASE)
     interfaceEndRe=re.compile(r" *end +interface *$",re.IGNORECASE)
-    routine={'preRoutine':[],
-             'core':[],
-             'strippedCore':[],
-             'begin':[],
-             'end':[],
-             'preDeclComments':[],
-             'declarations':[],
-             'declComments':[],
-             'parsedDeclarations':[],
-             'postRoutine':[],
-             'kind':None,'name':None,'arguments':None,'result':None,
-             'interfaceCount':0,
-             'use':[]
-             }
+    pos=inFile.tell()
+    routine=Routine(buffer,pos)
     includeRe=re.compile(r"#? *include +[\"'](?P<file>.+)[\"'] *$",re.IGNORECASE)
     while 1:
+        pos=inFile.tell()
         (jline,comments,lines)=readFortranLine(inFile)
         if len(lines)==0: break
         if startRe.match(jline):break
-        routine['preRoutine'].extend(lines)
         m=includeRe.match(lines[0])
         if m:
             try:
@@ -90,28 +126,31 @@ def parseRoutine(inFile):
                     (subjline,subcomments,sublines)=readFortranLine(subF)
                     if not sublines:
                         break
-                    routine['strippedCore'].append(subjline)
+                    routine.strippedCore.append(subjline)
                 subF.close()
             except:
                 import traceback
                 print "error trying to follow include ",m.group('file')
                 print "warning this might lead to the removal of used variables"
                 traceback.print_exc()
+    routine.bounds[1]=pos
     if jline:
-        routine['begin']=lines
         m=startRoutineRe.match(jline)
         if not m or m.span()[1]!=len(jline):
             raise SyntaxError("unexpected subroutine start format:"+repr(lines))
-        routine['name']=m.group('name')
-        routine['kind']=m.group('kind')
+        routine.name=m.group('name')
+        routine.kind=m.group('kind')
         if (m.group('arguments') and m.group('arguments').strip()):
-            routine['arguments']=map(lambda x: x.strip(),
-                                     m.group('arguments').split(","))
+            routine.arguments=map(lambda x: x.strip(),
+                                  m.group('arguments').split(","))
         if (m.group('result')):
-            routine['result']=m.group('result')
-        if (not routine['result'])and(routine['kind'].lower()=="function"):
-            routine['result']=routine['name']
+            routine.result=m.group('result')
+        if (not routine.result)and(routine.kind.lower()=="function"):
+            routine.result=routine.name
+    pos=inFile.tell()
+    routine.bounds[2]=pos
     while 1:
+        pos=inFile.tell()
         (jline,comments,lines)=readFortranLine(inFile)
         if len(lines)==0: break
         if not ignoreRe.match(jline):
@@ -156,57 +195,69 @@ def parseRoutine(inFile):
                             raise SyntaxError("error parsing vars (leftover="+
                                               repr(str)+") in "+repr(lines))
                         break
-                routine['parsedDeclarations'].append(decl)
+                routine.parsedDeclarations.append(decl)
             elif interfaceStartRe.match(jline):
                 istart=lines
                 interfaceDeclFile=StringIO()
+                depth=0
                 while 1:
                     (jline,comments,lines)=readFortranLine(inFile)
+                    if not lines:
+                        raise SyntaxError("unterminated interface block:"+
+                                          repr(istart))
                     if interfaceEndRe.match(jline):
-                        iend=lines
-                        break
+                        if depth==0:
+                            iend=lines
+                            break
+                        depth-=1
+                    elif interfaceStartRe.match(jline):
+                        # interface of a dummy procedure argument
+                        depth+=1
                     interfaceDeclFile.writelines(lines)
-                interfaceDeclFile=StringIO(interfaceDeclFile.getvalue())
+                interfaceBuffer=interfaceDeclFile.getvalue()
+                interfaceDeclFile=StringIO(interfaceBuffer)
                 iroutines=[]
                 while 1:
-                    iroutine=parseRoutine(interfaceDeclFile)
-                    if not iroutine['kind']:
+                    iroutine=parseRoutine(interfaceDeclFile,interfaceBuffer)
+                    if not iroutine.kind:
                         if len(iroutines)==0:
-                            interfaceDeclFile.seek(0)
                             raise SyntaxError("error parsing interface:"+
-                                              repr(interfaceDeclFile.read()))
-                        iroutines[-1]['postRoutine'].extend(iroutine['preRoutine'])
+                                              repr(interfaceBuffer))
+                        iroutines[-1].postRoutine.append(
+                            iroutine.text('preRoutine'))
                         break
                     iroutines.append(iroutine)
                 for iroutine in iroutines:
-                    routine['interfaceCount']+=1
-                    decl={'type':'z_interface%02d'%(routine['interfaceCount']),
+                    routine.interfaceCount+=1
+                    decl={'type':'z_interface%02d'%(routine.interfaceCount),
                           'parameters':None,
                           'attributes':[],
-                          'vars':[iroutine['name']],
+                          'vars':[iroutine.name],
                           'iroutine':iroutine,
                           'istart':istart,
                           'iend':iend
                           }
-                    routine['parsedDeclarations'].append(decl)
+                    routine.parsedDeclarations.append(decl)
             elif useParseRe.match(jline):
-                routine['use'].append("".join(lines))
+                routine.use.append("".join(lines))
             else:
                 break
-        routine['declarations'].append("".join(lines))
-        if (len(routine['parsedDeclarations'])==0 and len(routine['use'])==0 and
+        if (len(routine.parsedDeclarations)==0 and len(routine.use)==0 and
             not re.match(" *implicit +none *$",jline,re.IGNORECASE)):
-            routine['preDeclComments'].append("".join(lines))
+            routine.preDeclComments.append("".join(lines))
         elif comments:
-            routine['declComments'].append(comments)
+            routine.declComments.append(comments)
+    routine.bounds[3]=pos
     containsRe=re.compile(r" *contains *$",re.IGNORECASE)
     while len(lines)>0:
         if endRe.match(jline):
-            routine['end']=lines
             break
-        routine['strippedCore'].append(jline)
-        routine['core'].append("".join(lines))
+        routine.strippedCore.append(jline)
+        if routine.firstCore is None:
+            routine.firstCore="".join(lines)
+        routine.lastCore="".join(lines)
         if containsRe.match(lines[0]):
+            pos=inFile.tell()
             break
         m=includeRe.match(lines[0])
         if m:
@@ -216,14 +267,17 @@ def parseRoutine(inFile):
                     (subjline,subcomments,sublines)=readFortranLine(subF)
                     if not sublines:
                         break
-                    routine['strippedCore'].append(subjline)
+                    routine.strippedCore.append(subjline)
                 subF.close()
             except:
                 import traceback
                 print "error trying to follow include ",m.group('file')
                 print "warning this might lead to the removal of used variables"
                 traceback.print_exc()
+        pos=inFile.tell()
         (jline,comments,lines)=readFortranLine(inFile)
+    routine.bounds[4]=pos
+    routine.bounds[5]=inFile.tell()
     return routine
 
 def findWord(word,text,options=re.IGNORECASE):
@@ -238,66 +292,179 @@ def findWord(word,text,options=re.IGNORECASE):
         pos=-1
     return pos
 
-def enforceDeclDependecies(declarations):
-    """enforces the dependencies between the vars
-    and compacts the declarations, returns the variables needed by other variables"""
-    idecl=0
-    ii=0
-    while idecl<len(declarations):
-        typeParam="".join(declarations[idecl]['attributes'])
-        if declarations[idecl]['parameters']:
-            typeParam+=" "+declarations[idecl]['parameters']
-        typeParam=typeParam.lower()
-        
+identifierRe=re.compile(r"(?<![a-zA-Z_0-9%])[a-zA-Z_0-9]+")
+kindSuffixRe=re.compile(r"(?<=[0-9.]_)(?=([a-zA-Z_0-9]+))")
+
+def identifierIndex(text):
+    """Returns the set of the (lowercase) words that findWord finds in text,
+    so that checking if a word is used becomes a lookup.
+    These are the whole words not directly preceded by a '%' (i.e. not
+    components) and the kind suffixes of numeric constants (dp in 1.0_dp)"""
+    text=text.lower()
+    ids=set(identifierRe.findall(text))
+    ids.update(kindSuffixRe.findall(text))
+    return ids
+
+wordChars="abcdefghijklmnopqrstuvwxyz_0123456789"
+
+class IdentifierCollector:
+    """Collects the identifiers (see identifierIndex) of a text given in
+    pieces, as if the pieces were joined, without keeping the text:
+    the last word of a piece can continue in the next one, so it is kept
+    (with the character before it) until the next piece"""
+    def __init__(self):
+        self.ids=set()
+        self.tail=""
+        self.start=0
+
+    def add(self,text):
+        "adds the next piece of the text"
+        text=self.tail+text.lower()
+        cut=len(text)
+        while cut>0 and text[cut-1] in wordChars:
+            cut-=1
+        self.ids.update(identifierRe.findall(text,self.start,cut))
+        self.ids.update(kindSuffixRe.findall(text,self.start,cut))
+        if cut>0:
+            self.tail=text[cut-1:]
+            self.start=1
+        else:
+            self.tail=text
+
+    def identifiers(self):
+        "returns the set of the identifiers of the text added up to now"
+        ids=set(self.ids)
+        ids.update(identifierRe.findall(self.tail,self.start))
+        ids.update(kindSuffixRe.findall(self.tail,self.start))
+        return ids
+
+class ConstraintError(StandardError):
+    "the dependencies between the declarations cannot be satisfied"
+
+def orderDeclarations(declarations,varInfo,checkFirstType=1):
+    """returns copies of declarations ordered so that the vars come after the
+    vars they need (see enforceDeclDependecies).
+    varInfo maps each var to its lowercase name and the set of identifiers
+    it uses. If checkFirstType is true a declaration is moved also if the
+    type of the first declaration that reached its position needs a later
+    var.
+    Raises ConstraintError if the dependencies cannot be satisfied"""
+    import heapq
+    declarations=[dict(decl,vars=list(decl['vars'])) for decl in declarations]
+    varOfName={}
+    owner={}
+    for decl in declarations:
+        for var in decl['vars']:
+            varOfName[varInfo[var][0]]=var
+            owner[varInfo[var][0]]=decl
+    labels={}
+    heap=[]
+    for i in xrange(len(declarations)):
+        labels[id(declarations[i])]=(i,)
+        heap.append(((i,),declarations[i]))
+    maxSteps=(len(varInfo)+len(declarations)+10)**2
+    steps=0
+    tick=0
+    result=[]
+    firstTypeIds=None
+    while heap:
+        (label,decl)=heapq.heappop(heap)
+        if labels.get(id(decl))!=label:
+            continue # it was moved
+        typeParam="".join(decl['attributes'])
+        if decl['parameters']:
+            typeParam+=" "+decl['parameters']
+        typeIds=identifierIndex(typeParam)
+        if not checkFirstType:
+            pass
+        elif firstTypeIds is None:
+            firstTypeIds=typeIds
+        else:
+            typeIds=typeIds.union(firstTypeIds)
+        vars=decl['vars']
+        names=[varInfo[var][0] for var in vars]
         ivar=0
-        while ivar<len(declarations[idecl]['vars']):
+        while ivar<len(vars):
+            steps+=1
+            if steps>maxSteps:
+                raise ConstraintError("could not enforce all constraints")
+            var=vars[ivar]
+            (name,restIds)=varInfo[var]
             moved=0
-            m=varRe.match(declarations[idecl]['vars'][ivar])
-            if not m:
-                raise SyntaxError('could not match var '+repr(declarations[idecl]['vars'][ivar]))
-            rest=m.group("rest")
-            rest=rest.lower()
-            if rest:
-                for ivar2 in range(ivar+1,len(declarations[idecl]['vars'])):
-                    m=varRe.match(declarations[idecl]['vars'][ivar2])
-                    if findWord(m.group('var').lower(),rest)!=-1:
+            for dep in restIds:
+                if owner.get(dep) is decl:
+                    ivar2=names.index(dep)
+                    if ivar2>ivar and ivar2>=moved:
                         moved=ivar2+1
             if moved:
-                declarations[idecl]['vars'][moved:moved]=[
-                    declarations[idecl]['vars'][ivar]]
-                del declarations[idecl]['vars'][ivar]
+                vars.insert(moved,var)
+                names.insert(moved,name)
+                del vars[ivar]
+                del names[ivar]
+                continue
+            if ivar==0:
+                deps=restIds.union(typeIds)
             else:
-                for idecl2 in range(idecl+1,len(declarations)):
-                    for ivar2 in range(len(declarations[idecl2]['vars'])):
-                        ii+=1
-                        if ii>100000:
-                            raise StandardError,"could not enforce all constraints"
-                        m=varRe.match(declarations[idecl2]['vars'][ivar2])
-                        if (ivar==0 and
-                            findWord(m.group('var').lower(),typeParam)!=-1):
-                            declarations.insert(idecl2+1,declarations[idecl])
-                            del declarations[idecl]
-                            ivar=0
-                            moved=1
-                            break
-                        if rest and findWord(m.group('var').lower(),rest)!=-1:
-                            if len(declarations[idecl]['vars'])>1:
-                                newDecl={}
-                                newDecl.update(declarations[idecl])
-                                newDecl['vars']=[declarations[idecl]['vars'][ivar]]
-                                declarations.insert(idecl2+1,newDecl)
-                                del declarations[idecl]['vars'][ivar]
-                            else:
-                                declarations.insert(idecl2+1,
-                                                    declarations[idecl])
-                                del declarations[idecl]
-                                ivar=0
-                            moved=1
-                            break
-                    if moved:
-                        break
-            if not moved: ivar+=1
-        idecl+=1
+                deps=restIds
+            first=None
+            for dep in deps:
+                decl2=owner.get(dep)
+                if (decl2 is None or decl2 is decl or
+                    not labels.has_key(id(decl2))):
+                    continue
+                pos=(labels[id(decl2)],decl2['vars'].index(varOfName[dep]))
+                if first is None or pos<first[0]:
+                    first=(pos,dep,decl2)
+            if first is None:
+                ivar+=1
+                continue
+            (pos,dep,decl2)=first
+            tick+=1
+            newLabel=labels[id(decl2)]+(-tick,)
+            if (ivar==0 and dep in typeIds) or len(vars)==1:
+                labels[id(decl)]=newLabel
+                heapq.heappush(heap,(newLabel,decl))
+                break
+            newDecl={}
+            newDecl.update(decl)
+            newDecl['vars']=[var]
+            owner[name]=newDecl
+            labels[id(newDecl)]=newLabel
+            heapq.heappush(heap,(newLabel,newDecl))
+            del vars[ivar]
+            del names[ivar]
+        else:
+            del labels[id(decl)]
+            result.append(decl)
+            firstTypeIds=None
+    return result
+
+def enforceDeclDependecies(declarations):
+    """enforces the dependencies between the vars
+    and compacts the declarations, returns the variables needed by other variables
+
+    The declarations are handled in order: a var needing later vars of its
+    declaration is moved after the last of them, a var needing a var of a
+    later declaration is moved (split off if needed) after the first such
+    declaration, as is a declaration whose type needs a later var.
+    The dependencies are the identifiers of each var, and the order of the
+    declarations is kept with labels (a declaration moved after another gets
+    its label extended, sorting before the declarations moved there earlier),
+    so that the first later dependency is found without rescanning."""
+    varInfo={}
+    for decl in declarations:
+        for var in decl['vars']:
+            m=varRe.match(var)
+            if not m:
+                raise SyntaxError('could not match var '+repr(var))
+            varInfo[var]=(m.group("var").lower(),
+                          identifierIndex(m.group("rest") or ""))
+    try:
+        declarations[:]=orderDeclarations(declarations,varInfo)
+    except ConstraintError:
+        # checking also the type of the first declaration (as the previous
+        # implementation did) keeps the established order, but can cycle
+        declarations[:]=orderDeclarations(declarations,varInfo,0)
 
     for i in range(len(declarations)-1,0,-1):
         if (declarations[i]['normalizedType'].lower()==
@@ -324,12 +491,9 @@ def sortDeclarations(declarations):
 
 def writeRoutine(routine, outFile):
     """writes the given routine to outFile"""
-    outFile.writelines(routine["preRoutine"])
-    outFile.writelines(routine["begin"])
-    outFile.writelines(routine["declarations"])
-    outFile.writelines(routine["core"])
-    outFile.writelines(routine["end"])
-    outFile.writelines(routine["postRoutine"])
+    for part in routine.parts:
+        outFile.write(routine.text(part))
+    outFile.writelines(routine.postRoutine)
     
 def writeInCols(dLine,indentCol,maxCol,indentAtt,file):
     """writes out the strings (trying not to cut them) in dLine up to maxCol
@@ -448,38 +612,43 @@ def writeDeclarations(parsedDeclarations,file):
         else:
             writeExtendedDeclaration(d,file)
 
-def cleanDeclarations(routine,logFile=sys.stdout):
+def countStat(stats,key):
+    """increments the counter key of the stats dictionary (if given)"""
+    if stats is not None:
+        stats[key]=stats.get(key,0)+1
+
+def cleanDeclarations(routine,logFile=sys.stdout,stats=None):
     """cleans up the declaration part of the given parsed routine
-    removes unused variables"""
-    global rVar
+    removes unused variables (counted as 'removedVar' in stats)"""
     containsRe=re.compile(r" *contains *$",re.IGNORECASE)
-    if routine['core']:
-        if containsRe.match(routine['core'][-1]):
+    if routine.lastCore is not None:
+        if containsRe.match(routine.lastCore):
             logFile.write("*** routine %s contains other routines ***\n*** declarations not cleaned ***\n"%
-                (routine['name']))
+                (routine.name))
             return
     commentToRemoveRe=re.compile(r" *! *(?:interface|arguments|parameters|locals?|\** *local +variables *\**|\** *local +parameters *\**) *$",re.IGNORECASE)
     nullifyRe=re.compile(r" *nullify *\(([^()]+)\) *\n?",re.IGNORECASE|re.MULTILINE)
     
-    if not routine['kind']: return
-    if (routine['core']):
-        if re.match(" *type *[a-zA-Z_]+ *$",routine['core'][0],re.IGNORECASE):
+    if not routine.kind: return
+    if (routine.firstCore is not None):
+        if re.match(" *type *[a-zA-Z_]+ *$",routine.firstCore,re.IGNORECASE):
             logFile.write("*** routine %s contains local types, not fully cleaned ***\n"%
-                      (routine['name']))
-        if re.match(" *import+ *$",routine['core'][0],re.IGNORECASE):   
+                      (routine.name))
+        if re.match(" *import+ *$",routine.firstCore,re.IGNORECASE):   
             logFile.write("*** routine %s contains import, not fully cleaned ***\n"%
-                      (routine['name']))
-    if re.search("^#","".join(routine['declarations']),re.MULTILINE):
+                      (routine.name))
+    if re.search("^#",routine.text('declarations'),re.MULTILINE):
         logFile.write("*** routine %s declarations contain preprocessor directives ***\n*** declarations not cleaned ***\n"%(
-            routine['name']))
+            routine.name))
         return
+    core=None
     try:
-        rest="".join(routine['strippedCore']).lower()
-        nullifys=",".join(nullifyRe.findall(rest))
-        rest=nullifyRe.sub("",rest)
+        rest="".join(routine.strippedCore).lower()
+        nullifys=identifierIndex(",".join(nullifyRe.findall(rest)))
+        usedIds=identifierIndex(nullifyRe.sub("",rest))
         paramDecl=[]
         decls=[]
-        for d in routine['parsedDeclarations']:
+        for d in routine.parsedDeclarations:
             d['normalizedType']=d['type']
             if d['parameters']:
                 d['normalizedType']+=d['parameters']
@@ -503,19 +672,19 @@ def cleanDeclarations(routine,logFile=sys.stdout):
                 lowerV=m.group("var").lower()
                 if lowerV=="routinen":
                     has_routinen=1
-                    d['vars'][i]="routineN = '"+routine['name']+"'"
+                    d['vars'][i]="routineN = '"+routine.name+"'"
                 elif lowerV=="routinep":
                     pos_routinep=i
                     d['vars'][i]="routineP = moduleN//':'//routineN"
             if not has_routinen and pos_routinep>=0:
-                d['vars'].insert(pos_routinep,"routineN = '"+routine['name']+"'")
+                d['vars'].insert(pos_routinep,"routineN = '"+routine.name+"'")
 
 
-        if routine['arguments']:
-            routine['lowercaseArguments']=map(lambda x:x.lower(),routine['arguments'])
+        if routine.arguments:
+            lowercaseArguments=map(lambda x:x.lower(),routine.arguments)
         else:
-            routine['lowercaseArguments']=[]
-        if routine['result']: routine['lowercaseArguments'].append(routine['result'].lower())
+            lowercaseArguments=[]
+        if routine.result: lowercaseArguments.append(routine.result.lower())
         argDeclDict={}
         localDecl=[]
         for d in decls:
@@ -526,37 +695,38 @@ def cleanDeclarations(routine,logFile=sys.stdout):
             for v in d['vars']:
                 m=varRe.match(v)
                 lowerV=m.group("var").lower()
-                if lowerV in routine['lowercaseArguments']:
+                if lowerV in lowercaseArguments:
                     argD={}
                     argD.update(d)
                     argD['vars']=[v]
                     if argDeclDict.has_key(lowerV):
                         raise SyntaxError(
                             "multiple declarations not supported. var="+v+
-                            " declaration="+str(d)+"routine="+routine['name'])
+                            " declaration="+str(d)+"routine="+routine.name)
                     argDeclDict[lowerV]=argD
                 else:
-                    pos=findWord(lowerV,rest)
-                    if (pos!=-1):
+                    if lowerV in usedIds:
                         localD['vars'].append(v)
                     else:
-                        if findWord(lowerV,nullifys)!=-1:
-                            if not rmNullify(lowerV,routine['core']):
+                        if lowerV in nullifys:
+                            if core is None:
+                                core=routine.coreStatements()
+                            if not rmNullify(lowerV,core):
                                 raise SyntaxError(
                                     "could not remove nullify of "+lowerV+
-                                    " as expected, routine="+routine['name'])
+                                    " as expected, routine="+routine.name)
                         logFile.write("removed var %s in routine %s\n" %
-                                      (lowerV,routine['name']))
-                        rVar+=1
+                                      (lowerV,routine.name))
+                        countStat(stats,'removedVar')
             if (len(localD['vars'])):
                 localDecl.append(localD)
         argDecl=[]
-        for arg in routine['lowercaseArguments']:
+        for arg in lowercaseArguments:
             if argDeclDict.has_key(arg):
                 argDecl.append(argDeclDict[arg])
             else:
-                print "warning, implicitly typed argument '",arg,"' in routine",routine['name']
-        if routine['kind'].lower()=='function':
+                print "warning, implicitly typed argument '",arg,"' in routine",routine.name
+        if routine.kind.lower()=='function':
             aDecl=argDecl[:-1]
         else:
             aDecl=argDecl
@@ -582,10 +752,10 @@ def cleanDeclarations(routine,logFile=sys.stdout):
         paramDecl=paramDecl[:splitPos]
 
         newDecl=StringIO()
-        for comment in routine['preDeclComments']:
+        for comment in routine.preDeclComments:
             if not commentToRemoveRe.match(comment):
                 newDecl.write(comment)
-        newDecl.writelines(routine['use'])
+        newDecl.writelines(routine.use)
         writeDeclarations(argDecl,newDecl)
         if argDecl and paramDecl:
             newDecl.write("\n")
@@ -596,18 +766,19 @@ def cleanDeclarations(routine,logFile=sys.stdout):
         if argDecl or paramDecl or localDecl:
             newDecl.write("\n")
         wrote=0
-        for comment in routine['declComments']:
+        for comment in routine.declComments:
             if not commentToRemoveRe.match(comment):
                 newDecl.write(comment)
                 newDecl.write("\n")
                 wrote=1
         if wrote:
             newDecl.write("\n")
-        routine['declarations']=[newDecl.getvalue()]
+        routine.setText('declarations',newDecl.getvalue())
+        if core is not None:
+            routine.setText('core',"".join(core))
     except:
-        if routine.has_key('name'):
-            logFile.write("**** exception cleaning routine "+routine['name']+" ****")
-        logFile.write("parsedDeclartions="+str(routine['parsedDeclarations']))
+        logFile.write("**** exception cleaning routine "+routine.name+" ****")
+        logFile.write("parsedDeclartions="+str(routine.parsedDeclarations))
         raise
 
 def rmNullify(var,strings):
@@ -810,21 +981,42 @@ def prepareImplicitUses(modules):
             m_att['_WHOLE_']=1
     return mods
 
-def cleanUse(modulesDict,rest,implicitUses=None,logFile=sys.stdout):
-    """Removes the unneded modules (the ones that are not used in rest)"""
-    global rUse
+def cleanUse(modulesDict,rest,implicitUses=None,logFile=sys.stdout,
+             moduleIndex=None,stats=None):
+    """Removes the unneded modules (the ones that are not used in rest)
+    If a moduleIndex (see moduleIndex.py) is given also the uses of whole
+    modules are removed if none of the public symbols of the module is used.
+    The removed uses are counted as 'removedUse' in stats.
+    rest is the text using the modules, or the set of its identifiers (see
+    identifierIndex)"""
     exceptions={}
     modules=modulesDict['modules']
-    rest=rest.lower()
+    if isinstance(rest,set):
+        usedIds=rest
+    else:
+        usedIds=identifierIndex(rest)
     for i in range(len(modules)-1,-1,-1):
         m_att={}
         m_name=modules[i]['module'].lower()
         if implicitUses and implicitUses.has_key(m_name):
             m_att=implicitUses[m_name]
         if m_att.has_key('_WHOLE_') and m_att['_WHOLE_']:
-            rUse+=1
+            countStat(stats,'removedUse')
             logFile.write("removed USE of module "+m_name+"\n")
             del modules[i]
+        elif moduleIndex and not modules[i].has_key('only'):
+            if modules[i].get('renames'): continue
+            m_info=moduleIndex.moduleInfo(m_name)
+            if not m_info or not m_info['complete']: continue
+            for symbol in m_info['public']:
+                if symbol in usedIds: break
+            else:
+                countStat(stats,'removedUse')
+                logFile.write("removed USE of unused module "+m_name+"\n")
+                if modules[i]['comments']:
+                    modulesDict['preComments'].extend(
+                        map(lambda x:x+"\n",modules[i]['comments']))
+                del modules[i]
         elif modules[i].has_key("only"):
             els=modules[i]['only']
             for j in range(len(els)-1,-1,-1):
@@ -833,12 +1025,12 @@ def cleanUse(modulesDict,rest,implicitUses=None,logFile=sys.stdout):
                     raise SyntaxError('could not parse use only:'+repr(els[j]))
                 impAtt=m.group('localName').lower()
                 if m_att.has_key(impAtt):
-                    rUse+=1
+                    countStat(stats,'removedUse')
                     logFile.write("removed USE "+m_name+", only: "+repr(els[j])+"\n")
                     del els[j]
                 elif not exceptions.has_key(impAtt):
-                    if findWord(impAtt,rest)==-1:
-                        rUse+=1
+                    if not impAtt in usedIds:
+                        countStat(stats,'removedUse')
                         logFile.write("removed USE "+m_name+", only: "+repr(els[j])+"\n")
                         del els[j]
             if len(modules[i]['only'])==0:
@@ -856,46 +1048,93 @@ def resetModuleN(moduleName,lines):
             "  CHARACTER(len=*), PARAMETER, PRIVATE :: moduleN = '"+moduleName+"'",
             lines[i])
 
-def rewriteFortranFile(inFile,outFile,logFile=sys.stdout,orig_filename=None):
+def intersectsLines(first,last,changedLines):
+    "returns true if the span first-last contains one of the changedLines ranges"
+    for (start,end) in changedLines:
+        if start<=last and end>=first:
+            return 1
+    return 0
+
+_implicitUsesCache={}
+
+def implicitUsesOfFile(fileName):
+    """Returns the implicitUses (see prepareImplicitUses) of the use
+    statements contained in fileName (normally cp_common_uses.h).
+    The result is cached as long as the file does not change."""
+    import os
+    st=os.stat(fileName)
+    key=(st.st_mtime,st.st_size)
+    cached=_implicitUsesCache.get(fileName)
+    if cached and cached[0]==key:
+        return cached[1]
+    f=file(fileName)
+    try:
+        implicitUses=prepareImplicitUses(parseUse(f)['modules'])
+    finally:
+        f.close()
+    _implicitUsesCache[fileName]=(key,implicitUses)
+    return implicitUses
+
+def rewriteFortranFile(inFile,outFile,logFile=sys.stdout,orig_filename=None,
+                       moduleIndex=None,stats=None,changedLines=None):
     """rewrites the use statements and declarations of inFile to outFile.
-    It sorts them and removes the repetitions."""
+    It sorts them and removes the repetitions.
+    If moduleIndex is given also unused uses of whole modules are removed.
+    If stats is a dictionary the removed uses and variables are counted in
+    it ('removedUse' and 'removedVar').
+    If changedLines (a list of (first,last) line ranges of inFile) is given
+    only the declarations of the routines intersecting them are rewritten
+    (and the module uses only if the module header intersects them), all the
+    rest is copied verbatim.
+    The routines are parsed, cleaned and written one at a time, their output
+    is kept in memory only if the uses (that depend on all of them) are
+    rewritten."""
     import os.path
     moduleRe=re.compile(r" *(?:module|program) +(?P<moduleName>[a-zA-Z_][a-zA-Z_0-9]*) *(?:!.*)?$",
                         flags=re.IGNORECASE)
+    if not orig_filename: orig_filename=inFile.name
     commonUsesIncludeFilepath=os.path.join(
-        os.path.split(os.path.abspath(inFile.name))[0],"cp_common_uses.h")
-    coreLines=[]
+        os.path.split(os.path.abspath(orig_filename))[0],"cp_common_uses.h")
+    usedIds=IdentifierCollector()
+    headerNewlines=0
     while 1:
         line=inFile.readline()
         if not line: break
         if line[0]=='#':
-            coreLines.append(line)
+            usedIds.add(line)
         outFile.write(line)
+        headerNewlines+=line.count("\n")
         m=moduleRe.match(line)
         if m:
-            if not orig_filename: orig_filename=inFile.name
             fn = os.path.basename(orig_filename).rsplit(".",1)[0]
             if (m.group('moduleName')!=fn) :
                 raise SyntaxError("Module name is different from filename ("+
                                   m.group('moduleName')+"!="+fn+")")
             break
+    # the routines refer to this buffer
+    buffer=inFile.read()
+    if "\t" in buffer:
+        buffer=buffer.replace("\t",8*" ")
+        if changedLines is not None:
+            logFile.write("*** could not split the file in routines, "+
+                          "rewriting all of it ***\n")
+            changedLines=None
+    inFile=StringIO(buffer)
     try:
         modulesDict=parseUse(inFile)
-        routines=[]
-        coreLines.append(modulesDict['postLine'])
-        routine=parseRoutine(inFile)
-        coreLines.extend(routine['preRoutine'])
+        usedIds.add(modulesDict['postLine'])
+        routine=parseRoutine(inFile,buffer)
+        usedIds.add(routine.text('preRoutine'))
         if m:
-            resetModuleN(m.group('moduleName'),routine['preRoutine'])
-        routines.append(routine)
-        while routine['kind']:
-            routine=parseRoutine(inFile)
-            routines.append(routine)
-        map(lambda x:cleanDeclarations(x,logFile),routines)
-        for routine in routines:
-            coreLines.extend(routine['declarations'])
-            coreLines.extend(routine['strippedCore'])
-        rest="".join(coreLines)
+            preRoutine=[routine.text('preRoutine')]
+            resetModuleN(m.group('moduleName'),preRoutine)
+            if preRoutine[0]!=routine.text('preRoutine'):
+                routine.setText('preRoutine',preRoutine[0])
+        cleanModuleUses=1
+        if changedLines is not None:
+            newlines=headerNewlines+buffer.count("\n",0,routine.bounds[1])
+            cleanModuleUses=intersectsLines(1,newlines,changedLines)
+            countedPos=routine.bounds[1]
         nonStPrep=0
         for line in modulesDict['origLines']:
             if (re.search('^#',line) and not commonUsesRe.match(line)):
@@ -903,36 +1142,71 @@ def rewriteFortranFile(inFile,outFile,logFile=sys.stdout,orig_filename=None):
                 nonStPrep=1
         if nonStPrep:
             logFile.write("*** use statements contains preprocessor directives, not cleaning ***")
+        if nonStPrep or not cleanModuleUses:
+            # the uses are kept, the routines can be written right away
             outFile.writelines(modulesDict['origLines'])
+            outFile.write(modulesDict['postLine'])
+            routineFile=outFile
+            usedIds=None
         else:
+            # the uses depend on all the routines, buffer their output
+            routineFile=StringIO()
+        while 1:
+            clean=1
+            if changedLines is not None:
+                newlines+=buffer.count("\n",countedPos,routine.bounds[1])
+                first=newlines+1
+                newlines+=buffer.count("\n",routine.bounds[1],routine.bounds[5])
+                countedPos=routine.bounds[5]
+                clean=intersectsLines(first,newlines,changedLines)
+            if clean:
+                if toolsProfile.enabled:
+                    declarations=routine.text('declarations')
+                    started=toolsProfile.start()
+                    cleanDeclarations(routine,logFile,stats)
+                    toolsProfile.stop('clean-declarations',orig_filename,
+                                      started,lines=declarations.count("\n"),
+                                      bytesIn=len(declarations),
+                                      bytesOut=len(routine.text('declarations')))
+                else:
+                    cleanDeclarations(routine,logFile,stats)
+            if usedIds is not None:
+                usedIds.add(routine.text('declarations'))
+                usedIds.add("".join(routine.strippedCore))
+            writeRoutine(routine,routineFile)
+            if not routine.kind: break
+            routine=parseRoutine(inFile,buffer)
+        if routineFile is not outFile:
             implicitUses=None
             if modulesDict['commonUses']:
                 try:
-                    f=file(commonUsesIncludeFilepath)
-                    implicitUsesRaw=parseUse(f)
-                    f.close()
-                    implicitUses=prepareImplicitUses(implicitUsesRaw['modules'])
+                    implicitUses=implicitUsesOfFile(commonUsesIncludeFilepath)
                 except:
                     print ("ERROR trying to parse use statements contained in common",
                            "uses precompiler file ", commonUsesIncludeFilepath)
                     raise
-            cleanUse(modulesDict,rest,implicitUses=implicitUses,logFile=logFile)
+            if m and moduleIndex and m.group(0).lstrip()[:6].lower()=='module':
+                # a module that is public by default re-exports the used modules
+                m_info=moduleIndex.moduleInfo(m.group('moduleName'))
+                if not m_info or not m_info['defaultPrivate']:
+                    moduleIndex=None
+            cleanUse(modulesDict,usedIds.identifiers(),implicitUses=implicitUses,
+                     logFile=logFile,moduleIndex=moduleIndex,stats=stats)
             normalizeModules(modulesDict['modules'])
             outFile.writelines(modulesDict['preComments'])
             writeUses(modulesDict['modules'],outFile)
             outFile.write(modulesDict['commonUses'])
             if modulesDict['modules']:
                 outFile.write('\n')
-        outFile.write(modulesDict['postLine'])
-        for routine in routines:
-            writeRoutine(routine,outFile)
+            outFile.write(modulesDict['postLine'])
+            outFile.write(routineFile.getvalue())
     except:
         import traceback
         logFile.write('-'*60+"\n")
         traceback.print_exc(file=logFile)
         logFile.write('-'*60+"\n")
 
-        logFile.write("Processing file '"+inFile.name+"'\n")
+        logFile.write("Processing file '"+orig_filename+"'\n")
         raise
 
 if __name__ == '__main__':
@@ -945,18 +1219,19 @@ if __name__ == '__main__':
             print "out_dir must be a directory"
             print "usage:", sys.argv[0]," out_dir file1 [file2 ...]"
         else:
+            stats={'removedUse':0,'removedVar':0}
             for fileName in sys.argv[2:]:
                 try:
                     print "normalizing",fileName
                     infile=open(fileName,'r')
                     outfile=open(os.path.join(outDir,
                                               os.path.basename(fileName)),'w')
-                    rewriteFortranFile(infile,outfile)
+                    rewriteFortranFile(infile,outfile,stats=stats)
                     infile.close()
                     outfile.close()
                 except:
                     print "error for file", fileName
             print "*** "*6
-            print "removedUse=",rUse
-            print "removedVar=",rVar
+            print "removedUse=",stats['removedUse']
+            print "removedVar=",stats['removedVar']
                 # print "done"
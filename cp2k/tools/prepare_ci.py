@@ -17,7 +17,7 @@ directiveRe=re.compile(r"--(no-)?(normalize-use|upcase-keywords|"+
 descStr=("usage:"+sys.argv[0]+"""
   [--[no-]normalize-use] [--[no-]upcase-keywords] [--[no-]replace]
   [--help] [--[no-]synopsis] [--[no-]prettify-cvs] [--[no-]clean]
-  [--[no-]tests]
+  [--[no-]tests] [--jobs=N]
 
   Prepares for checkin the source.
   defaults="""+str(directives)
@@ -25,10 +25,13 @@ descStr=("usage:"+sys.argv[0]+"""
 if "--help" in sys.argv[1:]:
     print descStr
     sys.exit(0)
+jobs=1
 for directive in sys.argv[1:]:
     m=directiveRe.match(directive)
     if m:
         directives[m.groups()[1]]=not m.groups()[0]
+    elif re.match(r"--jobs=[0-9]+$",directive):
+        jobs=int(directive[7:])
     else:
         print " ** ERROR **\nUnknown argument",directive
         print descStr
@@ -50,7 +53,7 @@ print "main log: "+mainLog.name
 
 buildUtils.prettifyCp2k(cp2kRoot=cp2kRoot,buildType="sdbg",
                         logDirPath=logDirPath,mainLog=mainLog,
-                        directives=directives)
+                        directives=directives,jobs=jobs)
 
 # clean? compile sopt
 mainLog.write("====== clean="+str(directives["clean"])+
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 
 import sys
-import re, tempfile
-import os, os.path
+import re, tempfile, errno, itertools, traceback, hashlib
+import os, os.path, shutil
+from cStringIO import StringIO
+import fortranLexer
 import normalizeFortranFile
 import replacer
 import addSynopsis
+import moduleIndex
+import toolsProfile
 from sys import argv
 
 operatorsStr=r"\.(?:and|eqv?|false|g[et]|l[et]|n(?:e(?:|qv)|ot)|or|true)\."
@@ -14,28 +18,35 @@ keywordsStr="(?:a(?:llocat(?:able|e)|ssign(?:|ment))|c(?:a(?:ll|se)|haracter|los
 
 intrinsic_procStr=r"(?:a(?:bs|c(?:har|os)|djust[lr]|i(?:mag|nt)|ll(?:|ocated)|n(?:int|y)|s(?:in|sociated)|tan2?)|b(?:it_size|test)|c(?:eiling|har|mplx|o(?:njg|sh?|unt)|shift)|d(?:ate_and_time|ble|i(?:gits|m)|ot_product|prod)|e(?:oshift|psilon|xp(?:|onent))|f(?:loor|raction)|huge|i(?:a(?:char|nd)|b(?:clr|its|set)|char|eor|n(?:dex|t)|or|shftc?)|kind|l(?:bound|en(?:|_trim)|g[et]|l[et]|og(?:|10|ical))|m(?:a(?:tmul|x(?:|exponent|loc|val))|erge|in(?:|exponent|loc|val)|od(?:|ulo)|vbits)|n(?:earest|int|ot)|p(?:ack|r(?:e(?:cision|sent)|oduct))|r(?:a(?:dix|n(?:dom_(?:number|seed)|ge))|e(?:peat|shape)|rspacing)|s(?:ca(?:le|n)|e(?:lected_(?:int_kind|real_kind)|t_exponent)|hape|i(?:gn|nh?|ze)|p(?:acing|read)|qrt|um|ystem_clock)|t(?:anh?|iny|r(?:ans(?:fer|pose)|im))|u(?:bound|npack)|verify)(?= *\()"
 
-toUpcaseRe=re.compile("(?<![A-Za-z0-9_%#])(?<!% )(?P<toUpcase>"+operatorsStr+
-                      "|"+ keywordsStr +"|"+ intrinsic_procStr +
-                      ")(?![A-Za-z0-9_%])",flags=re.IGNORECASE)
-linePartsRe=re.compile("(?P<commands>[^\"'!]*)(?P<comment>!.*)?"+
-                       "(?P<string>(?P<qchar>[\"']).*?(?P=qchar))?")
+toUpcaseStr=("(?<![A-Za-z0-9_%#])(?<!% )(?P<toUpcase>"+operatorsStr+
+             "|"+ keywordsStr +"|"+ intrinsic_procStr +
+             ")(?![A-Za-z0-9_%])")
+toUpcaseRe=re.compile(toUpcaseStr,flags=re.IGNORECASE)
+# strings, comments and !$ directives (up to the end of the line) are copied
+# verbatim, so that a single scan of the line upcases it
+upcaseScanRe=re.compile("(?P<verbatim>"+fortranLexer.stringStr+"|!.*)|"+
+                        "(?P<openString>[\"'])|"+toUpcaseStr,
+                        flags=re.IGNORECASE)
+
+def upcaseMatch(match):
+    return match.group("toUpcase").upper()
+
+def upcaseScanMatch(match):
+    kind=match.lastgroup
+    if kind=="toUpcase":
+        return match.group().upper()
+    if kind=="openString":
+        raise SyntaxError("Syntax error, open string")
+    return match.group()
 
 def upcaseStringKeywords(line):
     """Upcases the fortran keywords, operators and intrinsic routines
-    in line"""
-    res=""
-    start=0
-    while start<len(line):
-        m=linePartsRe.match(line[start:])
-        if not m: raise SyntaxError("Syntax error, open string")
-        res=res+toUpcaseRe.sub(lambda match: match.group("toUpcase").upper(),
-                               m.group("commands"))
-        if m.group("comment"):
-            res=res+m.group("comment")
-        if m.group("string"):
-            res=res+m.group("string")
-        start=start+m.end()
-    return res
+    in line (but not in strings, comments and !$ directives).
+    The line is scanned once, so the time is linear in its length also for
+    very long lines with many strings"""
+    if not fortranLexer.specialCharRe.search(line):
+        return toUpcaseRe.sub(upcaseMatch,line)
+    return upcaseScanRe.sub(upcaseScanMatch,line)
 
 def upcaseKeywords(infile,outfile,logFile=sys.stdout):
     """Writes infile to outfile with all the fortran keywords upcased"""
@@ -51,136 +62,520 @@ def upcaseKeywords(infile,outfile,logFile=sys.stdout):
         e.text=line
         raise
 
+def runStage(stage,text,*args,**kw):
+    """runs stage(infile,outfile,*args,**kw) on text, and returns the text
+    the stage wrote to outfile"""
+    outfile=StringIO()
+    stage(StringIO(text),outfile,*args,**kw)
+    return outfile.getvalue()
+
+def prettifyString(text,fileName,normalize_use=1, upcase_keywords=1,
+                   interfaces_dir=None,replace=None,logFile=sys.stdout,
+                   changedStages=None,module_index=None,stats=None,
+                   changed_lines=None):
+    """returns the prettified version of the fortran source text, the content
+    of the file fileName (used to find cp_common_uses.h and the interface).
+    The stages are chained in memory.
+    See prettifyFile for the meaning of the options.
+    If changedStages is a list the names of the stages that changed the
+    text are appended to it.
+    If stats is a dictionary the uses and variables removed are counted in
+    it (see normalizeFortranFile.rewriteFortranFile)
+    If changed_lines (a list of (first,last) line ranges) is given only the
+    routines intersecting them are normalized, see
+    normalizeFortranFile.rewriteFortranFile"""
+    stages=[]
+    interfaceFile=None
+    if replace:
+        stages.append(('replace',replacer.replaceWords,(),
+                       {'logFile':logFile}))
+    if normalize_use:
+        index=None
+        if module_index:
+            index=moduleIndex.loadIndex(module_index)
+        stages.append(('normalize-use',normalizeFortranFile.rewriteFortranFile,
+                       (logFile,),{'orig_filename':fileName,
+                                   'moduleIndex':index,'stats':stats,
+                                   'changedLines':changed_lines}))
+    if upcase_keywords:
+        stages.append(('upcase',upcaseKeywords,(logFile,),{}))
+    if interfaces_dir:
+        baseName=os.path.basename(fileName)
+        baseName=baseName[:baseName.rfind(".")]
+        interfacePath=os.path.join(interfaces_dir,baseName+".int")
+        try:
+            interfaceFile=open(interfacePath,"r")
+        except:
+            logFile.write("error opening file "+interfacePath+"\n")
+            logFile.write("skipping addSynopsis step for "+baseName+"\n")
+            interfaceFile=None
+        if interfaceFile:
+            stages.append(('synopsis',
+                           lambda infile,outfile:addSynopsis.addSynopsisToFile(
+                               interfaceFile,infile,outfile,logFile=logFile),
+                           (),{}))
+    try:
+        for (stageName,stage,args,kw) in stages:
+            started=toolsProfile.start()
+            newText=runStage(stage,text,*args,**kw)
+            toolsProfile.stop(stageName,fileName,started,lines=text.count("\n"),
+                              bytesIn=len(text),bytesOut=len(newText))
+            if changedStages is not None and newText!=text:
+                changedStages.append(stageName)
+            text=newText
+    finally:
+        if interfaceFile:
+            interfaceFile.close()
+    return text
+
 def prettifyFile(infile,normalize_use=1, upcase_keywords=1,
-             interfaces_dir=None,replace=None,logFile=sys.stdout):
-    """prettifyes the fortran source in infile into a temporary file that is
-    returned. It can be the same as infile.
+             interfaces_dir=None,replace=None,logFile=sys.stdout,
+             module_index=None):
+    """prettifyes the fortran source in infile into an in memory file that is
+    returned.
     if normalize_use normalizes the use statements (defaults to true)
     if upcase_keywords upcases the keywords (defaults to true)
     if interfaces_dir is defined (and contains the directory with the
     interfaces) updates the synopsis
     if replace does the replacements contained in replacer.py (defaults
     to false)
+    if module_index is the path of a module index (see moduleIndex.py) also
+    the unused uses of whole modules are removed
 
     does not close the input file"""
-    ifile=infile
-    orig_filename=infile.name
-    tmpfile=None
     try:
-        if replace:
-            tmpfile2=os.tmpfile()
-            replacer.replaceWords(ifile,tmpfile2,logFile=logFile)
-            tmpfile2.seek(0)
-            if tmpfile:
-                tmpfile.close()
-            tmpfile=tmpfile2
-            ifile=tmpfile
-        if normalize_use:
-            tmpfile2=os.tmpfile()
-            normalizeFortranFile.rewriteFortranFile(ifile,tmpfile2,logFile,
-                                                    orig_filename=orig_filename)
-            tmpfile2.seek(0)
-            if tmpfile:
-                tmpfile.close()
-            tmpfile=tmpfile2
-            ifile=tmpfile
-        if upcase_keywords:
-            tmpfile2=os.tmpfile()
-            upcaseKeywords(ifile,tmpfile2,logFile)
-            tmpfile2.seek(0)
-            if tmpfile:
-                tmpfile.close()
-            tmpfile=tmpfile2
-            ifile=tmpfile
-        if interfaces_dir:
-            fileName=os.path.basename(infile.name)
-            fileName=fileName[:fileName.rfind(".")]
-            try:
-                interfaceFile=open(os.path.join(interfaces_dir,
-                                                fileName+".int"),"r")
-            except:
-                logFile.write("error opening file "+
-                              os.path.join(interfaces_dir,
-                                           fileName+".int")+"\n")
-                logFile.write("skipping addSynopsis step for "+fileName+"\n")
-                interfaceFile=None
-            if interfaceFile:
-                tmpfile2=os.tmpfile()
-                addSynopsis.addSynopsisToFile(interfaceFile,ifile,
-                                              tmpfile2,logFile=logFile)
-                tmpfile2.seek(0)
-                if tmpfile:
-                    tmpfile.close()
-                tmpfile=tmpfile2
-                ifile=tmpfile
-        return ifile
+        return StringIO(prettifyString(infile.read(),infile.name,
+                                       normalize_use,upcase_keywords,
+                                       interfaces_dir,replace,logFile,
+                                       module_index=module_index))
     except:
         logFile.write("error processing file '"+infile.name+"'\n")
         raise
 
+_toolsVersion=None
+def toolsVersion():
+    """returns a hash of the sources of the tools used by prettify, so that
+    changes to the tools invalidate the cache"""
+    global _toolsVersion
+    if _toolsVersion is None:
+        h=hashlib.sha1()
+        for module in [sys.modules[__name__],fortranLexer,
+                       normalizeFortranFile,replacer,addSynopsis,moduleIndex]:
+            sourceName=os.path.splitext(module.__file__)[0]+".py"
+            f=open(sourceName,'rb')
+            h.update(f.read())
+            f.close()
+        _toolsVersion=h.hexdigest()
+    return _toolsVersion
+
+def fileHash(fileName):
+    """returns the sha1 of the content of fileName, or 'missing' if the file
+    cannot be read"""
+    try:
+        f=open(fileName,'rb')
+    except IOError:
+        return 'missing'
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+# the modules defined or used by a file, the only entries of the module index
+# that its normalization depends on
+moduleNamesRe=re.compile(r"^[ \t]*(?:module|use)[ \t]+([a-zA-Z_][a-zA-Z_0-9]*)",
+                         re.IGNORECASE|re.MULTILINE)
+
+def prettifyCacheKey(fileName,content,normalize_use=1,upcase_keywords=1,
+                     interfaces_dir=None,replace=None,module_index=None):
+    """returns the key identifying the prettification of content (the content
+    of the file fileName) with the given options.
+    Besides the content and the enabled stages the key depends on the version
+    of the tools, on the cp_common_uses.h in the directory of the file (when
+    normalizing the uses), on the module index entries of the modules the
+    file defines or uses (if a module index is given) and on the interface
+    file (when adding synopsis)"""
+    h=hashlib.sha1()
+    h.update(content)
+    h.update("\0%d%d%d%d\0"%(bool(normalize_use),bool(upcase_keywords),
+                              bool(interfaces_dir),bool(replace)))
+    h.update(toolsVersion())
+    if normalize_use:
+        h.update(fileHash(os.path.join(
+            os.path.dirname(os.path.abspath(fileName)),"cp_common_uses.h")))
+        if module_index:
+            if os.path.exists(module_index):
+                index=moduleIndex.loadIndex(module_index)
+                h.update(index.modulesKey(moduleNamesRe.findall(content)))
+            else:
+                h.update('missing')
+    if interfaces_dir:
+        baseName=os.path.basename(fileName)
+        baseName=baseName[:baseName.rfind(".")]
+        h.update(fileHash(os.path.join(interfaces_dir,baseName+".int")))
+    return h.hexdigest()
+
+class PrettifyCache:
+    """An on disk index of the keys (see prettifyCacheKey) of the files that
+    are known to be already in canonical form.
+    The index is a text file with one key per line, new keys are appended
+    by save, and the index is compacted when it grows beyond maxEntries"""
+    def __init__(self,path,maxEntries=50000):
+        self.path=path
+        self.maxEntries=maxEntries
+        self.keys=[]
+        self.known={}
+        self.newKeys=[]
+        if os.path.isfile(path):
+            f=open(path,'r')
+            for line in f:
+                key=line.strip()
+                if key and not self.known.has_key(key):
+                    self.known[key]=1
+                    self.keys.append(key)
+            f.close()
+    def isCanonical(self,key):
+        return self.known.has_key(key)
+    def add(self,key):
+        if not self.known.has_key(key):
+            self.known[key]=1
+            self.keys.append(key)
+            self.newKeys.append(key)
+    def save(self):
+        "writes the new keys to the index"
+        if len(self.keys)>self.maxEntries:
+            self.keys=self.keys[-(self.maxEntries/2):]
+            self.known=dict.fromkeys(self.keys,1)
+            tmpName=self.path+"."+str(os.getpid())
+            f=open(tmpName,'w')
+            f.write("\n".join(self.keys)+"\n")
+            f.close()
+            os.rename(tmpName,self.path)
+        elif self.newKeys:
+            f=open(self.path,'a')
+            f.write("\n".join(self.newKeys)+"\n")
+            f.close()
+        self.newKeys=[]
+
+def openBackupFile(bkDir,fileName):
+    """opens a new backup file for fileName in bkDir.
+    If a backup with the same name exists .1, .2,... are appended.
+    The file is created exclusively so that concurrent processes
+    backing up files with the same name never overwrite each other"""
+    bkName=os.path.join(bkDir,os.path.basename(fileName))
+    bName=bkName
+    i=0
+    while 1:
+        try:
+            fd=os.open(bkName,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0666)
+            return os.fdopen(fd,"w")
+        except OSError, e:
+            if e.errno!=errno.EEXIST:
+                raise
+        i+=1
+        bkName=bName+"."+str(i)
+
+def writeAtomically(fileName,text):
+    """replaces the content of fileName with text, so that readers see either
+    the old or the new content. The permissions of the file are kept"""
+    (fd,tmpName)=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)),
+                                  prefix="."+os.path.basename(fileName))
+    try:
+        tmpFile=os.fdopen(fd,'w')
+        tmpFile.write(text)
+        tmpFile.close()
+        if os.path.exists(fileName):
+            shutil.copymode(fileName,tmpName)
+        os.rename(tmpName,fileName)
+    except:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+
 def prettfyInplace(fileName,bkDir="preprettify",normalize_use=1,
                    upcase_keywords=1, interfaces_dir=None,
-                   replace=None,logFile=sys.stdout):
-    """Same as prettify, but inplace, replaces only if needed"""
+                   replace=None,logFile=sys.stdout,cache=None,
+                   module_index=None,changedStages=None,stats=None,
+                   changed_lines=None):
+    """Same as prettify, but inplace, replaces only if needed.
+    If a PrettifyCache is given files already known to be in canonical form
+    are skipped, and files found to be canonical are added to it (unless
+    only the changed_lines were normalized).
+    changedStages, stats and changed_lines are passed to prettifyString.
+    Returns true if the file was changed"""
     if not os.path.exists(bkDir):
-        os.mkdir(bkDir)
+        try:
+            os.mkdir(bkDir)
+        except OSError:
+            if not os.path.isdir(bkDir): raise
     if not os.path.isdir(bkDir):
         raise Error("bk-dir must be a directory, was "+bkDir)
     infile=open(fileName,'r')
-    outfile=prettifyFile(infile, normalize_use,
-                         upcase_keywords, interfaces_dir, replace)
-    if (infile==outfile):
-        return
-    infile.seek(0)
-    outfile.seek(0)
-    same=1
-    while 1:
-        l1=outfile.readline()
-        l2=infile.readline()
-        if (l1!=l2):
-            same=0
-            break
-        if not l1:
-            break
-    if (not same):
-        bkName=os.path.join(bkDir,os.path.basename(fileName))
-        bName=bkName
-        i=0
-        while os.path.exists(bkName):
-            i+=1
-            bkName=bName+"."+str(i)
-        infile.seek(0)
-        bkFile=file(bkName,"w")
-        while 1:
-            l1=infile.readline()
-            if not l1: break
-            bkFile.write(l1)
-        bkFile.close()
-        outfile.seek(0)
-        newFile=file(fileName,'w')
-        while 1:
-            l1=outfile.readline()
-            if not l1: break
-            newFile.write(l1)
-        newFile.close()
+    text=infile.read()
+    infile.close()
+    if cache:
+        cacheKey=prettifyCacheKey(fileName,text,normalize_use,
+                                  upcase_keywords,interfaces_dir,replace,
+                                  module_index)
+        if cache.isCanonical(cacheKey):
+            return 0
+    try:
+        newText=prettifyString(text,fileName,normalize_use,upcase_keywords,
+                               interfaces_dir,replace,logFile,
+                               changedStages=changedStages,
+                               module_index=module_index,stats=stats,
+                               changed_lines=changed_lines)
+    except:
+        logFile.write("error processing file '"+fileName+"'\n")
+        raise
+    if newText==text:
+        if cache and changed_lines is None:
+            cache.add(cacheKey)
+        return 0
+    bkFile=openBackupFile(bkDir,fileName)
+    bkFile.write(text)
+    bkFile.close()
+    writeAtomically(fileName,newText)
+    return 1
+
+def checkFile(fileName,normalize_use=1,upcase_keywords=1,interfaces_dir=None,
+              replace=None,logFile=sys.stdout,module_index=None,
+              changedStages=None,stats=None,changed_lines=None):
+    """Prettifies fileName in memory, without writing anything.
+    changedStages, stats and changed_lines are passed to prettifyString.
+    Returns true if prettify would change the file"""
+    infile=open(fileName,'r')
+    text=infile.read()
     infile.close()
-    outfile.close()
+    try:
+        newText=prettifyString(text,fileName,normalize_use,upcase_keywords,
+                               interfaces_dir,replace,logFile,
+                               changedStages=changedStages,
+                               module_index=module_index,stats=stats,
+                               changed_lines=changed_lines)
+    except:
+        logFile.write("error processing file '"+fileName+"'\n")
+        raise
+    return newText!=text
+
+def prettifyWorker(job):
+    """prettifies a single file, suitable to be mapped over a process pool.
+    job is a tuple (fileName,bkDir,options,check) where options is a
+    dictionary with the keyword arguments of prettfyInplace, if check is
+    true the file is only checked (see checkFile).
+    Returns a tuple (fileName,status,log,info) where status is one of
+    'changed', 'unchanged', 'cached', 'missing' or 'failed', log
+    contains all the output generated while processing the file and info
+    is a dictionary with the changedStages and the stats of the file (and
+    the profile records if profiling is enabled, see toolsProfile)"""
+    (fileName,bkDir,options,check)=job
+    logFile=StringIO()
+    info={'changedStages':[],'removedUse':0,'removedVar':0}
+    if not os.path.isfile(fileName):
+        logFile.write("file "+fileName+" does not exists!\n")
+        return (fileName,'missing',logFile.getvalue(),info)
+    # the tools also print directly to stdout, capture it in the log
+    oldStdout=sys.stdout
+    sys.stdout=logFile
+    try:
+        try:
+            if check:
+                changed=checkFile(fileName,logFile=logFile,
+                                  changedStages=info['changedStages'],
+                                  stats=info,**options)
+            else:
+                changed=prettfyInplace(fileName,bkDir,logFile=logFile,
+                                       changedStages=info['changedStages'],
+                                       stats=info,**options)
+            if changed:
+                status='changed'
+            else:
+                status='unchanged'
+        except:
+            status='failed'
+            logFile.write('-'*60+"\n")
+            traceback.print_exc(file=logFile)
+            logFile.write('-'*60+"\n")
+            logFile.write("Processing file '"+fileName+"'\n")
+    finally:
+        sys.stdout=oldStdout
+    if toolsProfile.enabled:
+        info['profile']=toolsProfile.takeRecords()
+    return (fileName,status,logFile.getvalue(),info)
+
+def prettifyFiles(fileNames,bkDir="preprettify",jobs=1,logFile=sys.stdout,
+                  cacheFile=None,check=0,report=None,lineRanges=None,
+                  **options):
+    """prettifies inplace the files in fileNames using jobs processes.
+    options are passed to prettfyInplace.
+    If lineRanges is a dictionary, the files that are in it are normalized
+    only in the routines intersecting the line ranges it gives for them
+    (the changed_lines option of prettfyInplace), and are never added to the
+    cache.
+    If cacheFile is given it is used as PrettifyCache index, files that are
+    known to be in canonical form are not processed (status 'cached').
+    If check is true the files are only checked: nothing is written (not
+    even the backup dir or the cache) and 'changed' means that the file
+    would be changed.
+    The log of each file is written to logFile in the order of fileNames,
+    independently of the order in which the files are processed.
+    If report is a list, a dictionary with file, status, wouldChange,
+    changedStages, removedUse and removedVar is appended to it for each file.
+    Returns a list of (fileName,status) tuples (see prettifyWorker)"""
+    if not check:
+        if not os.path.exists(bkDir):
+            os.mkdir(bkDir)
+        if not os.path.isdir(bkDir):
+            raise Exception("bk-dir must be a directory, was "+bkDir)
+    cache=None
+    cacheKeys={}
+    if cacheFile:
+        cache=PrettifyCache(cacheFile)
+    jobList=[]
+    for fileName in fileNames:
+        if cache and os.path.isfile(fileName):
+            f=open(fileName,'r')
+            cacheKeys[fileName]=prettifyCacheKey(fileName,f.read(),**options)
+            f.close()
+            if cache.isCanonical(cacheKeys[fileName]):
+                continue
+        if lineRanges and lineRanges.has_key(fileName):
+            jobList.append((fileName,bkDir,
+                            dict(options,changed_lines=lineRanges[fileName]),
+                            check))
+        else:
+            jobList.append((fileName,bkDir,options,check))
+    pool=None
+    if jobs>1 and len(jobList)>1:
+        import multiprocessing
+        pool=multiprocessing.Pool(min(jobs,len(jobList)))
+        results=pool.imap(prettifyWorker,jobList)
+    else:
+        results=itertools.imap(prettifyWorker,jobList)
+    statuses={}
+    infos={}
+    try:
+        for (fileName,status,log,info) in results:
+            logFile.write(log)
+            logFile.flush()
+            statuses[fileName]=status
+            infos[fileName]=info
+            if info.has_key('profile'):
+                toolsProfile.addRecords(info['profile'])
+            if (cache and status=='unchanged' and not check and
+                not (lineRanges and lineRanges.has_key(fileName))):
+                cache.add(cacheKeys[fileName])
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if cache and not check:
+            cache.save()
+    if report is not None:
+        for fileName in fileNames:
+            status=statuses.get(fileName,'cached')
+            info=infos.get(fileName,{})
+            report.append({'file':fileName,'status':status,
+                           'wouldChange':status=='changed',
+                           'changedStages':info.get('changedStages',[]),
+                           'removedUse':info.get('removedUse',0),
+                           'removedVar':info.get('removedVar',0)})
+    return [(fileName,statuses.get(fileName,'cached'))
+            for fileName in fileNames]
+
+def parseLineRanges(rangesStr):
+    """parses a comma separated list of line ranges (like 10-20,35) and
+    returns a list of (first,last) tuples"""
+    ranges=[]
+    for rangeStr in rangesStr.split(","):
+        m=re.match(r" *([0-9]+) *(?:- *([0-9]+))? *$",rangeStr)
+        if not m:
+            raise ValueError("invalid line range "+repr(rangeStr))
+        first=int(m.group(1))
+        last=first
+        if m.group(2):
+            last=int(m.group(2))
+        ranges.append((first,last))
+    return ranges
+
+hunkRe=re.compile(r"^@@ -[0-9,]+ \+(?P<start>[0-9]+)(?:,(?P<count>[0-9]+))? @@",
+                  re.MULTILINE)
+
+def gitChangedLines(fileName,rev="HEAD"):
+    """returns the line ranges of fileName that changed with respect to the
+    git revision rev (the hunks of git diff), or None if the file is not
+    tracked by git (so that it is prettified completely)"""
+    import subprocess
+    dirName=os.path.dirname(os.path.abspath(fileName))
+    baseName=os.path.basename(fileName)
+    p=subprocess.Popen(["git","ls-files","--error-unmatch",baseName],
+                       cwd=dirName,stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+    p.communicate()
+    if p.returncode:
+        return None
+    p=subprocess.Popen(["git","diff","-U0","--no-color","--no-ext-diff",rev,
+                        "--",baseName],cwd=dirName,stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+    (out,err)=p.communicate()
+    if p.returncode:
+        raise Exception("git diff failed for "+fileName+": "+err)
+    ranges=[]
+    for m in hunkRe.finditer(out):
+        start=int(m.group('start'))
+        count=1
+        if m.group('count') is not None:
+            count=int(m.group('count'))
+        if count==0:
+            # only removed lines, between start and start+1
+            ranges.append((start,start+1))
+        else:
+            ranges.append((start,start+count-1))
+    return ranges
 
-                   
 if __name__ == '__main__':
     defaultsDict={'upcase':1,'normalize-use':1,'replace':1,
-                  'interface-dir':None,
-                  'backup-dir':'preprettify'}
+                  'interface-dir':None,'cache':1,'cache-file':None,
+                  'backup-dir':'preprettify','jobs':1,'module-index':None,
+                  'check':0,'report':'-','lines':None,'git-diff':None,
+                  'interface-store':None,'profile':None,'profile-regex':0}
     usageDesc=("usage:\n"+sys.argv[0]+ """
     [--[no-]upcase] [--[no-]normalize-use] [--[no-]replace]
     [--interface-dir=~/cp2k/obj/platform/target] [--help]
-    [--backup-dir=bk_dir] file1 [file2 ...]
+    [--interface-store=bk_dir/interfaces]
+    [--backup-dir=bk_dir] [--jobs=N] [--[no-]cache]
+    [--cache-file=bk_dir/prettify.cache] [--module-index=file]
+    [--check] [--report=file] [--lines=first-last[,...]]
+    [--git-diff[=rev]] [--profile=file] [--profile-regex] file1 [file2 ...]
 
     replaces file1,... with their prettified version after performing on
     them upcase of the fortran keywords, and normalizion the use statements.
     If the interface direcory is given updates also the synopsis.
+    The parsed interfaces are kept in the --interface-store directory
+    (bk_dir/interfaces if the cache is used), and parsed again only when
+    the .int file changes.
     If requested the replacements performed by the replacer.py script
     are also preformed.
+    With --jobs=N the files are processed by N parallel processes.
+    Unless --no-cache is given files already known to be in canonical form
+    (with the same tools, options, cp_common_uses.h and interface) are
+    skipped.
+    With --module-index the given module index (see moduleIndex.py) is
+    updated with the directories of the files, and used to remove also the
+    unused USE statements of whole modules.
+    With --check nothing is written, a json report with the files that
+    would be changed (and by which stages) is written to the --report file
+    (stdout by default, the log then goes to stderr). The exit status is
+    non zero if a file would change or fails. The module index is used but
+    not updated.
+    With --lines only the declarations of the routines containing the given
+    lines are normalized (and the module uses only if the lines touch the
+    module header), with --git-diff the lines changed with respect to the
+    given git revision (HEAD by default) are used for each file. The rest of
+    the file is copied verbatim by the normalization, the other stages are
+    applied to the whole file.
+    With --profile the time, lines and bytes of each stage on each file are
+    written to the given json file (see toolsProfile.py), --profile-regex
+    counts also the regexp calls (slowing down the tools).
     """+str(defaultsDict))
     
     replace=None
@@ -189,42 +584,108 @@ if __name__ == '__main__':
         sys.exit(0)
     args=[]
     for arg in sys.argv[1:]:
-        m=re.match(r"--(no-)?(normalize-use|upcase|replace)",arg)
+        m=re.match(r"--(no-)?(normalize-use|upcase|replace|cache|check|profile-regex)$",arg)
         if m:
             defaultsDict[m.groups()[1]]=not m.groups()[0]
         else:
-            m=re.match(r"--(interface-dir|backup-dir)=(.*)",arg)
+            m=re.match(r"--(interface-dir|interface-store|backup-dir|cache-file|module-index|report|profile)=(.*)",arg)
             if m:
-                path=os.path.abspath(os.path.expanduser(m.groups()[1]))
+                path=m.groups()[1]
+                if path!='-':
+                    path=os.path.abspath(os.path.expanduser(path))
                 defaultsDict[m.groups()[0]]=path
             else:
-                args.append(arg)
+                m=re.match(r"--jobs=([0-9]+)$",arg)
+                if m:
+                    defaultsDict['jobs']=int(m.groups()[0])
+                    continue
+                m=re.match(r"--lines=(.*)$",arg)
+                if m:
+                    defaultsDict['lines']=parseLineRanges(m.groups()[0])
+                    continue
+                m=re.match(r"--git-diff(?:=(.+))?$",arg)
+                if m:
+                    defaultsDict['git-diff']=m.groups()[0] or "HEAD"
+                else:
+                    args.append(arg)
     if len(args)<1:
         print usageDesc
     else:
         bkDir=defaultsDict['backup-dir']
-        if not os.path.exists(bkDir):
+        check=defaultsDict['check']
+        if defaultsDict['profile']:
+            toolsProfile.enable(defaultsDict['profile'],
+                                defaultsDict['profile-regex'])
+        if not check and not os.path.exists(bkDir):
             os.mkdir(bkDir)
-        if not os.path.isdir(bkDir):
+        if not check and not os.path.isdir(bkDir):
             print "bk-dir must be a directory"
             print usageDesc
         else:
-            failure=0
-            for fileName in args:
-                if not os.path.isfile(fileName):
-                    print "file",fileName,"does not exists!"
-                else:
-                    try:
-                        prettfyInplace(fileName,bkDir,
+            cacheFile=None
+            if defaultsDict['cache']:
+                cacheFile=defaultsDict['cache-file']
+                if not cacheFile:
+                    cacheFile=os.path.join(bkDir,"prettify.cache")
+            storeDir=defaultsDict['interface-store']
+            if (not storeDir and defaultsDict['interface-dir'] and
+                defaultsDict['cache'] and not check):
+                storeDir=os.path.join(bkDir,"interfaces")
+            if storeDir and defaultsDict['interface-dir']:
+                # --check leaves the files (and the store) untouched
+                addSynopsis.interfaceStore=addSynopsis.InterfaceStore(
+                    storeDir,readOnly=check)
+            if defaultsDict['module-index'] and not check:
+                index=moduleIndex.ModuleIndex(defaultsDict['module-index'])
+                dirs={}
+                for fileName in args:
+                    dirs[os.path.dirname(os.path.abspath(fileName))]=1
+                for dirName in dirs.keys():
+                    index.updateDir(dirName)
+                index.save()
+            lineRanges=None
+            if defaultsDict['lines'] is not None:
+                lineRanges=dict.fromkeys(args,defaultsDict['lines'])
+            elif defaultsDict['git-diff']:
+                lineRanges={}
+                for fileName in args:
+                    ranges=gitChangedLines(fileName,defaultsDict['git-diff'])
+                    if ranges is not None:
+                        lineRanges[fileName]=ranges
+            logFile=sys.stdout
+            report=None
+            if check:
+                report=[]
+                if defaultsDict['report']=='-':
+                    logFile=sys.stderr
+            statuses=prettifyFiles(args,bkDir,jobs=defaultsDict['jobs'],
+                                   logFile=logFile,cacheFile=cacheFile,
+                                   check=check,report=report,
+                                   lineRanges=lineRanges,
                                    normalize_use=defaultsDict['normalize-use'],
                                    upcase_keywords=defaultsDict['upcase'],
                                    interfaces_dir=defaultsDict['interface-dir'],
-                                   replace=defaultsDict['replace'])
-                    except:
-                        failure+=1
-                        import traceback
-                        sys.stdout.write('-'*60+"\n")
-                        traceback.print_exc(file=sys.stdout)
-                        sys.stdout.write('-'*60+"\n")
-                        sys.stdout.write("Processing file '"+fileName+"'\n")
+                                   replace=defaultsDict['replace'],
+                                   module_index=defaultsDict['module-index'])
+            failure=0
+            for (fileName,status) in statuses:
+                if status=='failed': failure+=1
+            if check:
+                import json
+                summary={'files':len(report),'failed':failure,
+                         'wouldChange':0,'removedUse':0,'removedVar':0}
+                for entry in report:
+                    summary['wouldChange']+=entry['wouldChange']
+                    summary['removedUse']+=entry['removedUse']
+                    summary['removedVar']+=entry['removedVar']
+                if defaultsDict['report']=='-':
+                    reportFile=sys.stdout
+                else:
+                    reportFile=open(defaultsDict['report'],'w')
+                json.dump({'summary':summary,'files':report},reportFile,
+                          indent=1,sort_keys=True)
+                reportFile.write("\n")
+                if reportFile is not sys.stdout:
+                    reportFile.close()
+                failure+=summary['wouldChange']
             sys.exit(failure>0)
@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+"""Long running prettify process, for editors and pre-commit hooks.
+
+Starting prettify.py costs the python startup, the import of the tools and
+the compilation of their regular expressions, which is much more than the
+time needed to prettify a single file. The server pays this only once, and
+keeps also the module index and the parsed interfaces in memory.
+
+The protocol is line based: every request is a json object on a single
+line, and gets a json object on a single line as answer.
+A request looks like
+  {"file":"path/to/file.F", "action":"format"}
+where action is one of
+  format   returns the prettified text in "text" (the default)
+  diff     returns a unified diff in "diff"
+  inplace  prettifies the file inplace (with backup in the backup dir)
+  ping     just answers {"status":"ok"}
+  shutdown stops the server
+The file content can be given in "text" (the file name is still used to find
+cp_common_uses.h and the interface), and the options of prettify can be
+overridden with the keys normalize_use, upcase_keywords, replace,
+interfaces_dir, module_index and changed_lines (a list of [first,last] line
+ranges, to normalize only the routines that contain them).
+The answer contains "status" ('changed', 'unchanged', 'failed', 'missing'
+or 'ok'), "log" with the messages of the tools and "changedStages".
+The sources are handled as bytes: in the json strings every character
+stands for the byte with the same code (latin-1).
+
+The server reads the requests from stdin (and answers on stdout), or with
+--socket=path listens on a unix socket. With --client a request for each
+file is sent to the socket, and the result written on stdout.
+"""
+
+import sys
+import os, os.path
+import socket
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class PrettifyServer:
+    """Handles the prettify requests, keeping the tools loaded"""
+    def __init__(self,bkDir="preprettify",**options):
+        import prettify, addSynopsis, moduleIndex
+        self.prettify=prettify
+        self.bkDir=bkDir
+        self.options={'normalize_use':1,'upcase_keywords':1,'replace':None,
+                      'interfaces_dir':None,'module_index':None,
+                      'changed_lines':None}
+        self.options.update(options)
+        addSynopsis.interfaceCache={}
+        if self.options['module_index'] and os.path.exists(self.options['module_index']):
+            moduleIndex.loadIndex(self.options['module_index'])
+        self.running=1
+
+    def handle(self,request):
+        """Returns the answer (a dictionary) to request (a dictionary)"""
+        action=request.get('action','format')
+        if action=='ping':
+            return {'status':'ok'}
+        if action=='shutdown':
+            self.running=0
+            return {'status':'ok'}
+        if action not in ('format','diff','inplace'):
+            return {'status':'failed','log':'unknown action '+repr(action)+'\n'}
+        fileName=request.get('file')
+        if not fileName:
+            return {'status':'failed','log':'no file given\n'}
+        fileName=os.path.abspath(fileName)
+        options=dict(self.options)
+        for key in options.keys():
+            if request.has_key(key): options[key]=request[key]
+        from cStringIO import StringIO
+        import traceback
+        logFile=StringIO()
+        answer={'changedStages':[]}
+        # the tools also print directly to stdout, keep the protocol clean
+        oldStdout=sys.stdout
+        sys.stdout=logFile
+        try:
+            try:
+                if action=='inplace':
+                    if not os.path.isfile(fileName):
+                        answer['status']='missing'
+                    elif self.prettify.prettfyInplace(fileName,self.bkDir,
+                                                      logFile=logFile,**options):
+                        answer['status']='changed'
+                    else:
+                        answer['status']='unchanged'
+                else:
+                    text=request.get('text')
+                    if text is None:
+                        if not os.path.isfile(fileName):
+                            answer['status']='missing'
+                            return answer
+                        f=open(fileName,'r')
+                        text=f.read()
+                        f.close()
+                    else:
+                        text=text.encode('latin-1')
+                    newText=self.prettify.prettifyString(
+                        text,fileName,logFile=logFile,
+                        changedStages=answer['changedStages'],**options)
+                    if newText==text:
+                        answer['status']='unchanged'
+                    else:
+                        answer['status']='changed'
+                    if action=='format':
+                        answer['text']=newText
+                    else:
+                        import difflib
+                        answer['diff']="".join(difflib.unified_diff(
+                            text.splitlines(1),newText.splitlines(1),
+                            fileName,fileName))
+            except:
+                answer['status']='failed'
+                logFile.write('-'*60+"\n")
+                traceback.print_exc(file=logFile)
+                logFile.write('-'*60+"\n")
+                logFile.write("Processing file '"+fileName+"'\n")
+        finally:
+            sys.stdout=oldStdout
+            answer['log']=logFile.getvalue()
+        return answer
+
+    def handleLine(self,line):
+        """Returns the answer (a json line) to the request line"""
+        try:
+            request=json.loads(line)
+        except ValueError, e:
+            return json.dumps({'status':'failed',
+                               'log':'invalid request: '+str(e)+'\n'})+"\n"
+        return json.dumps(self.handle(request),encoding='latin-1')+"\n"
+
+    def serveStream(self,inFile,outFile):
+        """Answers the requests read from inFile on outFile until the end of
+        inFile or a shutdown request"""
+        while self.running:
+            line=inFile.readline()
+            if not line: break
+            if not line.strip(): continue
+            outFile.write(self.handleLine(line))
+            outFile.flush()
+
+    def serveSocket(self,path):
+        """Answers the requests of the connections to the unix socket path,
+        until a shutdown request. A connection that fails is logged on
+        stderr and dropped"""
+        if os.path.exists(path):
+            os.remove(path)
+        sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(5)
+        try:
+            while self.running:
+                (conn,address)=sock.accept()
+                connFile=conn.makefile('rw')
+                try:
+                    try:
+                        self.serveStream(connFile,connFile)
+                    finally:
+                        try:
+                            connFile.close()
+                        finally:
+                            conn.close()
+                except (socket.error,IOError), e:
+                    # the client went away, serve the next connection
+                    sys.stderr.write("connection failed: "+str(e)+"\n")
+        finally:
+            sock.close()
+            os.remove(path)
+
+def sendRequests(path,requests):
+    """Sends the requests (dictionaries) to the server listening on the unix
+    socket path, and returns the answers"""
+    sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    sock.connect(path)
+    connFile=sock.makefile('rw')
+    answers=[]
+    try:
+        for request in requests:
+            connFile.write(json.dumps(request,encoding='latin-1')+"\n")
+            connFile.flush()
+            answers.append(json.loads(connFile.readline()))
+    finally:
+        connFile.close()
+        sock.close()
+    return answers
+
+if __name__ == '__main__':
+    usageDesc=("usage:\n"+sys.argv[0]+ """
+    [--socket=path] [--backup-dir=bk_dir] [--[no-]upcase] [--[no-]normalize-use]
+    [--[no-]replace] [--interface-dir=dir] [--module-index=file]
+
+    serves prettify requests (see the documentation of this module) on stdin
+    or on the given unix socket.
+
+    """+sys.argv[0]+""" --client --socket=path [--action=format|diff|inplace]
+    file1 [file2 ...]
+
+    sends the files to the server on the given socket and writes the result
+    to stdout (the messages of the tools go to stderr).
+    """)
+    import re
+    defaultsDict={'upcase':1,'normalize-use':1,'replace':1,
+                  'interface-dir':None,'module-index':None,
+                  'backup-dir':'preprettify','socket':None,'action':'format'}
+    client=0
+    args=[]
+    for arg in sys.argv[1:]:
+        m=re.match(r"--(no-)?(normalize-use|upcase|replace)$",arg)
+        if m:
+            defaultsDict[m.groups()[1]]=not m.groups()[0]
+            continue
+        m=re.match(r"--(interface-dir|backup-dir|module-index|socket)=(.*)",arg)
+        if m:
+            path=os.path.abspath(os.path.expanduser(m.groups()[1]))
+            defaultsDict[m.groups()[0]]=path
+            continue
+        m=re.match(r"--action=(format|diff|inplace)$",arg)
+        if m:
+            defaultsDict['action']=m.groups()[0]
+        elif arg=="--client":
+            client=1
+        elif arg=="--help" or arg.startswith("-"):
+            print usageDesc
+            sys.exit(arg!="--help")
+        else:
+            args.append(arg)
+    if client:
+        if not defaultsDict['socket'] or not args:
+            print usageDesc
+            sys.exit(1)
+        failure=0
+        answers=sendRequests(defaultsDict['socket'],
+                             [{'file':os.path.abspath(fileName),
+                               'action':defaultsDict['action']}
+                              for fileName in args])
+        for answer in answers:
+            sys.stderr.write(answer.get('log','').encode('latin-1'))
+            if answer['status'] in ('failed','missing'): failure=1
+            if answer.has_key('text'):
+                sys.stdout.write(answer['text'].encode('latin-1'))
+            elif answer.has_key('diff'):
+                sys.stdout.write(answer['diff'].encode('latin-1'))
+        sys.exit(failure)
+    if args:
+        print usageDesc
+        sys.exit(1)
+    server=PrettifyServer(defaultsDict['backup-dir'],
+                          normalize_use=defaultsDict['normalize-use'],
+                          upcase_keywords=defaultsDict['upcase'],
+                          replace=defaultsDict['replace'],
+                          interfaces_dir=defaultsDict['interface-dir'],
+                          module_index=defaultsDict['module-index'])
+    if defaultsDict['socket']:
+        server.serveSocket(defaultsDict['socket'])
+    else:
+        server.serveStream(sys.stdin,sys.stdout)
@@ -1,7 +1,13 @@
 #! /usr/bin/env python
+"""Replaces words (and general regular expressions) in fortran files.
+
+All the word replacements are compiled in a single regular expression (an
+alternation factored on the common prefixes of the words), so that a file is
+scanned once, whatever the number of words to replace."""
 
 import re
 import sys
+import os, os.path
 
 repl={
     'routine_name':'routineN',
@@ -10,40 +16,235 @@ repl={
 specialRepl=None
 # { re.compile(r"(.*:: *moduleN) *= *(['\"])[a-zA-Z_0-9]+\2",flags=re.IGNORECASE):r"character(len=*), parameter :: moduleN = '__MODULE_NAME__'" }
 
+wordRe=re.compile(r"\w+\Z")
+
+def trieRegexp(words):
+    """Returns a regular expression (as string) that matches exactly the
+    given words, the alternatives are factored on their common prefixes so
+    that matching does not depend on the number of words"""
+    trie={}
+    for word in words:
+        node=trie
+        for c in word:
+            node=node.setdefault(c,{})
+        node['']=None
+    def nodeRegexp(node):
+        alternatives=[]
+        lastChars=[]
+        for c in sorted(node.keys()):
+            if not c:
+                continue
+            if node[c].keys()==['']:
+                lastChars.append(re.escape(c))
+            else:
+                alternatives.append(re.escape(c)+nodeRegexp(node[c]))
+        if len(lastChars)==1:
+            alternatives.append(lastChars[0])
+        elif lastChars:
+            alternatives.append("["+"".join(lastChars)+"]")
+        if not alternatives:
+            return ""
+        if len(alternatives)==1 and not node.has_key(''):
+            return alternatives[0]
+        res="(?:"+"|".join(alternatives)+")"
+        if node.has_key(''):
+            res+="?"
+        return res
+    return nodeRegexp(trie)
+
+class Replacer:
+    """Performs a set of word and regexp replacements in a single pass.
+
+    replacements is a dictionary with the words to replace (only whole words
+    are replaced), specialReplacements is a dictionary from compiled regexps
+    to their replacement. The regexps are applied line by line (in the
+    order of the dictionary) before the words are replaced"""
+    def __init__(self,replacements=repl,specialReplacements=specialRepl):
+        for word in replacements.keys():
+            if not wordRe.match(word):
+                raise ValueError("replaced words should match \\w+, not "+
+                                 repr(word))
+        self.replacements=dict(replacements)
+        self.specialReplacements=[]
+        if specialReplacements:
+            self.specialReplacements=specialReplacements.items()
+        self.wordsRe=None
+        if self.replacements:
+            self.wordsRe=re.compile(r"\b"+
+                                    trieRegexp(self.replacements.keys())+
+                                    r"\b")
+
+    def replace(self,text,hits=None):
+        """Returns text with the replacements performed.
+        If hits is a dictionary the number of replacements of each word
+        (or regexp pattern) is added to it"""
+        if self.specialReplacements:
+            lines=text.split("\n")
+            for i in xrange(len(lines)-1):
+                lines[i]+="\n"
+            for (subs,replacement) in self.specialReplacements:
+                nHits=0
+                for i in xrange(len(lines)):
+                    (lines[i],n)=subs.subn(replacement,lines[i])
+                    nHits+=n
+                if hits is not None and nHits:
+                    hits[subs.pattern]=hits.get(subs.pattern,0)+nHits
+            text="".join(lines)
+        if self.wordsRe is None:
+            return text
+        replacements=self.replacements
+        if hits is None:
+            return self.wordsRe.sub(lambda m:replacements[m.group()],text)
+        def replaceWord(m):
+            word=m.group()
+            hits[word]=hits.get(word,0)+1
+            return replacements[word]
+        return self.wordsRe.sub(replaceWord,text)
+
+    def replaceFile(self,infile,outfile,hits=None):
+        """Reads infile and writes it with the replacements performed to
+        outfile"""
+        outfile.write(self.replace(infile.read(),hits))
+
+_replacers={}
+def cachedReplacer(replacements=repl,specialReplacements=specialRepl):
+    """Returns a Replacer for the given replacements, reusing the ones
+    already built"""
+    specials=()
+    if specialReplacements:
+        specials=tuple([(subs.pattern,subs.flags,replacement)
+                        for (subs,replacement) in specialReplacements.items()])
+    key=(tuple(sorted(replacements.items())),specials)
+    replacer=_replacers.get(key)
+    if replacer is None:
+        if len(_replacers)>=20:
+            _replacers.clear()
+        replacer=Replacer(replacements,specialReplacements)
+        _replacers[key]=replacer
+    return replacer
+
 def replaceWords(infile,outfile,replacements=repl,
                  specialReplacements=specialRepl,
                  logFile=sys.stdout):
     """Replaces the words in infile writing the output to outfile.
-    
+
     replacements is a dictionary with the words to replace.
     specialReplacements is a dictionary with general regexp replacements.
     """
-    lineNr=0
-    nonWordRe=re.compile(r"(\W+)")
-    
-    while 1:
-        line= infile.readline()
-        lineNr=lineNr+1
-        if not line: break
-        
-        if specialReplacements:
-            for subs in specialReplacements.keys():
-                line=subs.sub(specialReplacements[subs],line)
-                
-        tokens=nonWordRe.split(line)
-        for token in tokens:
-            if replacements.has_key(token):
-                outfile.write(replacements[token])
-            else:
-                outfile.write(token)
-        
+    cachedReplacer(replacements,specialReplacements).replaceFile(infile,outfile)
 
-if __name__ == '__main__':
-    if len(sys.argv)<2:
-        print "usage:", sys.argv[0]," file_in file_out"
+def readReplacements(fileName):
+    """Reads a file with a replacement per line ('old new', empty lines and
+    lines starting with # are skipped) and returns them as dictionary"""
+    replacements={}
+    f=open(fileName,'r')
+    try:
+        lineNr=0
+        for line in f:
+            lineNr+=1
+            fields=line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields)!=2:
+                raise SyntaxError("expected 'old new' at line %d of %s"%
+                                  (lineNr,fileName))
+            replacements[fields[0]]=fields[1]
+    finally:
+        f.close()
+    return replacements
+
+_workerReplacer=None
+def replaceFileWorker(fileName):
+    """Performs inplace the replacements of _workerReplacer in fileName.
+    Returns (fileName,hits)"""
+    import tempfile, shutil
+    f=open(fileName,'r')
+    text=f.read()
+    f.close()
+    hits={}
+    newText=_workerReplacer.replace(text,hits)
+    if newText!=text:
+        (fd,tmpName)=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)),
+                                      prefix="."+os.path.basename(fileName))
+        try:
+            tmpFile=os.fdopen(fd,'w')
+            tmpFile.write(newText)
+            tmpFile.close()
+            shutil.copymode(fileName,tmpName)
+            os.rename(tmpName,fileName)
+        except:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+    return (fileName,hits)
+
+def replaceFiles(fileNames,replacer,jobs=1,logFile=sys.stdout):
+    """Performs inplace the replacements of replacer in the files fileNames
+    using jobs processes, and writes the number of replacements in each
+    changed file to logFile.
+    Returns a dictionary with the total number of replacements of each word"""
+    global _workerReplacer
+    import itertools
+    _workerReplacer=replacer
+    pool=None
+    if jobs>1 and len(fileNames)>1:
+        import multiprocessing
+        pool=multiprocessing.Pool(min(jobs,len(fileNames)))
+        results=pool.imap(replaceFileWorker,fileNames)
     else:
-        infile=open(sys.argv[1],'r')
-        outfile=open(sys.argv[2],'w')
-        replaceWords(infile,outfile,replacements=repl,
-                     specialReplacements=specialRepl)
+        results=itertools.imap(replaceFileWorker,fileNames)
+    totalHits={}
+    try:
+        for (fileName,hits) in results:
+            if hits:
+                logFile.write("%s: %d replacements (%s)\n"%
+                    (fileName,sum(hits.values()),
+                     ", ".join(["%s:%d"%item for item in sorted(hits.items())])))
+            for (word,n) in hits.items():
+                totalHits[word]=totalHits.get(word,0)+n
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return totalHits
+
+if __name__ == '__main__':
+    usageDesc=("usage:\n"+sys.argv[0]+""" file_in file_out
+    """+sys.argv[0]+""" --inplace [--replacements=file] [--jobs=N] file1 [file2 ...]
 
+    performs the replacements of replacer.py (or the 'old new' pairs of the
+    --replacements file) on file_in writing file_out, or with --inplace on
+    the given files (using N parallel processes), reporting the number of
+    replacements of each changed file.
+    """)
+    inplace=0
+    jobs=1
+    replacements=repl
+    args=[]
+    for arg in sys.argv[1:]:
+        m=re.match(r"--jobs=([0-9]+)$",arg)
+        if m:
+            jobs=int(m.groups()[0])
+            continue
+        m=re.match(r"--replacements=(.+)$",arg)
+        if m:
+            replacements=readReplacements(m.groups()[0])
+        elif arg=="--inplace":
+            inplace=1
+        elif arg.startswith("-"):
+            print usageDesc
+            sys.exit(arg!="--help")
+        else:
+            args.append(arg)
+    if inplace and args:
+        totalHits=replaceFiles(args,Replacer(replacements,specialRepl),jobs)
+        print "%d replacements" % sum(totalHits.values())
+    elif len(args)==2:
+        infile=open(args[0],'r')
+        outfile=open(args[1],'w')
+        replaceWords(infile,outfile,replacements=replacements,
+                     specialReplacements=specialRepl)
+        outfile.close()
+    else:
+        print usageDesc
+        sys.exit(1)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# checks that fortranXref indexes the modules, uses and calls of a source tree
+
+import unittest, os, os.path, shutil, tempfile
+import fortranXref
+
+moduleSrc="""MODULE kinds
+  IMPLICIT NONE
+  PRIVATE
+  INTEGER, PARAMETER, PUBLIC :: dp=8
+  CLASS(*), POINTER, PUBLIC :: cp
+  PUBLIC :: kind_info
+CONTAINS
+  SUBROUTINE kind_info()
+  END SUBROUTINE kind_info
+END MODULE kinds
+"""
+
+userSrc="""MODULE user
+  USE kinds, ONLY: dp
+  IMPLICIT NONE
+  PRIVATE
+  PUBLIC :: run
+CONTAINS
+  SUBROUTINE run(x)
+    REAL(KIND=dp) :: x
+    CALL helper(x)
+  END SUBROUTINE run
+  SUBROUTINE helper(x)
+    REAL(KIND=dp) :: x
+  END SUBROUTINE helper
+END MODULE user
+"""
+
+class xrefTest(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        for (name,src) in (("kinds.F",moduleSrc),("user.F",userSrc)):
+            f=open(os.path.join(self.dir,name),"w")
+            f.write(src)
+            f.close()
+        self.xref=fortranXref.XrefDatabase(os.path.join(self.dir,"xref.db"))
+    def tearDown(self):
+        self.xref.close()
+        shutil.rmtree(self.dir)
+    def testIndex(self):
+        self.assertEqual(self.xref.updateDir(self.dir),2)
+        errors=self.xref.db.execute(
+            "select path,error from files where error is not null").fetchall()
+        self.assertEqual(errors,[])
+        modules=self.xref.db.execute(
+            "select name,line,defaultPrivate,complete from modules "+
+            "order by name").fetchall()
+        self.assertEqual(modules,[("kinds",1,1,1),("user",1,1,1)])
+        symbols=self.xref.db.execute(
+            "select name from symbols where module='kinds' order by name")
+        self.assertEqual([row[0] for row in symbols],["cp","dp","kind_info"])
+        users=self.xref.users("kinds")
+        self.assertEqual([(unit,only) for (unit,only,path,line) in users],
+                         [("user","dp")])
+        callers=self.xref.callers("helper")
+        self.assertEqual([(caller,line) for (caller,path,line) in callers],
+                         [("run",9)])
+        self.assertEqual(self.xref.updateDir(self.dir),0)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# checks that input_converter keeps the rows of the coordinate sections
+
+import unittest, StringIO
+import input_converter
+from input_parser import Parser, InputFile
+
+coordInput="""&FORCE_EVAL
+  METHOD Quickstep
+  &SUBSYS
+    &COORD
+      UNIT angstrom
+      O 0.0 0.0 0.0 # oxygen
+      H 0.0 0.757 0.587 H2O
+    &END COORD
+    &VELOCITY
+      1.0e-4 2.0e-4 3.0e-4
+      -1.0e-4 0.0 0.5
+    &END VELOCITY
+  &END SUBSYS
+&END FORCE_EVAL
+"""
+
+splitCoordInput="""&FORCE_EVAL
+  &SUBSYS
+    &COORD
+      O 0.0 0.0 0.0 # oxygen
+    &END COORD
+    &COORD
+      # second molecule
+      H 0.0 0.757 0.587 H2O
+      H 0.0 -0.757 0.587
+    &END COORD
+  &END SUBSYS
+&END FORCE_EVAL
+"""
+
+def convert(text):
+    inF=StringIO.StringIO(text)
+    inF.name="test.inp"
+    oldInput=InputFile(inF.name)
+    oldInput.parse_file(Parser(inF))
+    newInput=InputFile("out.inp")
+    input_converter.mainConv.convert(oldInput,newInput)
+    outF=StringIO.StringIO()
+    newInput.write(outF)
+    return outF.getvalue()
+
+def sectionLines(text,name):
+    lines=text.splitlines()
+    start=lines.index("    &"+name)
+    end=lines.index("    &END "+name)
+    return [line.strip() for line in lines[start+1:end]]
+
+class convertCoordTest(unittest.TestCase):
+    def testCoord(self):
+        self.assertEqual(sectionLines(convert(coordInput),"COORD"),
+                         ["UNIT angstrom","O 0.0 0.0 0.0 # oxygen",
+                          "H 0.0 0.757 0.587 H2O"])
+    def testVelocity(self):
+        self.assertEqual(sectionLines(convert(coordInput),"VELOCITY"),
+                         ["0.0001 0.0002 0.0003","-0.0001 0.0 0.5"])
+    def testDuplicateCoord(self):
+        self.assertEqual(sectionLines(convert(splitCoordInput),"COORD"),
+                         ["O 0.0 0.0 0.0 # oxygen","# second molecule",
+                          "H 0.0 0.757 0.587 H2O","H 0.0 -0.757 0.587"])
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+# checks that the edits of a lazily parsed input are written out
+
+import unittest, StringIO
+from input_parser import Parser, InputFile
+
+testInput="""&GLOBAL
+  PROJECT water
+&END GLOBAL
+&FORCE_EVAL
+  METHOD Quickstep
+  &SUBSYS
+    &KIND H
+      BASIS_SET DZVP
+    &END KIND
+  &END SUBSYS
+&END FORCE_EVAL
+"""
+
+def parse(text,lazy):
+    inF=StringIO.StringIO(text)
+    inF.name="test.inp"
+    inp=InputFile(inF.name)
+    inp.parse_file(Parser(inF),lazy=lazy)
+    return inp
+
+def write(inp):
+    outF=StringIO.StringIO()
+    inp.write(outF)
+    return outF.getvalue()
+
+class lazyEditTest(unittest.TestCase):
+    def testUnchanged(self):
+        self.assertEqual(write(parse(testInput,1)),write(parse(testInput,0)))
+    def testSetSectionArgs(self):
+        for lazy in (0,1):
+            inp=parse(testInput,lazy)
+            inp.set("FORCE_EVAL%SUBSYS%KIND",["O"])
+            inp.set("GLOBAL",["ARG"])
+            out=write(inp)
+            self.assertTrue("&KIND O\n" in out)
+            self.assertFalse("&KIND H" in out)
+            self.assertTrue("&GLOBAL ARG\n" in out)
+            self.assertTrue("BASIS_SET DZVP" in out)
+    def testRename(self):
+        inp=parse(testInput,1)
+        inp.get("FORCE_EVAL%SUBSYS%KIND").name="KIND_OLD"
+        out=write(inp)
+        self.assertTrue("&KIND_OLD H\n" in out)
+        self.assertTrue("&END KIND_OLD\n" in out)
+
+if __name__=="__main__":
+    unittest.main()
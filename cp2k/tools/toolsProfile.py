@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+"""Opt-in instrumentation of the source tools.
+
+When enabled, the stages of the tools (replace, normalize-use,
+clean-declarations, upcase, synopsis, instantiate) record for each file
+the number of calls, the wall time, the lines processed and the bytes read
+and written. With regexp counting also the calls to the methods of
+compiled regular expressions (match, search, sub,...) are counted, this
+uses sys.setprofile and makes the tools noticeably slower, so the times
+are then inflated. The counts of a stage include those of the stages
+nested in it (clean-declarations is part of normalize-use).
+
+Profiling is enabled with enable(), or by setting the environment variable
+CP2K_TOOLS_PROFILE to the file where the profile should be written (and
+CP2K_TOOLS_PROFILE_REGEX=1 to count the regexp calls). The profile is
+written as json when the process exits:
+  {"regexCounted":..., "totalTime":...,
+   "stages":{stage:{"calls","time","lines","bytesIn","bytesOut",
+                    "regexCalls","files"}},
+   "files":[{"file","stage","calls","time",...}]}
+with the files sorted by decreasing time.
+Worker processes should send their records (see takeRecords) to the parent
+that merges them with addRecords."""
+
+import sys, os, re, time
+
+enabled=0
+countRegex=0
+profileFile=None
+_startTime=None
+_regexCalls=0
+# (fileName,stage) -> [calls,time,lines,bytesIn,bytesOut,regexCalls]
+_stats={}
+_fields=('calls','time','lines','bytesIn','bytesOut','regexCalls')
+_patternType=type(re.compile(""))
+_atexitRegistered=0
+
+def _countRegexCalls(frame,event,arg):
+    global _regexCalls
+    if event=='c_call' and type(getattr(arg,'__self__',None)) is _patternType:
+        _regexCalls+=1
+
+def enable(fileName=None,regex=0):
+    """Starts profiling, if fileName is given the profile is written to it
+    at exit. If regex is true the regexp calls are counted"""
+    global enabled, countRegex, profileFile, _startTime, _atexitRegistered
+    enabled=1
+    if _startTime is None:
+        _startTime=time.time()
+    if fileName:
+        profileFile=fileName
+        if not _atexitRegistered:
+            import atexit
+            atexit.register(_dumpAtExit)
+            _atexitRegistered=1
+    if regex and not countRegex:
+        countRegex=1
+        sys.setprofile(_countRegexCalls)
+
+def start():
+    """Returns the token to pass to stop at the end of a stage (None if
+    profiling is disabled)"""
+    if not enabled:
+        return None
+    return (time.time(),_regexCalls)
+
+def stop(stage,fileName,started,lines=0,bytesIn=0,bytesOut=0):
+    """Records a call of stage on fileName, started is the value returned
+    by start at the beginning of the stage"""
+    if started is None:
+        return
+    elapsed=time.time()-started[0]
+    stat=_stats.get((fileName,stage))
+    if stat is None:
+        stat=[0,0.0,0,0,0,0]
+        _stats[(fileName,stage)]=stat
+    stat[0]+=1
+    stat[1]+=elapsed
+    stat[2]+=lines
+    stat[3]+=bytesIn
+    stat[4]+=bytesOut
+    stat[5]+=_regexCalls-started[1]
+
+def takeRecords():
+    """Returns the records collected so far (a list of tuples, that can be
+    pickled) and forgets them"""
+    records=[key+tuple(stat) for (key,stat) in _stats.items()]
+    _stats.clear()
+    return records
+
+def addRecords(records):
+    """Merges the records returned by takeRecords (in another process)"""
+    for record in records:
+        key=record[:2]
+        stat=_stats.get(key)
+        if stat is None:
+            _stats[key]=list(record[2:])
+        else:
+            for i in xrange(len(stat)):
+                stat[i]+=record[2+i]
+
+def profile():
+    """Returns the profile collected so far (see the module documentation)"""
+    files=[]
+    stages={}
+    for ((fileName,stage),stat) in _stats.items():
+        entry={'file':fileName,'stage':stage}
+        entry.update(zip(_fields,stat))
+        files.append(entry)
+        total=stages.get(stage)
+        if total is None:
+            total=dict.fromkeys(_fields,0)
+            total['files']=0
+            stages[stage]=total
+        for (field,value) in zip(_fields,stat):
+            total[field]+=value
+        total['files']+=1
+    files.sort(key=lambda entry:(-entry['time'],entry['file'],entry['stage']))
+    totalTime=0.0
+    if _startTime is not None:
+        totalTime=time.time()-_startTime
+    return {'regexCounted':bool(countRegex),'totalTime':totalTime,
+            'stages':stages,'files':files}
+
+def dump(fileName):
+    """Writes the profile as json to fileName"""
+    import json
+    f=open(fileName,'w')
+    try:
+        json.dump(profile(),f,indent=1,sort_keys=True)
+        f.write("\n")
+    finally:
+        f.close()
+
+def _dumpAtExit():
+    if enabled and profileFile:
+        dump(profileFile)
+
+if os.environ.get('CP2K_TOOLS_PROFILE'):
+    enable(os.path.abspath(os.environ['CP2K_TOOLS_PROFILE']),
+           os.environ.get('CP2K_TOOLS_PROFILE_REGEX','0') not in ('','0'))